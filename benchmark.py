@@ -0,0 +1,376 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from botocore.awsrequest import AWSResponse
+
+import monthly_report
+
+# resource is not available on Windows; peak RSS is not reported there
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Platform names accepted in --platform-mix and the PlatformDetails they stand for
+PLATFORMS = {'windows': 'Windows', 'rhel': 'Red Hat Enterprise Linux', 'linux': 'Linux/UNIX'}
+
+# Page sizes of the fake APIs, close to the AWS defaults
+PAGE_SIZES = {'DescribeInstances': 100, 'ListMetrics': 500, 'DescribeInstancePatches': 50, 'DescribeDBInstances': 100, 'DescribeDBClusters': 100}
+
+# NotApplicable patches listed per installed patch, as on long-lived servers
+NOT_APPLICABLE_PATCHES = 20
+
+# GetMetricData returns at most this many datapoints per call before paginating
+MAX_DATAPOINTS_PER_CALL = 100800
+
+# The fleet a benchmark process serves; set before worker processes fork so they can build sessions
+FLEET = None
+
+
+# Function to parse a platform mix like "windows=2,rhel=1,linux=1" into {PlatformDetails: weight}
+def parse_platform_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[PLATFORMS[name.strip().lower()]] = float(weight or 1)
+    return mix
+
+
+# Synthetic AWS account for offline benchmarks. Sessions created by session() answer EC2, CloudWatch, SSM,
+# RDS, STS and IAM calls from this fleet through a botocore before-call hook (the same short-circuit
+# Stubber uses), so nothing goes over the network. Every call is counted per service and operation.
+class FakeFleet:
+    def __init__(self, instances=50, platform_mix=None, volumes=(1, 2), patches=5, datapoints=None,
+                 databases=5, latency_ms=0, month_start=None, seed=1):
+        rnd = random.Random(seed)
+        platform_mix = platform_mix or {platform: 1 for platform in PLATFORMS.values()}
+        self.patches = patches
+        # Patches are installed, and patch scans run, during the reported month
+        self.month_start = month_start or datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        self.datapoints = datapoints
+        self.latency = latency_ms / 1000.0
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.values = [rnd.random() * 100 for _ in range(10007)]
+        self._timestamps = {}
+
+        self.instances = []
+        self.disks = {}
+        for number in range(instances):
+            instance_id = f'i-{number:017x}'
+            platform = rnd.choices(list(platform_mix), weights=list(platform_mix.values()))[0]
+            volume_count = rnd.randint(*volumes)
+            self.instances.append({
+                'InstanceId': instance_id,
+                'ImageId': 'ami-0123456789abcdef0',
+                'InstanceType': rnd.choice(['t3.medium', 'm5.large', 'r5.xlarge']),
+                'State': {'Name': 'running'},
+                'PlatformDetails': platform,
+                'BlockDeviceMappings': [{'DeviceName': f'/dev/sd{chr(97 + volume)}'} for volume in range(volume_count)],
+                'Tags': [{'Key': 'Name', 'Value': f'bench-{number:05d}'}]
+            })
+            if platform == 'Windows':
+                self.disks[instance_id] = [('N/A', drive) for drive in ['C:', 'D:', 'E:', 'F:'][:volume_count]]
+            elif platform == 'Red Hat Enterprise Linux':
+                self.disks[instance_id] = [('nvme0n1p2', '/')] + [(f'nvme{volume}n1', f'/data{volume}') for volume in range(1, volume_count)]
+
+        engines = ['postgres', 'mysql', 'aurora-mysql', 'aurora-postgresql']
+        self.databases = [
+            {'DBInstanceIdentifier': f'bench-db-{number:03d}', 'Engine': engines[number % len(engines)], 'DBInstanceClass': 'db.r5.large'}
+            for number in range(databases)
+        ]
+        # Every Aurora database is the writer of its own cluster
+        self.clusters = [
+            {'DBClusterIdentifier': f"{database['DBInstanceIdentifier']}-cluster", 'Engine': database['Engine']}
+            for database in self.databases if database['Engine'].startswith('aurora')
+        ]
+
+    # Function to create a boto3 session whose calls are answered by the fleet
+    def session(self):
+        session = boto3.Session(aws_access_key_id='bench', aws_secret_access_key='bench', region_name='us-east-1')
+        session.events.register('before-parameter-build', self._remember_parameters)
+        session.events.register('before-call', self._handle)
+        return session
+
+    # Function to reset and return the call counters
+    def take_calls(self):
+        with self.lock:
+            calls = dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    def _remember_parameters(self, params, context, **kwargs):
+        context['bench_parameters'] = dict(params)
+
+    def _handle(self, model, context, **kwargs):
+        with self.lock:
+            self.calls[f'{model.service_model.service_name}:{model.name}'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, f'_{model.name}', None)
+        if handler is None:
+            raise NotImplementedError(f'The benchmark fleet does not answer {model.name}')
+        return AWSResponse(None, 200, {}, None), handler(context.get('bench_parameters', {}))
+
+    # Function to return one page of items, using NextToken (or Marker for RDS) like the real APIs
+    def _page(self, operation_name, items, params, result_key, token_name='NextToken'):
+        start = int(params.get(token_name) or 0)
+        size = min(params.get('MaxResults') or params.get('MaxRecords') or PAGE_SIZES[operation_name], PAGE_SIZES[operation_name])
+        page = {result_key: items[start:start + size]}
+        if start + size < len(items):
+            page[token_name] = str(start + size)
+        return page
+
+    def _DescribeInstances(self, params):
+        ids = set(params.get('InstanceIds') or [])
+        instances = [instance for instance in self.instances if not ids or instance['InstanceId'] in ids]
+        return self._page('DescribeInstances', [{'Instances': [instance]} for instance in instances], params, 'Reservations')
+
+    def _ListMetrics(self, params):
+        metrics = []
+        for instance in self.instances:
+            instance_id = instance['InstanceId']
+            windows = instance['PlatformDetails'] == 'Windows'
+            if windows != (params.get('MetricName') == 'LogicalDisk % Free Space'):
+                continue
+            for device, disk in self.disks.get(instance_id, []):
+                if windows:
+                    dimensions = [
+                        {'Name': 'instance', 'Value': disk}, {'Name': 'InstanceId', 'Value': instance_id},
+                        {'Name': 'ImageId', 'Value': instance['ImageId']}, {'Name': 'objectname', 'Value': 'LogicalDisk'},
+                        {'Name': 'InstanceType', 'Value': instance['InstanceType']}
+                    ]
+                else:
+                    dimensions = [
+                        {'Name': 'InstanceId', 'Value': instance_id}, {'Name': 'ImageId', 'Value': instance['ImageId']},
+                        {'Name': 'InstanceType', 'Value': instance['InstanceType']}, {'Name': 'device', 'Value': device},
+                        {'Name': 'fstype', 'Value': 'xfs'}, {'Name': 'path', 'Value': disk}
+                    ]
+                metrics.append({'Namespace': 'CWAgent', 'MetricName': params.get('MetricName'), 'Dimensions': dimensions})
+        return self._page('ListMetrics', metrics, params, 'Metrics')
+
+    # Function to get the timestamps of a series, shared between queries with the same window and period
+    def _series_timestamps(self, start_time, end_time, period):
+        window = (start_time, end_time, period)
+        if window not in self._timestamps:
+            start_time = start_time if start_time.tzinfo else start_time.replace(tzinfo=timezone.utc)
+            end_time = end_time if end_time.tzinfo else end_time.replace(tzinfo=timezone.utc)
+            count = max(int(-(-(end_time - start_time).total_seconds() // period)), 0)
+            step = period
+            if self.datapoints is not None and count > self.datapoints:
+                step = (end_time - start_time).total_seconds() / max(self.datapoints, 1)
+                count = self.datapoints
+            self._timestamps[window] = [start_time + timedelta(seconds=step * index) for index in range(count)]
+        return self._timestamps[window]
+
+    def _GetMetricData(self, params):
+        queries = params['MetricDataQueries']
+        first_query = int(params.get('NextToken') or 0)
+        results = []
+        datapoint_count = 0
+        for index in range(first_query, len(queries)):
+            query = queries[index]
+            timestamps = self._series_timestamps(params['StartTime'], params['EndTime'], query['MetricStat']['Period'])
+            if results and datapoint_count + len(timestamps) > MAX_DATAPOINTS_PER_CALL:
+                return {'MetricDataResults': results, 'NextToken': str(index)}
+            offset = zlib.crc32(json.dumps(query['MetricStat'], sort_keys=True).encode()) % len(self.values)
+            values = (self.values * (len(timestamps) // len(self.values) + 2))[offset:offset + len(timestamps)]
+            results.append({
+                'Id': query['Id'], 'Label': query['Id'], 'Timestamps': timestamps,
+                'Values': values, 'StatusCode': 'Complete'
+            })
+            datapoint_count += len(timestamps)
+        return {'MetricDataResults': results}
+
+    def _DescribeInstancePatches(self, params):
+        patches = [
+            {
+                'Title': f'Security update {number}', 'KBId': f'KB{5000000 + number}', 'Classification': 'SecurityUpdates',
+                'Severity': 'Important', 'State': 'Installed', 'InstalledTime': self.month_start + timedelta(days=number % 28)
+            }
+            for number in range(self.patches)
+        ]
+        # Long-lived servers also carry a history of patches that do not apply to them
+        patches += [
+            {
+                'Title': f'Update {number}', 'KBId': f'KB{4000000 + number}', 'Classification': 'Updates',
+                'Severity': 'Unspecified', 'State': 'NotApplicable'
+            }
+            for number in range(self.patches * NOT_APPLICABLE_PATCHES)
+        ]
+        for patch_filter in params.get('Filters', []):
+            if patch_filter['Key'] == 'State':
+                patches = [patch for patch in patches if patch['State'] in patch_filter['Values']]
+        return self._page('DescribeInstancePatches', patches, params, 'Patches')
+
+    def _DescribeInstancePatchStates(self, params):
+        operation_time = self.month_start + timedelta(days=20)
+        return {'InstancePatchStates': [
+            {
+                'InstanceId': instance_id, 'PatchGroup': 'bench', 'BaselineId': 'pb-0123456789abcdef0', 'Operation': 'Scan',
+                'OperationStartTime': operation_time, 'OperationEndTime': operation_time,
+                'InstalledCount': self.patches, 'InstalledOtherCount': 0, 'InstalledPendingRebootCount': 0,
+                'InstalledRejectedCount': 0, 'MissingCount': 1, 'FailedCount': 0
+            }
+            for instance_id in params.get('InstanceIds', [])
+        ]}
+
+    def _DescribeDBInstances(self, params):
+        return self._page('DescribeDBInstances', self.databases, params, 'DBInstances', 'Marker')
+
+    def _DescribeDBClusters(self, params):
+        return self._page('DescribeDBClusters', self.clusters, params, 'DBClusters', 'Marker')
+
+    def _DescribeRegions(self, params):
+        return {'Regions': [{'RegionName': 'us-east-1'}]}
+
+    def _GetCallerIdentity(self, params):
+        return {'Account': '123456789012', 'Arn': 'arn:aws:sts::123456789012:assumed-role/bench/bench', 'UserId': 'bench'}
+
+    def _ListAccountAliases(self, params):
+        return {'AccountAliases': ['bench-account'], 'IsTruncated': False}
+
+
+# Function to stand in for initialize_session while benchmarking main
+def bench_session(profile_name):
+    return FLEET.session()
+
+
+# Function to run one profile of main and attach the API calls it made (in whichever process ran it)
+def counted_run_profile(profile_name, month_year, start_time, end_time, report_options, months=None, output_dir=''):
+    FLEET.take_calls()
+    summary = bench_run_profile(profile_name, month_year, start_time, end_time, report_options, months, output_dir)
+    summary['API calls'] = json.dumps(FLEET.take_calls(), sort_keys=True)
+    return summary
+
+
+bench_run_profile = monthly_report.run_profile
+
+
+# Function to get the peak resident set size of this process and its finished children, in MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if os.uname().sysname == 'Darwin' else 1024  # ru_maxrss is bytes on macOS, KB elsewhere
+    return {
+        'self': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        'children': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)
+    }
+
+
+# Function to run one benchmark scenario; runs in a fresh process so peak RSS belongs to the scenario
+def run_scenario(scenario):
+    global FLEET
+    month_year = scenario['month']
+    start_time, end_time = monthly_report.parse_month_year(month_year)
+    FLEET = FakeFleet(month_start=start_time.replace(tzinfo=timezone.utc), **scenario['fleet'])
+    output_folder = os.path.join(scenario['output'], f"{scenario['mode']}-{scenario['fleet']['instances']}")
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+
+    result = {'mode': scenario['mode'], 'instances': scenario['fleet']['instances']}
+    started = time.perf_counter()
+    if scenario['mode'] == 'report':
+        report = monthly_report.generate_report(
+            'bench', FLEET.session(), start_time, end_time, output_folder, **scenario['report_options']
+        )
+        result['wall_seconds'] = round(time.perf_counter() - started, 2)
+        result['charts'] = report['charts']
+        result['render_seconds'] = round(report['render_seconds'], 2)
+        result['api_calls'] = FLEET.take_calls()
+    else:
+        # main writes its reports to monthly-reports-<month> in the scenario's output folder
+        summaries = []
+        write_run_summary = monthly_report.write_run_summary
+        monthly_report.initialize_session = bench_session
+        monthly_report.run_profile = counted_run_profile
+        monthly_report.write_run_summary = lambda profile_summaries, *args: summaries.extend(profile_summaries) or write_run_summary(profile_summaries, *args)
+        profile_names = [f'bench-{number}' for number in range(scenario['profiles'])]
+        monthly_report.main(profile_names, month_year, scenario['processes'], output_dir=output_folder, **scenario['report_options'])
+        result['wall_seconds'] = round(time.perf_counter() - started, 2)
+        api_calls = Counter()
+        for summary in summaries:
+            api_calls.update(json.loads(summary.get('API calls', '{}')))
+        result['api_calls'] = dict(api_calls)
+        result['profiles'] = scenario['profiles']
+    result['total_api_calls'] = sum(result['api_calls'].values())
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+# Function to print one scenario result
+def print_result(result):
+    print(f"\n{result['mode']} with {result['instances']} instances: {result['wall_seconds']}s wall time, "
+          f"{result['total_api_calls']} API calls, peak RSS {result['peak_rss_mb']}")
+    if 'render_seconds' in result:
+        print(f"  {result['charts']} charts rendered in {result['render_seconds']}s of worker time")
+    for operation, count in sorted(result['api_calls'].items()):
+        print(f"  {operation:<45} {count}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the report against a simulated AWS fleet (no network).')
+    parser.add_argument('--instances', type=int, nargs='+', default=[50], help='Fleet sizes to run (default: 50)')
+    parser.add_argument('--platform-mix', default='windows=1,rhel=1,linux=1', help='Platform weights (windows, rhel, linux)')
+    parser.add_argument('--volumes', default='1-2', help='Range of volumes per instance, e.g. 1-2')
+    parser.add_argument('--patches', type=int, default=5, help='Patches per instance')
+    parser.add_argument('--datapoints', type=int, help='Datapoints per series (default: one per period)')
+    parser.add_argument('--databases', type=int, default=5, help='Number of RDS instances')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Simulated latency of every API call')
+    parser.add_argument('--month', default='09-2024', help='Month to report (MM-YYYY)')
+    parser.add_argument('--mode', choices=['report', 'main'], default='report', help='Benchmark generate_report or main')
+    parser.add_argument('--profiles', type=int, default=2, help='Profiles to run in main mode')
+    parser.add_argument('--processes', type=int, default=1, help='Profiles run in parallel in main mode')
+    parser.add_argument('--workers', type=int, default=8, help='Workers per profile')
+    parser.add_argument('--chart-processes', type=int, help='Chart rendering processes')
+    parser.add_argument('--no-png-charts', action='store_true', help='Do not draw PNG charts')
+    parser.add_argument('--output', help='Folder for the generated reports (default: a temporary folder)')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    low, _, high = args.volumes.partition('-')
+    output = os.path.abspath(args.output or tempfile.mkdtemp(prefix='report-benchmark-'))
+    results = []
+    for instance_count in args.instances:
+        scenario = {
+            'mode': args.mode,
+            'month': args.month,
+            'output': output,
+            'profiles': args.profiles,
+            'processes': args.processes,
+            'fleet': {
+                'instances': instance_count,
+                'platform_mix': parse_platform_mix(args.platform_mix),
+                'volumes': (int(low), int(high or low)),
+                'patches': args.patches,
+                'datapoints': args.datapoints,
+                'databases': args.databases,
+                'latency_ms': args.latency_ms
+            },
+            'report_options': {
+                'workers': args.workers,
+                'use_cache': False,
+                'chart_processes': args.chart_processes,
+                'png_charts': not args.no_png_charts
+            }
+        }
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_scenario, scenario).result()
+        print_result(result)
+        results.append(result)
+
+    print(f"\nReports written to {output}")
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
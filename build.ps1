@@ -22,7 +22,9 @@ if (Test-Path .\*.spec) {
 }
 
 # build the executable file
-python -m PyInstaller --onefile --name aws_monthly_report_$newVersion .\monthly_report.py
+# pandas is only used to load exported datasets, never by the report, so it is left out of the executable
+# to keep the one-file start-up short (matplotlib is still bundled and loaded on the first chart)
+python -m PyInstaller --onefile --exclude-module pandas --exclude-module openpyxl --name aws_monthly_report_$newVersion .\monthly_report.py
 
 # create output folder if not exist
 $outputFolder = ".\output"
@@ -0,0 +1,186 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Seconds in a day, the bucket size of the daily utilization charts
+DAY = 86400
+
+# Figures reused by this process, one per figure size, so each chart only redraws its axes
+_figures = {}
+
+
+# Function to describe a line chart of the daily mean of an hourly series (timestamps in epoch seconds)
+# Returns None when there are fewer than two datapoints, as there is nothing to draw
+def daily_utilization_chart(series, label, color, title, graph_file):
+    timestamps, values = series
+    if len(values) < 2:
+        return None
+    return {
+        'kind': 'daily', 'file': graph_file, 'title': title, 'label': label, 'color': color,
+        'timestamps': np.asarray(timestamps), 'values': np.asarray(values), 'figsize': (10, 6)
+    }
+
+
+# Function to describe a line chart of a raw series, e.g. the RDS graphs
+# Returns None when the series has no datapoints, as there is nothing to draw
+def line_chart(series, label, color, title, ylabel, graph_file):
+    timestamps, values = series
+    if not len(values):
+        return None
+    return {
+        'kind': 'line', 'file': graph_file, 'title': title, 'label': label, 'color': color, 'ylabel': ylabel,
+        'timestamps': np.asarray(timestamps), 'values': np.asarray(values), 'figsize': (6.4, 4.8)
+    }
+
+
+# Function to describe a bar chart, e.g. the average inbound/outbound bandwidth of an instance
+def bar_chart(labels, values, colors, title, xlabel, ylabel, graph_file):
+    return {
+        'kind': 'bar', 'file': graph_file, 'title': title, 'labels': list(labels), 'values': list(values),
+        'colors': list(colors), 'xlabel': xlabel, 'ylabel': ylabel, 'figsize': (10, 6)
+    }
+
+
+# Function to describe a line chart with one line per series over labelled points, e.g. monthly averages
+# series is a list of (label, color, values); missing values (None) leave a gap in the line
+def trend_chart(labels, series, title, ylabel, graph_file):
+    return {
+        'kind': 'trend', 'file': graph_file, 'title': title, 'ylabel': ylabel, 'labels': list(labels),
+        'series': [(label, color, np.array(values, dtype=float)) for label, color, values in series], 'figsize': (10, 6)
+    }
+
+
+# Function to average an hourly series per day, filling days without data by linear interpolation
+def daily_means(timestamps, values):
+    days = timestamps // DAY
+    day_index = days - days[0]
+    counts = np.bincount(day_index)
+    sums = np.bincount(day_index, weights=values)
+    present = counts > 0
+    positions = np.arange(len(counts))
+    means = np.interp(positions, positions[present], sums[present] / counts[present])
+    return ((days[0] + positions) * DAY).astype('datetime64[s]'), means
+
+
+# Function to get the reusable figure and axes of a size, cleared for the next chart
+# matplotlib is imported on the first chart drawn, so runs without PNG charts never load it
+def _figure(figsize):
+    if figsize not in _figures:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        figure = Figure(figsize=figsize)
+        FigureCanvasAgg(figure)
+        _figures[figsize] = (figure, figure.add_subplot())
+    figure, axes = _figures[figsize]
+    axes.clear()
+    return figure, axes
+
+
+# Function to rotate the x tick labels of an axes so dates do not overlap
+def _rotate_xticks(axes, horizontal_alignment='center'):
+    for tick_label in axes.get_xticklabels():
+        tick_label.set_rotation(45)
+        tick_label.set_horizontalalignment(horizontal_alignment)
+
+
+# Function to draw one chart description to its PNG file, creating its folder when needed
+def render_chart(chart):
+    figure, axes = _figure(chart['figsize'])
+    if chart['kind'] == 'daily':
+        days, means = daily_means(chart['timestamps'], chart['values'])
+        axes.plot(days, means, label=chart['label'], color=chart['color'], linestyle='-', marker='o')
+        axes.set_xlabel('Time')
+        axes.set_ylabel('Utilization (%)')
+        axes.legend()
+        axes.grid(True)
+        _rotate_xticks(axes, 'right')
+    elif chart['kind'] == 'line':
+        axes.plot(chart['timestamps'].astype('datetime64[s]'), chart['values'], label=chart['label'], color=chart['color'])
+        axes.set_xlabel('Timestamp')
+        axes.set_ylabel(chart['ylabel'])
+        _rotate_xticks(axes)
+    elif chart['kind'] == 'trend':
+        for label, color, values in chart['series']:
+            axes.plot(chart['labels'], values, label=label, color=color, linestyle='-', marker='o')
+        axes.set_xlabel('Month')
+        axes.set_ylabel(chart['ylabel'])
+        axes.legend()
+        axes.grid(True)
+        _rotate_xticks(axes, 'right')
+    else:
+        axes.bar(chart['labels'], chart['values'], color=chart['colors'])
+        axes.set_xlabel(chart['xlabel'])
+        axes.set_ylabel(chart['ylabel'])
+    axes.set_title(chart['title'])
+    figure.tight_layout()
+    os.makedirs(os.path.dirname(chart['file']) or '.', exist_ok=True)
+    figure.savefig(chart['file'])
+
+
+# Function to draw a list of chart descriptions, returning how many were drawn and the seconds it took
+def render_charts(charts):
+    started = time.perf_counter()
+    for chart in charts:
+        render_chart(chart)
+    return len(charts), time.perf_counter() - started
+
+
+# Renders queued per worker process before submit waits for the oldest one to finish
+MAX_PENDING_RENDERS_PER_PROCESS = 4
+
+
+# Rendering stage: chart descriptions are queued as instances finish and drawn by a pool of worker
+# processes, so rendering scales with the cores and does not hold up the collection loop.
+# At most MAX_PENDING_RENDERS_PER_PROCESS renders per process are queued: when collection is faster than
+# rendering, submit waits, so queued chart data does not grow with the fleet.
+# With processes=0 charts are drawn in the calling process as they are submitted.
+class ChartRenderer:
+    def __init__(self, processes=None):
+        self.processes = (os.cpu_count() or 1) if processes is None else processes
+        self.executor = ProcessPoolExecutor(max_workers=self.processes) if self.processes > 0 else None
+        self.max_pending = self.processes * MAX_PENDING_RENDERS_PER_PROCESS
+        self.futures = []
+        self.charts = 0
+        self.render_seconds = 0.0
+
+    # Function to queue the charts of one instance or database
+    def submit(self, charts):
+        charts = [chart for chart in charts if chart is not None]
+        if not charts:
+            return
+        if self.executor is None:
+            self._record(render_charts(charts))
+        else:
+            self.futures.append(self.executor.submit(render_charts, charts))
+            self._collect_done()
+            while len(self.futures) > self.max_pending:
+                self._record(self.futures.pop(0).result())
+
+    def _record(self, result):
+        charts, seconds = result
+        self.charts += charts
+        self.render_seconds += seconds
+
+    # Function to pick up finished renders, so failed charts surface early and futures do not pile up
+    def _collect_done(self):
+        pending = []
+        for future in self.futures:
+            if future.done():
+                self._record(future.result())
+            else:
+                pending.append(future)
+        self.futures = pending
+
+    # Function to wait for every queued chart and shut the worker processes down
+    def close(self):
+        try:
+            for future in self.futures:
+                self._record(future.result())
+            self.futures = []
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+        return self.charts, self.render_seconds
@@ -0,0 +1,99 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+
+# Function to turn a stored patch row back into the row get_monthly_patches returns (Installed Time as datetime)
+def patch_row_from_json(row):
+    if isinstance(row.get('Installed Time'), str):
+        row['Installed Time'] = datetime.fromisoformat(row['Installed Time'])
+    return row
+
+
+# Local store of what the background collector gathers during the month, next to the CloudWatch cache in the
+# report folder: the latest inventory snapshot (running instances, disk volumes, RDS instances and clusters,
+# account name) and the compliance and patch rows of each instance. generate_report reads it instead of
+# EC2, SSM and RDS when run with collected=True.
+class CollectedData:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS snapshot (name TEXT PRIMARY KEY, payload TEXT NOT NULL)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS patch_data ('
+            'instance_id TEXT PRIMARY KEY, operation_end TEXT, compliance TEXT NOT NULL, patches TEXT NOT NULL)'
+        )
+        self.connection.commit()
+
+    # Function to open the store of a report folder, or None when the collector has not written one
+    @classmethod
+    def open(cls, output_folder, file_name='collected.sqlite'):
+        path = os.path.join(output_folder, file_name)
+        return cls(path) if os.path.exists(path) else None
+
+    def _get(self, name, default=None):
+        with self.lock:
+            row = self.connection.execute('SELECT payload FROM snapshot WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    # Function to replace the inventory snapshot; instances are describe_instances entries
+    def put_snapshot(self, instances, disk_index, rds_resources, account_name):
+        rows = [
+            ('instances', json.dumps(instances, default=str)),
+            ('disk_index', json.dumps(disk_index)),
+            ('rds_resources', json.dumps(rds_resources)),
+            ('account_name', json.dumps(account_name))
+        ]
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO snapshot (name, payload) VALUES (?, ?)', rows)
+            self.connection.commit()
+
+    def instances(self):
+        return self._get('instances', [])
+
+    def disk_index(self):
+        return self._get('disk_index', {})
+
+    def rds_resources(self):
+        return self._get('rds_resources', [])
+
+    def account_name(self):
+        return self._get('account_name')
+
+    # Function to get the OperationEndTime the stored patch rows of an instance were listed after, or None
+    def patch_operation_end(self, instance_id):
+        with self.lock:
+            row = self.connection.execute('SELECT operation_end FROM patch_data WHERE instance_id = ?', (instance_id,)).fetchone()
+        return row[0] if row else None
+
+    # Function to store the compliance rows of an instance, and its patch rows unless patches is None
+    # (the patches listed after an earlier run are kept when the last patch operation has not changed)
+    def put_patch_data(self, instance_id, operation_end, compliance, patches=None):
+        with self.lock:
+            if patches is None:
+                row = self.connection.execute('SELECT patches FROM patch_data WHERE instance_id = ?', (instance_id,)).fetchone()
+                patches_payload = row[0] if row else '[]'
+            else:
+                patches_payload = json.dumps(patches, default=str)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO patch_data (instance_id, operation_end, compliance, patches) VALUES (?, ?, ?, ?)',
+                (instance_id, operation_end, json.dumps(compliance, default=str), patches_payload)
+            )
+            self.connection.commit()
+
+    # Function to get the (compliance rows, patch rows) of an instance, shaped like collect_instance_patch_data
+    def patch_data(self, instance_id):
+        with self.lock:
+            row = self.connection.execute('SELECT compliance, patches FROM patch_data WHERE instance_id = ?', (instance_id,)).fetchone()
+        if row is None:
+            print(f"No collected patch state found for instance {instance_id}.")
+            return [], []
+        return json.loads(row[0]), [patch_row_from_json(patch) for patch in json.loads(row[1])]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import botocore
+
+from collected_data import CollectedData
+from functions import ClientManager, chunked, initialize_session, iter_instances, parse_profile_names, read_profile_names, service_slot
+from instrumentation import RunInstrumentation, phase
+from metric_cache import DEFAULT_CACHE_SIZE_MB, SETTLE_TIME, MetricCache, to_utc_naive
+from monthly_report import (
+    DEFAULT_PERIODS, INSTANCE_BATCH_SIZE, collect_metric_data, describe_instance_batch, discover_disk_volumes,
+    generate_compliance_report, get_instance_display_name, get_monthly_patches, get_patch_states, get_rds_utilization,
+    iter_rds_resources, parse_month_year, reports_folder
+)
+
+# Seconds between two collection runs of a month (once a day by default)
+DEFAULT_INTERVAL = 86400
+
+# Longest sleep between two checks, so the final run of a month starts soon after the month is closed
+POLL_INTERVAL = 3600
+
+# State file the collector keeps in each report folder
+STATE_FILE = 'collector_state.json'
+
+
+# State of the collection of one profile and month: when it last ran, up to when the metrics were fetched and
+# whether the month is finalised (fetched to its end once late datapoints have landed). Kept as JSON in the
+# report folder and written atomically, so a restarted collector picks up where it stopped.
+class CollectorState:
+    def __init__(self, path):
+        self.path = path
+        self.state = {'last_run': None, 'collected_until': None, 'finalised': False, 'runs': 0}
+        if os.path.exists(path):
+            with open(path) as state_file:
+                self.state.update(json.load(state_file))
+
+    # Function to check whether the month needs a run: the final run is due as soon as the month is closed,
+    # the others once interval seconds have passed since the last run
+    def is_due(self, now, interval, final=False):
+        if self.state['finalised']:
+            return False
+        if final or self.state['last_run'] is None:
+            return True
+        return now - datetime.fromisoformat(self.state['last_run']) >= timedelta(seconds=interval)
+
+    # Function to record a finished run
+    def record(self, now, collected_until, finalised=False):
+        self.state.update({
+            'last_run': now.isoformat(),
+            'collected_until': collected_until.isoformat(),
+            'finalised': finalised,
+            'runs': self.state['runs'] + 1
+        })
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as state_file:
+            json.dump(self.state, state_file, indent=2)
+        os.replace(temporary_path, self.path)
+
+
+# Function to store the compliance and patch rows of a batch of instances
+# Patches are only listed again when the last patch operation of an instance changed since the previous run
+def collect_patch_data(collected_data, inventory, ssm_client, instance_ids, start_time, end_time, instrumentation=None):
+    patch_states = get_patch_states(ssm_client, instance_ids, instrumentation)
+    for instance_id in instance_ids:
+        patch_state = patch_states.get(instance_id)
+        compliance = generate_compliance_report(patch_state, instance_id, get_instance_display_name(instance_id, inventory))
+        operation_end = patch_state.get('OperationEndTime') if patch_state else None
+        operation_end_label = operation_end.isoformat() if operation_end else None
+
+        patches = None
+        if operation_end is None or operation_end.replace(tzinfo=None) < start_time:
+            patches = []
+        elif operation_end_label != collected_data.patch_operation_end(instance_id):
+            with service_slot('ssm', ssm_client.meta.region_name), phase(instrumentation, 'patches'):
+                patches = get_monthly_patches(inventory, instance_id, ssm_client, start_time, end_time)
+        collected_data.put_patch_data(instance_id, operation_end_label, compliance, patches)
+
+
+# Function to collect one month of a profile up to now into its report folder, when a run is due
+# The metrics extend the month-to-date series of the CloudWatch cache (only datapoints since the last run are
+# fetched); once the month is closed, a final run fetches it to its end and stores the closed window, so
+# generate_report with collected=True reads every metric from the cache.
+# Returns True when a run was made
+def collect_month(profile_name, session, month_year, now, interval=DEFAULT_INTERVAL, workers=1,
+                  cache_size_mb=DEFAULT_CACHE_SIZE_MB, periods=DEFAULT_PERIODS, clients=None, output_dir=''):
+    start_time, end_time = parse_month_year(month_year)
+    output_folder = os.path.join(reports_folder(month_year, output_dir=output_dir), f'{profile_name}-{month_year}')
+    os.makedirs(output_folder, exist_ok=True)
+    state = CollectorState(os.path.join(output_folder, STATE_FILE))
+    final = now >= end_time + SETTLE_TIME
+    if not state.is_due(now, interval, final):
+        return False
+    collection_end = min(now, end_time)
+
+    instrumentation = RunInstrumentation()
+    clients = clients or ClientManager(workers)
+    cloudwatch, ec2, ssm_client, rds = (
+        instrumentation.attach(clients.client(session, service_name)) for service_name in ('cloudwatch', 'ec2', 'ssm', 'rds')
+    )
+    cache = MetricCache(os.path.join(output_folder, 'cloudwatch_cache.sqlite'), cache_size_mb, incremental=True)
+    collected_data = CollectedData(os.path.join(output_folder, 'collected.sqlite'))
+    try:
+        with instrumentation.phase('inventory'):
+            instances = list(iter_instances(ec2, filters=[{'Name': 'instance-state-name', 'Values': ['running']}]))
+            disk_index = discover_disk_volumes(cloudwatch)
+            rds_resources = list(iter_rds_resources(rds))
+            account_name = collected_data.account_name() or clients.account_name(session)
+        collected_data.put_snapshot(instances, disk_index, rds_resources, account_name)
+
+        # The next batch is fetched while the previous one finishes, and leaves the inventory once it is stored
+        inventory = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for batch in chunked(instances, INSTANCE_BATCH_SIZE):
+                metric_requests = describe_instance_batch(batch, inventory, disk_index, periods)
+                instance_ids = [instance['InstanceId'] for instance in batch]
+                submitted = (instance_ids, [
+                    executor.submit(collect_metric_data, cloudwatch, metric_requests, start_time, collection_end, cache, instrumentation),
+                    executor.submit(collect_patch_data, collected_data, inventory, ssm_client, instance_ids, start_time, end_time, instrumentation)
+                ])
+                for instance_ids_done, futures in pending:
+                    for future in futures:
+                        future.result()
+                    for instance_id in instance_ids_done:
+                        del inventory[instance_id]
+                pending = [submitted]
+            for _, futures in pending:
+                for future in futures:
+                    future.result()
+
+        for _ in instrumentation.timed_iter('rds', get_rds_utilization(account_name, rds, start_time, collection_end, cloudwatch, cache, periods['utilization'], rds_resources)):
+            pass
+    finally:
+        cache.close()
+        collected_data.close()
+        instrumentation.detach()
+
+    state.record(now, collection_end, final)
+    run_summary = instrumentation.write_summary(
+        os.path.join(output_folder, 'collector_summary.json'),
+        profile=profile_name, month=month_year, collected_until=collection_end, finalised=final, instances=len(instances)
+    )
+    print(f"Collected {len(instances)} instances of {profile_name} for {month_year} up to {collection_end:%Y-%m-%d %H:%M} "
+          f"with {run_summary['api_calls']} API calls{' (month finalised)' if final else ''}")
+    return True
+
+
+# Function to run the collector: every profile's current month is collected once per interval, and the previous
+# month gets its final run after it closes. With once=True a single round is made
+# The clients are kept between rounds; the collector never starts an SSO login itself, as nobody may be there to
+# complete it, so a profile whose token expired gets a new session once someone has logged in again
+def run_collector(profile_names, interval=DEFAULT_INTERVAL, once=False, **collect_options):
+    clients = ClientManager(collect_options.get('workers', 1))
+    sessions = {}
+    while True:
+        now = to_utc_naive(datetime.now(timezone.utc))
+        current_month = now.strftime('%m-%Y')
+        previous_month = (now.replace(day=1) - timedelta(days=1)).strftime('%m-%Y')
+        for profile_name in profile_names:
+            if profile_name not in sessions:
+                sessions[profile_name] = initialize_session(profile_name)
+            session = sessions[profile_name]
+            for month_year in (previous_month, current_month):
+                # Only months the collector already worked on are finalised
+                state_path = os.path.join(reports_folder(month_year, output_dir=collect_options.get('output_dir', '')), f'{profile_name}-{month_year}', STATE_FILE)
+                if month_year == previous_month and not os.path.exists(state_path):
+                    continue
+                try:
+                    collect_month(profile_name, session, month_year, now, interval, clients=clients, **collect_options)
+                except botocore.exceptions.UnauthorizedSSOTokenError:
+                    print(f"AWS SSO session for {profile_name} has expired; run 'aws sso login --profile {profile_name}'. Retrying next round.")
+                    del sessions[profile_name]
+                    clients.discard(profile_name)
+                    break
+                except Exception as e:
+                    print(f"An unexpected error occurred collecting {profile_name} for {month_year}: {e}")
+        if once:
+            return
+        time.sleep(min(interval, POLL_INTERVAL))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Collect the report data in the background during the month.')
+    parser.add_argument('--profiles', help='Comma separated SSO profile names')
+    parser.add_argument('--profiles-file', help='File with one SSO profile name per line')
+    parser.add_argument('--interval', type=int, default=DEFAULT_INTERVAL, help=f'Seconds between two collections of a month (default: {DEFAULT_INTERVAL})')
+    parser.add_argument('--output-dir', default='', help='Folder the report folders are created in (must match the report, default: the working directory)')
+    parser.add_argument('--once', action='store_true', help='Collect once and exit, e.g. when run by a scheduler')
+    parser.add_argument('--workers', type=int, default=1, help='Number of instance batches collected concurrently per profile (default: 1)')
+    parser.add_argument('--utilization-period', type=int, default=DEFAULT_PERIODS['utilization'], help='Period in seconds of the CPU, memory, disk and RDS series (must match the report)')
+    parser.add_argument('--network-period', type=int, default=DEFAULT_PERIODS['network'], help='Period in seconds of the network series (must match the report)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB, help=f'Cache size limit in MB (default: {DEFAULT_CACHE_SIZE_MB})')
+    args = parser.parse_args()
+
+    profile_names = []
+    if args.profiles:
+        profile_names.extend(parse_profile_names(args.profiles))
+    if args.profiles_file:
+        profile_names.extend(read_profile_names(args.profiles_file))
+    if not profile_names:
+        parser.error('pass --profiles or --profiles-file')
+    run_collector(
+        profile_names, args.interval, args.once,
+        workers=max(args.workers, 1),
+        cache_size_mb=args.cache_size,
+        output_dir=args.output_dir,
+        periods={'utilization': args.utilization_period, 'network': args.network_period}
+    )
@@ -0,0 +1,173 @@
+import glob
+import importlib.util
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+# pyarrow is optional: without it the dataset is written as JSON Lines instead of Parquet. It is only imported
+# when a Parquet part file is written, so runs without --export never load it
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+# Rows buffered per table before a part file is written
+EXPORT_BATCH_ROWS = 250000
+
+# Columns of the datapoints table
+DATAPOINT_COLUMNS = ['region', 'resource_type', 'resource_id', 'metric', 'volume', 'statistic', 'timestamp', 'value']
+
+
+# Function to pick the export format: Parquet when pyarrow is installed, JSON Lines otherwise
+def default_export_format():
+    return 'parquet' if HAS_PYARROW else 'jsonl'
+
+
+# Function to get the folder of one account and month of the dataset (Hive-style partitions)
+def partition_folder(root, account, month):
+    return os.path.join(root, f'account={account}', f'month={month}')
+
+
+# Writer of the raw datapoints and patch/compliance rows of one account and month to a partitioned dataset:
+#   <root>/account=<account>/month=<YYYY-MM>/<table>/part-00000.parquet (or .jsonl)
+# Rows are buffered per table and written in part files of EXPORT_BATCH_ROWS, so large fleets are never
+# held in memory. A rerun of the same account and month replaces its partition, unless it resumes an
+# interrupted run (resume=True), whose part files are kept and added to.
+# Rows may be added from several threads (e.g. one per region).
+class DatasetExporter:
+    def __init__(self, root, account, month, export_format=None, resume=False):
+        self.export_format = export_format or default_export_format()
+        if self.export_format == 'parquet' and not HAS_PYARROW:
+            raise ValueError("Parquet export needs pyarrow; install it or use the jsonl format.")
+        self.folder = partition_folder(root, account, month)
+        self.parts = {}
+        if resume:
+            for table_folder in glob.glob(os.path.join(self.folder, '*')):
+                self.parts[os.path.basename(table_folder)] = len(glob.glob(os.path.join(table_folder, 'part-*')))
+        else:
+            shutil.rmtree(self.folder, ignore_errors=True)
+        self.buffers = {}
+        self.buffered_rows = {}
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    # Function to add every series of a SeriesStore, or only those of resource_id; keys are
+    # ((resource_id, metric, ...), statistic). Summaries of a whole window, keyed
+    # (((resource_id, metric), 'summary'), statistic), are not raw datapoints and are left out.
+    # Only the datapoints of the selected series are copied, so exporting a store one resource at a time
+    # costs the same as exporting it at once. region tells apart resources with the same ID in several regions
+    def add_series_store(self, resource_type, series_store, resource_id=None, region=''):
+        counts = np.diff(series_store.offsets)
+        positions = [
+            position for position, key in enumerate(series_store.keys)
+            if counts[position] and not isinstance(key[0][0], tuple) and (resource_id is None or key[0][0] == resource_id)
+        ]
+        if not positions:
+            return
+        keys = [series_store.keys[position] for position in positions]
+        lengths = counts[positions]
+        rows = np.concatenate([np.arange(series_store.offsets[position], series_store.offsets[position + 1]) for position in positions])
+        self._add_datapoints({
+            'region': np.full(len(rows), region, dtype=object),
+            'resource_type': np.full(len(rows), resource_type, dtype=object),
+            'resource_id': np.repeat(np.array([key[0][0] for key in keys], dtype=object), lengths),
+            'metric': np.repeat(np.array([key[0][1] for key in keys], dtype=object), lengths),
+            'volume': np.repeat(np.array([key[0][3] if len(key[0]) > 3 else '' for key in keys], dtype=object), lengths),
+            'statistic': np.repeat(np.array([key[1] for key in keys], dtype=object), lengths),
+            'timestamp': series_store.timestamps[rows],
+            'value': series_store.values[rows]
+        })
+
+    # Function to add one series given as (timestamps in epoch seconds, values) arrays
+    def add_series(self, resource_type, resource_id, metric, statistic, series, volume='', region=''):
+        timestamps, values = series
+        if not len(values):
+            return
+        self._add_datapoints({
+            'region': np.full(len(values), region, dtype=object),
+            'resource_type': np.full(len(values), resource_type, dtype=object),
+            'resource_id': np.full(len(values), resource_id, dtype=object),
+            'metric': np.full(len(values), metric, dtype=object),
+            'volume': np.full(len(values), volume, dtype=object),
+            'statistic': np.full(len(values), statistic, dtype=object),
+            'timestamp': np.asarray(timestamps, dtype=np.int64),
+            'value': np.asarray(values, dtype=np.float64)
+        })
+
+    # Function to add report rows (dicts), e.g. the patch and compliance rows
+    def add_rows(self, table, rows):
+        if rows:
+            self._buffer(table, list(rows), len(rows))
+
+    def _add_datapoints(self, columns):
+        self._buffer('datapoints', columns, len(columns['value']))
+
+    def _buffer(self, table, chunk, row_count):
+        with self.lock:
+            self.buffers.setdefault(table, []).append(chunk)
+            self.buffered_rows[table] = self.buffered_rows.get(table, 0) + row_count
+            if self.buffered_rows[table] >= EXPORT_BATCH_ROWS:
+                self._flush(table)
+
+    # Function to write the buffered rows of a table to its next part file
+    def _flush(self, table):
+        chunks = self.buffers.pop(table, [])
+        row_count = self.buffered_rows.pop(table, 0)
+        if not row_count:
+            return
+        table_folder = os.path.join(self.folder, table)
+        os.makedirs(table_folder, exist_ok=True)
+        part = self.parts.get(table, 0)
+        self.parts[table] = part + 1
+        self.rows[table] = self.rows.get(table, 0) + row_count
+        part_file = os.path.join(table_folder, f'part-{part:05d}.{self.export_format}')
+        if self.export_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+        if table == 'datapoints':
+            columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in DATAPOINT_COLUMNS}
+            columns['timestamp'] = columns['timestamp'].astype('datetime64[s]')
+            if self.export_format == 'parquet':
+                pq.write_table(pa.table({name: pa.array(column) for name, column in columns.items()}), part_file)
+            else:
+                columns['timestamp'] = np.datetime_as_string(columns['timestamp'])
+                with open(part_file, 'w') as part_output:
+                    for row in zip(*(columns[name].tolist() for name in DATAPOINT_COLUMNS)):
+                        part_output.write(json.dumps(dict(zip(DATAPOINT_COLUMNS, row))) + '\n')
+        else:
+            rows = [row for chunk in chunks for row in chunk]
+            if self.export_format == 'parquet':
+                pq.write_table(pa.Table.from_pylist(rows), part_file)
+            else:
+                with open(part_file, 'w') as part_output:
+                    for row in rows:
+                        part_output.write(json.dumps(row, default=str) + '\n')
+
+    # Function to write every remaining buffer; returns the number of rows exported per table
+    def close(self):
+        with self.lock:
+            for table in list(self.buffers):
+                self._flush(table)
+            return dict(self.rows)
+
+
+# Function to load one table of the dataset into a pandas DataFrame, optionally for one account and/or month
+# pandas is only imported here, as the report itself never needs it
+def read_dataset(root, table, account='*', month='*'):
+    import pandas as pd
+
+    frames = []
+    for table_folder in sorted(glob.glob(os.path.join(partition_folder(root, account, month), table))):
+        partition = dict(
+            part.split('=', 1) for part in os.path.relpath(os.path.dirname(table_folder), root).split(os.sep)
+        )
+        for part_file in sorted(glob.glob(os.path.join(table_folder, 'part-*'))):
+            if part_file.endswith('.parquet'):
+                frame = pd.read_parquet(part_file)
+            else:
+                frame = pd.read_json(part_file, lines=True)
+            frames.append(frame.assign(**partition))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
@@ -1,25 +1,207 @@
 import boto3
 import botocore
+import os
 import subprocess
+import threading
+import time
+from botocore.config import Config
+from botocore.tokens import SSOTokenProvider
+from botocore.utils import JSONFileCache, SSOTokenLoader, parse_timestamp
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+# Maximum number of concurrent calls each AWS service gets, whatever the worker count
+SERVICE_CONCURRENCY = {'cloudwatch': 8, 'ssm': 4, 'ec2': 4, 'rds': 4}
+
+_service_slots = {}
+_service_slots_lock = threading.Lock()
+
+# Function to get the semaphore that caps concurrent calls to one AWS service
+# API rate limits are per region, so each region gets its own slots
+def service_slot(service_name, region_name=None):
+    key = (service_name, region_name)
+    with _service_slots_lock:
+        if key not in _service_slots:
+            _service_slots[key] = threading.BoundedSemaphore(SERVICE_CONCURRENCY.get(service_name, 4))
+        return _service_slots[key]
+
+# Function to create a client with adaptive retries (client-side backoff on throttling) and a pool sized for the workers
+# region_name defaults to the region of the session's profile
+def create_client(session, service_name, max_pool_connections=10, region_name=None):
+    config = Config(
+        retries={'mode': 'adaptive', 'max_attempts': 10},
+        max_pool_connections=max_pool_connections
+    )
+    return session.client(service_name, region_name=region_name, config=config)
+
+# Seconds before the SSO token of a profile expires at which the SSO login is renewed
+SSO_REFRESH_MARGIN = 900
+
+# Seconds between two checks of the SSO token of a profile
+SSO_CHECK_INTERVAL = 300
+
+# Folder of the SSO token cache the AWS CLI writes on aws sso login
+SSO_TOKEN_CACHE = os.path.expanduser(os.path.join('~', '.aws', 'sso', 'cache'))
+
+
+# Clients shared by the runs of a process: one client per (profile, region, service) with adaptive retries, and a
+# connection pool sized to the calls that can be in flight at once (the service's SERVICE_CONCURRENCY slots, capped
+# by the workers, plus the thread streaming the inventory), so workers reuse connections instead of opening new
+# ones. The SSO token of each profile is checked while it is used and renewed before it expires.
+class ClientManager:
+    def __init__(self, workers=1, refresh_margin=SSO_REFRESH_MARGIN):
+        self.workers = workers
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self.clients = {}
+        self.account_names = {}
+        self.last_checks = {}
+        self.lock = threading.Lock()
+
+    # Function to get the connection pool size of a service's clients
+    def pool_size(self, service_name):
+        return min(self.workers, SERVICE_CONCURRENCY.get(service_name, 4)) + 1
+
+    # Function to get the shared client of a service in a region (the session's region when None)
+    def client(self, session, service_name, region_name=None):
+        key = (session.profile_name, region_name or session.region_name, service_name)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = create_client(session, service_name, self.pool_size(service_name), region_name)
+            return self.clients[key]
+
+    # Function to get the account name of a profile, looked up once
+    def account_name(self, session):
+        if session.profile_name not in self.account_names:
+            self.account_names[session.profile_name] = get_aws_account_name(session, self)
+        return self.account_names[session.profile_name]
+
+    # Function to drop the clients of a profile, e.g. after its credentials were replaced
+    def discard(self, profile_name):
+        with self.lock:
+            self.clients = {key: client for key, client in self.clients.items() if key[0] != profile_name}
+            self.account_names.pop(profile_name, None)
+
+    # Function to renew the SSO login of a session's profile when its token expires within the refresh margin,
+    # checked at most every SSO_CHECK_INTERVAL seconds unless force is set. Returns True when it logged in
+    def refresh_credentials(self, session, force=False):
+        profile_name = session.profile_name
+        now = time.monotonic()
+        if not force and now - self.last_checks.get(profile_name, now - SSO_CHECK_INTERVAL) < SSO_CHECK_INTERVAL:
+            return False
+        self.last_checks[profile_name] = now
+        expiry = sso_token_expiry(session)
+        if expiry is None or expiry - datetime.now(timezone.utc) > self.refresh_margin:
+            return False
+        print(f"AWS SSO session for {profile_name} expires at {expiry:%Y-%m-%d %H:%M} UTC. Logging in again...")
+        login_to_sso(profile_name)
+        return True
+
+# Function to get when the SSO token of a session's profile expires, or None when the profile does not use SSO
+# Profiles with an sso-session refresh their token themselves while its refresh token lasts; a token that can
+# no longer be loaded or refreshed counts as expired
+def sso_token_expiry(session):
+    try:
+        config = session._session.get_scoped_config()
+    except botocore.exceptions.ProfileNotFound:
+        return None
+    session_name = config.get('sso_session')
+    try:
+        if session_name:
+            token = SSOTokenProvider(session._session).load_token()
+            return token.get_frozen_token().expiration if token else None
+        if not config.get('sso_start_url'):
+            return None
+        token = SSOTokenLoader(cache=JSONFileCache(SSO_TOKEN_CACHE))(config['sso_start_url'])
+        return parse_timestamp(token['expiresAt'])
+    except botocore.exceptions.BotoCoreError:
+        return datetime.now(timezone.utc)
+
+# Function to list the regions enabled for the account (opted-in and default regions)
+def list_enabled_regions(session, clients=None):
+    ec2 = clients.client(session, 'ec2') if clients is not None else create_client(session, 'ec2')
+    return sorted(region['RegionName'] for region in ec2.describe_regions()['Regions'])
+
+# Function to split any iterable into lists of at most size items, consuming it lazily
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Function to stream the items of a paginated AWS API, one page at a time
+def paginate(client, operation_name, result_key, **kwargs):
+    paginator = client.get_paginator(operation_name)
+    for page in paginator.paginate(**kwargs):
+        for item in page.get(result_key, []):
+            yield item
+
+# Function to stream EC2 instances across every describe_instances page
+def iter_instances(ec2, filters=None):
+    for reservation in paginate(ec2, 'describe_instances', 'Reservations', Filters=filters or []):
+        for instance in reservation.get('Instances', []):
+            yield instance
+
+# Function to stream RDS instances across every describe_db_instances page
+def iter_db_instances(rds):
+    return paginate(rds, 'describe_db_instances', 'DBInstances')
+
+# Function to stream RDS (Aurora and Multi-AZ) DB clusters across every describe_db_clusters page
+def iter_db_clusters(rds):
+    return paginate(rds, 'describe_db_clusters', 'DBClusters')
+
+# Maximum number of instance IDs describe_instance_patch_states accepts per call
+PATCH_STATES_BATCH_SIZE = 50
+
+# Patch states that have an InstalledTime; the others (Missing, NotApplicable, Failed) never match a report window
+INSTALLED_PATCH_STATES = ['Installed', 'InstalledOther', 'InstalledPendingReboot', 'InstalledRejected']
+
+# Function to stream the installed patches of an instance across every describe_instance_patches page
+# The State filter is applied by SSM, so the (often thousands of) NotApplicable patches are never listed
+def iter_instance_patches(ssm_client, instance_id):
+    return paginate(
+        ssm_client, 'describe_instance_patches', 'Patches',
+        InstanceId=instance_id, Filters=[{'Key': 'State', 'Values': INSTALLED_PATCH_STATES}]
+    )
+
+# Function to stream the patch states of instances, PATCH_STATES_BATCH_SIZE instances per describe_instance_patch_states call
+def iter_instance_patch_states(ssm_client, instance_ids):
+    for batch in chunked(instance_ids, PATCH_STATES_BATCH_SIZE):
+        for patch_state in paginate(ssm_client, 'describe_instance_patch_states', 'InstancePatchStates', InstanceIds=batch):
+            yield patch_state
+
+# Function to add one describe_instances entry to the in-memory EC2 inventory
+def add_instance_to_inventory(inventory, instance):
+    inventory[instance['InstanceId']] = {
+        'Name': next((tag['Value'] for tag in instance.get('Tags', []) if tag['Key'] == 'Name'), 'N/A'),
+        'State': instance.get('State', {}).get('Name', 'N/A'),
+        'PlatformDetails': instance.get('PlatformDetails', 'Linux/UNIX'),  # Default to Linux/UNIX if not Windows
+        'BlockDeviceMappings': instance.get('BlockDeviceMappings', []),
+        'ImageId': instance.get('ImageId'),
+        'InstanceType': instance.get('InstanceType')
+    }
+    return inventory[instance['InstanceId']]
 
 # Function to list EC2s
-def get_instance_name(instance_id, ec2):
-    response = ec2.describe_tags(Filters=[{'Name': 'resource-id', 'Values': [instance_id]}])
-    for tag in response.get('Tags', []):
-        if tag['Key'] == 'Name':
-            return tag['Value']
-    return 'N/A'
+def get_instance_name(instance_id, inventory):
+    return inventory.get(instance_id, {}).get('Name', 'N/A')
 
 # Function to list EC2s state
-def get_instance_state(instance_id, ec2):
-    response = ec2.describe_instances(InstanceIds=[instance_id])
-    reservations = response.get('Reservations', [])
-    if reservations:
-        instances = reservations[0].get('Instances', [])
-        if instances:
-            state = instances[0].get('State', {}).get('Name', 'N/A')
-            return state
-    return 'N/A'
+def get_instance_state(instance_id, inventory):
+    return inventory.get(instance_id, {}).get('State', 'N/A')
+
+# Function to split a comma or space separated list of SSO profile names
+def parse_profile_names(text):
+    return [name for name in text.replace(',', ' ').split() if name]
+
+# Function to read SSO profile names from a file, one per line (blank lines and # comments ignored)
+def read_profile_names(path):
+    profile_names = []
+    with open(path) as profiles_file:
+        for line in profiles_file:
+            profile_names.extend(parse_profile_names(line.split('#', 1)[0]))
+    return profile_names
 
 # Function to handle AWS SSO login
 def login_to_sso(profile_name):
@@ -33,15 +215,15 @@ def login_to_sso(profile_name):
 def initialize_session(profile_name):
     return boto3.Session(profile_name=profile_name)
 
-# Function to get the logged-in AWS account name (or alias)
-def get_aws_account_name(session):
-    sts = session.client('sts')
+# Function to get the logged-in AWS account name (or alias), with the shared clients when a ClientManager is given
+def get_aws_account_name(session, clients=None):
+    sts = clients.client(session, 'sts') if clients is not None else session.client('sts')
     identity = sts.get_caller_identity()
     account_id = identity['Account']
 
     # Try to get the account alias if available (requires iam:ListAccountAliases permission)
     try:
-        iam = session.client('iam')
+        iam = clients.client(session, 'iam') if clients is not None else session.client('iam')
         account_aliases = iam.list_account_aliases()['AccountAliases']
         if account_aliases:
             return account_aliases[0]  # Use the first alias if available
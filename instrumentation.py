@@ -0,0 +1,171 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds (ms) of the API latency histogram buckets; slower calls land in the last, open bucket
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Error codes AWS services use for throttling
+THROTTLE_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown', 'PriorRequestNotComplete'
+}
+
+# Seconds between two updates of the live progress line
+PROGRESS_INTERVAL = 0.5
+
+
+# Function to time a pipeline phase when instrumentation is enabled, and do nothing otherwise
+def phase(instrumentation, name):
+    if instrumentation is None:
+        return nullcontext()
+    return instrumentation.phase(name)
+
+
+# Counters and timers of one report run: API calls, retries, throttles, errors and latency per service and
+# operation (from botocore events on the clients it is attached to) and the time spent in each pipeline phase
+class RunInstrumentation:
+    def __init__(self, progress=False):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.phases = {}
+        self.progress_enabled = progress
+        self.last_progress = 0.0
+        self.clients = []
+
+    # Function to register the event handlers on a client
+    def attach(self, client):
+        client.meta.events.register_first('before-call', self._before_call)
+        client.meta.events.register('after-call', self._after_call)
+        client.meta.events.register('after-call-error', self._after_call_error)
+        client.meta.events.register('needs-retry', self._needs_retry)
+        self.clients.append(client)
+        return client
+
+    # Function to unregister the event handlers from every attached client, so shared clients outlive the run
+    def detach(self):
+        for client in self.clients:
+            client.meta.events.unregister('before-call', self._before_call)
+            client.meta.events.unregister('after-call', self._after_call)
+            client.meta.events.unregister('after-call-error', self._after_call_error)
+            client.meta.events.unregister('needs-retry', self._needs_retry)
+        self.clients = []
+
+    # Function to get the counters of a (service name, operation name)
+    def _operation(self, key):
+        if key not in self.operations:
+            self.operations[key] = {
+                'calls': 0, 'retries': 0, 'throttles': 0, 'errors': 0, 'latency_total_ms': 0.0, 'latency_max_ms': 0.0,
+                'latency_histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)
+            }
+        return self.operations[key]
+
+    # The operation is kept in the request context, as after-call-error only passes the exception and context
+    def _before_call(self, model, context, **kwargs):
+        context['instrumentation_operation'] = (model.service_model.service_name, model.name)
+        context['instrumentation_started'] = time.perf_counter()
+
+    def _record_call(self, context, retries=0, error=False):
+        latency_ms = (time.perf_counter() - context.get('instrumentation_started', time.perf_counter())) * 1000
+        bucket = next((index for index, bound in enumerate(LATENCY_BUCKETS_MS) if latency_ms <= bound), len(LATENCY_BUCKETS_MS))
+        with self.lock:
+            operation = self._operation(context.get('instrumentation_operation', ('unknown', 'unknown')))
+            operation['calls'] += 1
+            operation['retries'] += retries
+            operation['errors'] += error
+            operation['latency_total_ms'] += latency_ms
+            operation['latency_max_ms'] = max(operation['latency_max_ms'], latency_ms)
+            operation['latency_histogram'][bucket] += 1
+
+    # Error responses (ClientError) also come back through after-call, with an HTTP error status
+    def _after_call(self, context, http_response=None, parsed=None, **kwargs):
+        retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        error = http_response is not None and http_response.status_code >= 400
+        self._record_call(context, retries, error)
+
+    # Connection-level failures (endpoint errors, expired SSO tokens while signing) come through after-call-error
+    def _after_call_error(self, context, **kwargs):
+        self._record_call(context, error=True)
+
+    # needs-retry fires after every attempt, so every throttled attempt is counted (retries come from the
+    # RetryAttempts of the final response)
+    def _needs_retry(self, response, operation, **kwargs):
+        if response is None or response[1].get('Error', {}).get('Code') not in THROTTLE_CODES:
+            return None
+        with self.lock:
+            self._operation((operation.service_model.service_name, operation.name))['throttles'] += 1
+        return None
+
+    # Function to time a pipeline phase; phases running on several threads add up their time
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase_time(name, time.perf_counter() - started)
+
+    # Function to add time measured elsewhere (e.g. by the chart worker processes) to a phase
+    def add_phase_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    # Function to time every step of an iterator (e.g. the pages of describe_instances) as a phase
+    def timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    # Function to update the live progress line, at most every PROGRESS_INTERVAL seconds unless final
+    def progress(self, instances, final=False):
+        if not self.progress_enabled:
+            return
+        now = time.perf_counter()
+        if not final and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        with self.lock:
+            calls = sum(operation['calls'] for operation in self.operations.values())
+            throttles = sum(operation['throttles'] for operation in self.operations.values())
+        sys.stderr.write(f"\r{instances} instances, {calls} API calls, {throttles} throttled, {now - self.started:.0f}s elapsed")
+        if final:
+            sys.stderr.write('\n')
+        sys.stderr.flush()
+
+    # Function to build the JSON-serialisable run summary
+    def summary(self, **details):
+        with self.lock:
+            api = {}
+            for (service_name, operation_name), operation in sorted(self.operations.items()):
+                histogram = {f'<={bound}ms': count for bound, count in zip(LATENCY_BUCKETS_MS, operation['latency_histogram'])}
+                histogram[f'>{LATENCY_BUCKETS_MS[-1]}ms'] = operation['latency_histogram'][-1]
+                api.setdefault(service_name, {})[operation_name] = {
+                    'calls': operation['calls'],
+                    'retries': operation['retries'],
+                    'throttles': operation['throttles'],
+                    'errors': operation['errors'],
+                    'latency_mean_ms': round(operation['latency_total_ms'] / operation['calls'], 2) if operation['calls'] else None,
+                    'latency_max_ms': round(operation['latency_max_ms'], 2),
+                    'latency_histogram': histogram
+                }
+            summary = dict(details)
+            summary['wall_seconds'] = round(time.perf_counter() - self.started, 2)
+            summary['phase_seconds'] = {name: round(seconds, 2) for name, seconds in self.phases.items()}
+            summary['api_calls'] = sum(operation['calls'] for operation in self.operations.values())
+            summary['api'] = api
+        return summary
+
+    # Function to write the run summary to a JSON file
+    def write_summary(self, path, **details):
+        summary = self.summary(**details)
+        with open(path, 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2, default=str)
+        return summary
@@ -0,0 +1,110 @@
+import json
+import os
+
+import numpy as np
+
+from collected_data import patch_row_from_json
+
+
+# Function to make report rows and chart descriptions JSON-serialisable (arrays as lists, datetimes as text)
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+# Function to turn a journaled chart description back into the one charts.py draws
+def _chart_from_json(chart):
+    if chart is None:
+        return None
+    if 'timestamps' in chart:
+        chart['timestamps'] = np.asarray(chart['timestamps'], dtype=np.int64)
+        chart['values'] = np.asarray(chart['values'], dtype=np.float64)
+    if 'series' in chart:
+        chart['series'] = [(label, color, np.array(values, dtype=float)) for label, color, values in chart['series']]
+    chart['figsize'] = tuple(chart['figsize'])
+    return chart
+
+
+# Function to turn a journaled item back into the rows and chart descriptions it was recorded from
+def _item_from_json(item):
+    item['charts'] = [_chart_from_json(chart) for chart in item['charts']]
+    if 'patches' in item:
+        item['patches'] = [patch_row_from_json(patch) for patch in item['patches']]
+    return item
+
+
+# Checkpoint journal of a report run, kept as JSON Lines in the output folder: a header identifying the run, then
+# one line per finished instance or database with its rows and chart descriptions. A run that stops part way
+# (expired SSO token, crash) leaves its journal behind; the next run with the same parameters replays the
+# journaled items and only collects the rest. The journal is removed once the report is complete.
+class ReportJournal:
+    def __init__(self, path, run, resume=True):
+        self.path = path
+        self.run = json.loads(json.dumps(run, default=_to_json))
+        self.finished = {}
+        self.resumed = 0
+
+        valid_size = self._read() if resume else None
+        if valid_size is None:
+            self.finished = {}
+            self.resumed = 0
+            with open(path, 'w') as journal_file:
+                journal_file.write(json.dumps({'run': self.run}) + '\n')
+        else:
+            # Drop a last line cut short by a crash, so new lines start on a line of their own
+            with open(path, 'r+b') as journal_file:
+                journal_file.truncate(valid_size)
+        self.journal_file = open(path, 'a')
+
+    # Function to read the items of a journal left by the same run; returns the size of its complete lines,
+    # or None when there is no such journal
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as journal_file:
+            header = journal_file.readline()
+            try:
+                if not header.endswith(b'\n') or json.loads(header) != {'run': self.run}:
+                    return None
+            except ValueError:
+                return None
+            valid_size = len(header)
+            for line in journal_file:
+                try:
+                    entry = json.loads(line) if line.endswith(b'\n') else None
+                except ValueError:
+                    entry = None
+                if entry is None:
+                    break
+                self.finished.setdefault(entry['region'], set()).add((entry['kind'], entry['id']))
+                self.resumed += 1
+                valid_size += len(line)
+        return valid_size
+
+    # Function to get the (kind, id) of the items already finished in a region
+    def finished_in(self, region_name):
+        return self.finished.get(region_name, set())
+
+    # Function to stream the items journaled by the previous run as (region, kind, item)
+    def replay(self):
+        with open(self.path) as journal_file:
+            journal_file.readline()
+            for _ in range(self.resumed):
+                entry = json.loads(journal_file.readline())
+                yield entry['region'], entry['kind'], _item_from_json(entry['item'])
+
+    # Function to record a finished item; it is on disk before the next one is reported
+    def record(self, region_name, kind, item_id, item):
+        self.journal_file.write(json.dumps({'region': region_name, 'kind': kind, 'id': item_id, 'item': item}, default=_to_json) + '\n')
+        self.journal_file.flush()
+
+    def close(self):
+        self.journal_file.close()
+
+    # Function to remove the journal once the report is complete
+    def complete(self):
+        self.close()
+        os.remove(self.path)
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+# Default size limit of the on-disk CloudWatch cache
+DEFAULT_CACHE_SIZE_MB = 512
+
+# Time windows that ended at least this long ago are treated as immutable (late datapoints have landed)
+SETTLE_TIME = timedelta(hours=3)
+
+
+# Function to turn a datetime into a naive UTC datetime (boto3 treats naive datetimes as UTC)
+def to_utc_naive(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+# Persistent SQLite cache of CloudWatch datapoints, keyed by query and time window
+class MetricCache:
+    def __init__(self, path, max_size_mb=DEFAULT_CACHE_SIZE_MB, refresh=False, incremental=False):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self.refresh = refresh  # Refresh mode skips reads but still stores what it fetches
+        self.incremental = incremental  # Incremental mode keeps growing series and only fetches what is new
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS datapoints ('
+            'key TEXT PRIMARY KEY, datapoints TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)'
+        )
+        self.connection.commit()
+
+    # Function to build the cache key of a metric request over a time window
+    def key(self, request, start_time, end_time):
+        identity = {
+            'Namespace': request['Namespace'],
+            'MetricName': request['MetricName'],
+            'Dimensions': sorted((dimension['Name'], dimension['Value']) for dimension in request['Dimensions']),
+            'Period': request['Period'],
+            'Statistics': sorted(request['Statistics']),
+            'Unit': request['Unit'],
+            'StartTime': to_utc_naive(start_time).isoformat(),
+            'EndTime': to_utc_naive(end_time).isoformat(),
+            'Format': 'columns'
+        }
+        return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+    # Function to build the key of a growing series: the query and the start of its window, but not the end
+    def series_key(self, request, start_time):
+        return 'series:' + self.key(request, start_time, start_time)
+
+    # Function to check whether a window is fully in the past, so its datapoints can no longer change
+    def is_immutable(self, end_time):
+        return to_utc_naive(end_time) + SETTLE_TIME <= to_utc_naive(datetime.now(timezone.utc))
+
+    # Function to read the cached columns of a window, or None when the window has not been cached
+    def get(self, key):
+        if self.refresh:
+            return None
+        with self.lock:
+            row = self.connection.execute('SELECT datapoints FROM datapoints WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute('UPDATE datapoints SET accessed = ? WHERE key = ?', (time.time(), key))
+        columns = json.loads(row[0])
+        return {
+            name: np.array(column, dtype=np.int64 if name == 'Timestamp' else np.float64)
+            for name, column in columns.items()
+        }
+
+    # Function to store the columns of several windows in one transaction
+    def put_many(self, columns_by_key):
+        rows = []
+        for key, columns in columns_by_key.items():
+            payload = json.dumps({name: column.tolist() for name, column in columns.items()})
+            rows.append((key, payload, len(payload), time.time()))
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO datapoints (key, datapoints, size, accessed) VALUES (?, ?, ?, ?)', rows
+            )
+            self.connection.commit()
+
+    # Function to drop the least recently used windows once the cache is over its size limit
+    def evict(self):
+        with self.lock:
+            total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM datapoints').fetchone()[0]
+            if total_size > self.max_bytes:
+                for key, size in self.connection.execute('SELECT key, size FROM datapoints ORDER BY accessed').fetchall():
+                    if total_size <= self.max_bytes:
+                        break
+                    self.connection.execute('DELETE FROM datapoints WHERE key = ?', (key,))
+                    total_size -= size
+            self.connection.commit()
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.connection.close()
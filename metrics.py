@@ -0,0 +1,226 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from functions import chunked
+from metric_cache import SETTLE_TIME, to_utc_naive
+
+# GetMetricData accepts at most 500 metric queries per request
+MAX_QUERIES_PER_REQUEST = 500
+
+# Longer time windows are split so no query asks for more datapoints than this in one window
+MAX_DATAPOINTS_PER_WINDOW = 1440
+
+# Periods CloudWatch keeps datapoints for: (age of the data, smallest period still available at that age)
+RETENTION_PERIODS = [(timedelta(hours=3), 1), (timedelta(days=15), 60), (timedelta(days=63), 300)]
+RETENTION_OLDEST_PERIOD = 3600
+
+# Function to raise a period to the smallest one CloudWatch still keeps for data starting at start_time
+def retention_period(period, start_time):
+    age = to_utc_naive(datetime.now(timezone.utc)) - to_utc_naive(start_time)
+    minimum = next((minimum for limit, minimum in RETENTION_PERIODS if age <= limit), RETENTION_OLDEST_PERIOD)
+    return max(period, minimum)
+
+# Function to get the period of a whole-window request: the length of the window rounded up to whole hours,
+# so CloudWatch returns one datapoint covering it and accepts the period for data of any age
+def window_period(start_time, end_time):
+    seconds = (to_utc_naive(end_time) - to_utc_naive(start_time)).total_seconds()
+    return max(int(-(-seconds // 3600)), 1) * 3600
+
+# Function to split a time window into windows of at most max_datapoints periods each
+def split_window(start_time, end_time, period, max_datapoints=MAX_DATAPOINTS_PER_WINDOW):
+    windows = []
+    window_length = timedelta(seconds=period * max_datapoints)
+    window_start, end_time = to_utc_naive(start_time), to_utc_naive(end_time)
+    while window_start < end_time:
+        window_end = min(window_start + window_length, end_time)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+# Function to describe one CloudWatch metric to collect
+# With period=None the statistics are computed over the whole window of each fetch (see summary_request)
+def metric_request(namespace, metric_name, dimensions, statistics=('Average',), unit=None, period=3600):
+    return {
+        'Namespace': namespace,
+        'MetricName': metric_name,
+        'Dimensions': list(dimensions),
+        'Statistics': list(statistics),
+        'Unit': unit,
+        'Period': period
+    }
+
+# Function to describe the summary of a metric: its statistics computed by CloudWatch over the whole window
+# from every datapoint the metric received, such as extended statistics (p50, p95, p99), which cannot be
+# derived from the averages of a series
+def summary_request(request, statistics):
+    return dict(request, Statistics=list(statistics), Period=None)
+
+# Function to build the GetMetricData query for one statistic of a metric request
+def build_metric_query(query_id, request, statistic):
+    metric_stat = {
+        'Metric': {
+            'Namespace': request['Namespace'],
+            'MetricName': request['MetricName'],
+            'Dimensions': request['Dimensions']
+        },
+        'Period': request['Period'],
+        'Stat': statistic
+    }
+    if request['Unit']:
+        metric_stat['Unit'] = request['Unit']
+    return {'Id': query_id, 'MetricStat': metric_stat, 'ReturnData': True}
+
+# Function to run GetMetricData for up to 500 queries, following NextToken
+# Returns the timestamps (epoch seconds) and values of every query as flat lists, in time order
+def run_metric_queries(cloudwatch, queries, start_time, end_time):
+    series = {query['Id']: ([], []) for query in queries}
+    kwargs = {
+        'MetricDataQueries': queries,
+        'StartTime': start_time,
+        'EndTime': end_time,
+        'ScanBy': 'TimestampAscending'
+    }
+    while True:
+        response = cloudwatch.get_metric_data(**kwargs)
+        for result in response.get('MetricDataResults', []):
+            timestamps, values = series.setdefault(result['Id'], ([], []))
+            timestamps.extend(int(timestamp.timestamp()) for timestamp in result.get('Timestamps', []))
+            values.extend(result.get('Values', []))
+        next_token = response.get('NextToken')
+        if not next_token:
+            return series
+        kwargs['NextToken'] = next_token
+
+# Function to line up the series of each statistic of a request on one sorted timestamp column
+# Columns are {'Timestamp': int64 epoch seconds, <statistic>: float64 values}, NaN where a statistic has no value
+def align_columns(series_by_statistic, statistics):
+    timestamps = np.unique(np.concatenate(
+        [np.asarray(series_by_statistic.get(statistic, ([], []))[0], dtype=np.int64) for statistic in statistics]
+    ))
+    columns = {'Timestamp': timestamps}
+    for statistic in statistics:
+        statistic_timestamps, values = series_by_statistic.get(statistic, ([], []))
+        column = np.full(len(timestamps), np.nan)
+        column[np.searchsorted(timestamps, np.asarray(statistic_timestamps, dtype=np.int64))] = values
+        columns[statistic] = column
+    return columns
+
+# Function to turn columns back into datapoints shaped like get_metric_statistics output
+def columns_to_datapoints(columns, unit=None):
+    datapoints = []
+    statistics = [name for name in columns if name != 'Timestamp']
+    for position, timestamp in enumerate(columns['Timestamp'].tolist()):
+        datapoint = {'Timestamp': datetime.fromtimestamp(timestamp, timezone.utc)}
+        for statistic in statistics:
+            value = columns[statistic][position]
+            if not np.isnan(value):
+                datapoint[statistic] = float(value)
+        if unit:
+            datapoint['Unit'] = unit
+        datapoints.append(datapoint)
+    return datapoints
+
+# Function to fetch many metrics with batched GetMetricData calls
+# metric_requests maps any hashable key to a metric_request(); the result maps the same keys to
+# datapoints shaped like get_metric_statistics output: [{'Timestamp': ..., 'Average': ...}, ...]
+def get_metric_data(cloudwatch, metric_requests, start_time, end_time, cache=None):
+    return {
+        key: columns_to_datapoints(columns, metric_requests[key]['Unit'])
+        for key, columns in get_metric_columns(cloudwatch, metric_requests, start_time, end_time, cache).items()
+    }
+
+# Function to fetch many metrics with batched GetMetricData calls, as columns (see align_columns)
+# When a MetricCache is given, windows that are fully in the past are read from and written to it, and in
+# incremental mode every series is extended with only the datapoints that arrived since the last run
+# Summary requests (period None) get one datapoint over the window; they are always fetched in full, as a
+# partial window cannot be extended with a delta
+def get_metric_columns(cloudwatch, metric_requests, start_time, end_time, cache=None):
+    # Older months are only available at coarser periods
+    summary_keys = {key for key, request in metric_requests.items() if request['Period'] is None}
+    metric_requests = {
+        key: dict(request, Period=window_period(start_time, end_time) if key in summary_keys else retention_period(request['Period'], start_time))
+        for key, request in metric_requests.items()
+    }
+    metric_columns = {}
+    cache_keys = {}
+    if cache is not None and cache.is_immutable(end_time):
+        for key, request in metric_requests.items():
+            cache_keys[key] = cache.key(request, start_time, end_time)
+            cached = cache.get(cache_keys[key])
+            if cached is not None:
+                metric_columns[key] = cached
+
+    missing_requests = {key: request for key, request in metric_requests.items() if key not in metric_columns}
+    if missing_requests:
+        if cache is not None and cache.incremental:
+            fetched = fetch_metric_columns(cloudwatch, {
+                key: request for key, request in missing_requests.items() if key in summary_keys
+            }, start_time, end_time)
+            fetched.update(fetch_incremental_metric_columns(cloudwatch, {
+                key: request for key, request in missing_requests.items() if key not in summary_keys
+            }, start_time, end_time, cache))
+        else:
+            fetched = fetch_metric_columns(cloudwatch, missing_requests, start_time, end_time)
+        if cache_keys:
+            cache.put_many({cache_keys[key]: columns for key, columns in fetched.items()})
+        metric_columns.update(fetched)
+    return metric_columns
+
+# Function to extend the stored series of each request with only the datapoints after its last fetch
+# The last SETTLE_TIME of each stored series is fetched again because late datapoints may still land there;
+# delta windows start on a period boundary of the series, so the refetched datapoints line up with the stored ones
+def fetch_incremental_metric_columns(cloudwatch, metric_requests, start_time, end_time, cache):
+    series_keys = {key: cache.series_key(request, start_time) for key, request in metric_requests.items()}
+    stored = {key: cache.get(series_key) for key, series_key in series_keys.items()}
+
+    # Group the requests by the start of their delta window, so each group is one batched fetch
+    delta_groups = {}
+    for key, request in metric_requests.items():
+        delta_start = start_time
+        if stored[key] is not None and len(stored[key]['Timestamp']):
+            first_timestamp, last_timestamp = stored[key]['Timestamp'][[0, -1]].tolist()
+            delta_timestamp = max(last_timestamp - SETTLE_TIME.total_seconds(), first_timestamp)
+            delta_timestamp -= (delta_timestamp - first_timestamp) % request['Period']
+            delta_start = datetime.fromtimestamp(delta_timestamp, timezone.utc)
+        delta_groups.setdefault(delta_start, {})[key] = request
+
+    metric_columns = {}
+    for delta_start, requests in delta_groups.items():
+        for key, columns in fetch_metric_columns(cloudwatch, requests, delta_start, end_time).items():
+            if stored[key] is not None:
+                kept = stored[key]['Timestamp'] < delta_start.timestamp()
+                columns = {
+                    name: np.concatenate([stored[key].get(name, np.full(len(kept), np.nan))[kept], column])
+                    for name, column in columns.items()
+                }
+            metric_columns[key] = columns
+
+    cache.put_many({series_keys[key]: columns for key, columns in metric_columns.items()})
+    return metric_columns
+
+# Function to fetch metric requests from CloudWatch, up to 500 queries per GetMetricData call
+# Windows longer than MAX_DATAPOINTS_PER_WINDOW periods are fetched in consecutive windows and joined
+def fetch_metric_columns(cloudwatch, metric_requests, start_time, end_time):
+    queries_by_period = {}
+    query_targets = {}
+    for key, request in metric_requests.items():
+        for statistic in request['Statistics']:
+            query_id = f'm{len(query_targets)}'
+            queries_by_period.setdefault(request['Period'], []).append(build_metric_query(query_id, request, statistic))
+            query_targets[query_id] = (key, statistic)
+
+    series = {key: {} for key in metric_requests}
+    for period, queries in queries_by_period.items():
+        for window_start, window_end in split_window(start_time, end_time, period):
+            for batch in chunked(queries, MAX_QUERIES_PER_REQUEST):
+                for query_id, (timestamps, values) in run_metric_queries(cloudwatch, batch, window_start, window_end).items():
+                    key, statistic = query_targets[query_id]
+                    query_series = series[key].setdefault(statistic, ([], []))
+                    query_series[0].extend(timestamps)
+                    query_series[1].extend(values)
+
+    return {
+        key: align_columns(series_by_statistic, metric_requests[key]['Statistics'])
+        for key, series_by_statistic in series.items()
+    }
@@ -10,23 +10,76 @@ Last Revised on: 01-10-2024
 """
 
 import botocore
-import pandas as pd
-import matplotlib.pyplot as plt
+import json
 import os
-from datetime import datetime
-import numpy as np
-import openpyxl
-
-from functions import *
+import argparse
+import csv
+import sys
+import time
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+# Only light modules are imported at start-up: matplotlib is loaded by charts.py on the first PNG chart drawn,
+# and pandas by export.read_dataset, so a run without charts starts without either
+from functions import (
+    ClientManager, add_instance_to_inventory, chunked, get_instance_name, get_instance_state, initialize_session,
+    iter_db_clusters, iter_db_instances, iter_instance_patch_states, iter_instance_patches, iter_instances,
+    list_enabled_regions, login_to_sso, paginate, parse_profile_names, read_profile_names, service_slot
+)
+from charts import ChartRenderer, bar_chart, daily_utilization_chart, line_chart, trend_chart
+from workbook import ReportWorkbook
+from export import DatasetExporter
+from instrumentation import RunInstrumentation, phase
+from metrics import MAX_QUERIES_PER_REQUEST, get_metric_columns, get_metric_data, metric_request, retention_period, summary_request
+from timeseries import SeriesStore
+from metric_cache import MetricCache, DEFAULT_CACHE_SIZE_MB
+from collected_data import CollectedData
+from journal import ReportJournal
+
+# Number of instances whose metrics are fetched together before their rows are built
+INSTANCE_BATCH_SIZE = 40
+
+# CloudWatch periods (seconds) of the collected series. Utilization (CPU, memory, disk, RDS) only feeds daily
+# charts, so CloudWatch aggregates it per day; network keeps hourly datapoints. The monthly averages and
+# percentiles are summary statistics CloudWatch computes over the whole month (see SUMMARY_STATISTICS)
+DEFAULT_PERIODS = {'utilization': 86400, 'network': 3600}
+
+# Statistics of the month fetched for CPU, memory and RDS, computed by CloudWatch from every datapoint, and the
+# percentiles among them shown in the report. Network also gets its lowest and highest datapoint
+PERCENTILE_STATISTICS = ['p50', 'p95', 'p99']
+SUMMARY_STATISTICS = ['Average'] + PERCENTILE_STATISTICS
+NETWORK_SUMMARY_STATISTICS = ['Average', 'Minimum', 'Maximum'] + PERCENTILE_STATISTICS
+
+# Series statistic standing in for a summary statistic of metrics collected without a summary (disks)
+SERIES_FALLBACK = {'Average': 'mean', 'Minimum': 'min', 'Maximum': 'max'}
+
+# CWAgent disk metrics published for Linux (used percent) and Windows (free space) volumes
+DISK_METRIC_NAMES = ['disk_used_percent', 'LogicalDisk % Free Space']
+
+# List of possible path values and Device values for the secondary disk of linux
+LINUX_SECONDARY_PATHS = ['/u01','/opt/tyk-gateway']  # Add all potential paths for secondary disk of linux
+LINUX_SECONDARY_DEVICES = ['nvme1n1p1','nvme1n1']
+
+# Drive reported as the secondary disk of Windows when the agent publishes it
+WINDOWS_SECONDARY_DRIVES = ['D:']
+
+# File systems and mount points of the operating system, never reported as the secondary volume
+SYSTEM_FSTYPES = ['tmpfs', 'devtmpfs', 'vfat']
+SYSTEM_PATH_PREFIXES = ['/boot']
+
+# Error codes of describe_instance_patch_states for which a batch is reported without compliance data
+# (no SSM access, instances SSM does not manage)
+SKIPPED_PATCH_STATE_ERROR_CODES = {'AccessDeniedException', 'InvalidInstanceId', 'UnsupportedPlatformType'}
 
 
 # Function to get patches installed on EC2 instances
-def get_monthly_patches(ec2, instance_id, ssm_client, start_time, end_time):
-    # Get the list of installed patches for the specified instance
-    response = ssm_client.describe_instance_patches(InstanceId=instance_id)
-
+def get_monthly_patches(inventory, instance_id, ssm_client, start_time, end_time):
+    # Get the list of installed patches for the specified instance, page by page
     patches = []
-    for patch in response.get('Patches', []):
+    for patch in iter_instance_patches(ssm_client, instance_id):
         installed_time_str = patch.get('InstalledTime', 'N/A')
 
         # Check if installed_time_str is already a datetime object
@@ -39,8 +92,8 @@ def get_monthly_patches(ec2, instance_id, ssm_client, start_time, end_time):
         if start_time <= installed_time <= end_time:
             patch_data = {
                 'Instance ID': instance_id,
-                'Instance Name': get_instance_name(instance_id, ec2),
-                'Instance State': get_instance_state(instance_id, ec2),
+                'Instance Name': get_instance_name(instance_id, inventory),
+                'Instance State': get_instance_state(instance_id, inventory),
                 'Patch Name': patch['Title'],
                 'Severity': patch['Severity'],
                 'Compliance State': patch['State'],
@@ -51,81 +104,53 @@ def get_monthly_patches(ec2, instance_id, ssm_client, start_time, end_time):
             patches.append(patch_data)
     return patches
 
-# Function to get CPU utilization statistics
-def get_cpu_utilization(instance_id, start_time, end_time, cloudwatch):
-    response = cloudwatch.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName='CPUUtilization',
-        Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-        StartTime=start_time,
-        EndTime=end_time,
-        Period=3600,
-        Statistics=['Average'],
-        Unit='Percent'
+# Function to describe the CPU utilization metric of an instance
+def cpu_utilization_request(instance_id, period=3600):
+    return metric_request(
+        'AWS/EC2', 'CPUUtilization', [{'Name': 'InstanceId', 'Value': instance_id}], unit='Percent', period=period
     )
-    return response['Datapoints']
+
+# Function to get CPU utilization statistics
+def get_cpu_utilization(instance_id, start_time, end_time, cloudwatch, cache=None):
+    return get_metric_data(cloudwatch, {'cpu': cpu_utilization_request(instance_id)}, start_time, end_time, cache)['cpu']
+
+# Function to describe a CWAgent memory or disk metric
+def utilization_request(platform, metric_name, dimensions, period=3600):
+    # For Windows platform, do not use the 'Unit' parameter
+    if platform == 'Windows':
+        return metric_request('CWAgent', metric_name, dimensions, period=period)
+    return metric_request('CWAgent', metric_name, dimensions, unit='Percent', period=period)  # Use Unit 'Percent' for non-Windows platforms
 
 # Simplified function to get either memory or disk utilization based on parameters
-def get_utilization(platform, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, metric_name, dimensions):        
+def get_utilization(platform, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, metric_name, dimensions, cache=None):        
     try:
-        # For Windows platform, do not use the 'Unit' parameter
-        if platform == 'Windows' and 'Memory' in metric_name:
-            response = cloudwatch.get_metric_statistics(
-                Namespace='CWAgent',
-                MetricName=metric_name,
-                Dimensions=dimensions,
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=3600,
-                Statistics=['Average']
-            )
-        elif platform == 'Windows' and 'LogicalDisk' in metric_name:
-            response = cloudwatch.get_metric_statistics(
-                Namespace='CWAgent',
-                MetricName=metric_name,
-                Dimensions=dimensions,
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=3600,
-                Statistics=['Average']
-            )
-        else:
-            response = cloudwatch.get_metric_statistics(
-                Namespace='CWAgent',
-                MetricName=metric_name,
-                Dimensions=dimensions,
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=3600,
-                Statistics=['Average'],
-                Unit='Percent'  # Use Unit 'Percent' for non-Windows platforms
-            )
-        
-        if not response['Datapoints']:
+        request = utilization_request(platform, metric_name, dimensions)
+        datapoints = get_metric_data(cloudwatch, {metric_name: request}, start_time, end_time, cache)[metric_name]
+        if not datapoints:
             print(f"No {metric_name} utilization data found for instance {instance_id}.")
-        return response['Datapoints']
+        return datapoints
     except Exception as e:
         print(f"Error retrieving {metric_name} utilization for instance {instance_id}: {e}")
         return []
 
 
 # Function to get EC2 instance platform (Windows or Linux)
-def get_instance_platform(ec2, instance_id):
-    response = ec2.describe_instances(InstanceIds=[instance_id])
-    reservations = response.get('Reservations', [])
-    if reservations:
-        instances = reservations[0].get('Instances', [])
-        if instances:
-            platform = instances[0].get('PlatformDetails', 'Linux/UNIX')  # Default to Linux/UNIX if not Windows
-            # Get the number of attached storage volumes
-            block_device_mappings = instances[0].get('BlockDeviceMappings', [])
-            volume_count = len(block_device_mappings)
-            
-            return platform, volume_count
+def get_instance_platform(inventory, instance_id):
+    instance = inventory.get(instance_id)
+    if instance:
+        platform = instance['PlatformDetails']
+        # Get the number of attached storage volumes
+        volume_count = len(instance['BlockDeviceMappings'])
+        return platform, volume_count
     return 'N/A', 0
 
-# Function to get memory utilization based on platform (Windows or RHEL)
-def get_memory_utilization(instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform):
+# Function to get the display name of an instance, falling back to its ID
+def get_instance_display_name(instance_id, inventory):
+    instance_name = get_instance_name(instance_id, inventory)
+    return instance_id if instance_name == 'N/A' else instance_name
+
+# Function to describe the memory utilization metric based on platform (Windows or RHEL)
+def memory_utilization_request(instance_name, instance_id, image_id, instance_type, platform, period=3600):
     if platform == 'Windows':
         metric_name = 'Memory % Committed Bytes In Use'
         dimensions = [
@@ -143,13 +168,20 @@ def get_memory_utilization(instance_name, instance_id, image_id, instance_type,
         ]
     else:
         print(f"Instance {instance_name} is running on Unsupported platform for memory utilization:{platform}.")
+        return None
+    return utilization_request(platform, metric_name, dimensions, period)
+
+# Function to get memory utilization based on platform (Windows or RHEL)
+def get_memory_utilization(instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform):
+    request = memory_utilization_request(instance_name, instance_id, image_id, instance_type, platform)
+    if request is None:
         return []
 
     # Retrieve memory utilization from CloudWatch based on platform
-    return get_utilization(platform, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, metric_name, dimensions)
+    return get_utilization(platform, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, request['MetricName'], request['Dimensions'])
 
-# Function to get disk utilization\disk fress space based on platform (Windows or RHEL)
-def get_disk_utilization(instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform, device, disk):
+# Function to describe the disk utilization\disk free space metric based on platform (Windows or RHEL)
+def disk_utilization_request(instance_name, instance_id, image_id, instance_type, platform, device, disk):
     if platform == 'Windows':
         metric_name = 'LogicalDisk % Free Space'
         dimensions=[
@@ -171,18 +203,181 @@ def get_disk_utilization(instance_name, instance_id, image_id, instance_type, st
         ]
     else:
         print(f"Instance {instance_name} is running on Unsupported platform for Disk utilization:{platform}.")
+        return None
+    return utilization_request(platform, metric_name, dimensions)
+
+# Function to get disk utilization\disk fress space based on platform (Windows or RHEL)
+def get_disk_utilization(instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform, device, disk):
+    request = disk_utilization_request(instance_name, instance_id, image_id, instance_type, platform, device, disk)
+    if request is None:
         return []
 
     # Retrieve memory utilization from CloudWatch based on platform
-    return get_utilization(platform, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, metric_name, dimensions)
+    return get_utilization(platform, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, request['MetricName'], request['Dimensions'])
 
-# Helper function to retrieve network utilization
-def get_network_utilization(instance_id, start_time, end_time, cloudwatch):
-    metrics = {
-        'NetworkIn': 'Inbound Bandwidth (Mbps)',
-        'NetworkOut': 'Outbound Bandwidth (Mbps)'
+# Function to list the (device, disk) combinations to look for on each volume of an instance
+def disk_candidates(platform, volume_count):
+    if platform == 'Windows':
+        volumes = {
+            'primary': [('N/A', 'C:')],
+            'secondary': [('N/A', 'D:'), ('N/A', 'F:')]
+        }
+    elif platform == 'Red Hat Enterprise Linux':
+        volumes = {
+            'primary': [('nvme0n1p2', '/')],
+            'secondary': [(device, path) for device in LINUX_SECONDARY_DEVICES for path in LINUX_SECONDARY_PATHS]
+        }
+    else:
+        return {}
+
+    if volume_count == 1:
+        del volumes['secondary']
+    elif volume_count != 2:
+        return {}
+    return volumes
+
+# Function to discover the disk metrics the CloudWatch agent publishes, indexed by InstanceId
+# ListMetrics only returns metrics that received data in the last two weeks
+def discover_disk_volumes(cloudwatch):
+    disk_index = {}
+    for metric_name in DISK_METRIC_NAMES:
+        for metric in paginate(cloudwatch, 'list_metrics', 'Metrics', Namespace='CWAgent', MetricName=metric_name):
+            dimensions = {dimension['Name']: dimension['Value'] for dimension in metric['Dimensions']}
+            disk = dimensions.get('path', dimensions.get('instance'))
+            if 'InstanceId' not in dimensions or disk in (None, '_Total'):
+                continue
+            disk_index.setdefault(dimensions['InstanceId'], []).append({
+                'MetricName': metric_name,
+                'Dimensions': metric['Dimensions'],
+                'device': dimensions.get('device', 'N/A'),
+                'disk': disk,
+                'fstype': dimensions.get('fstype', 'N/A')
+            })
+    return disk_index
+
+# Function to check whether a discovered volume is a mount of the operating system (tmpfs, /boot, EFI partition)
+def is_system_volume(volume):
+    return volume['fstype'] in SYSTEM_FSTYPES or any(volume['disk'].startswith(prefix) for prefix in SYSTEM_PATH_PREFIXES)
+
+# File next to the CloudWatch cache holding the disk volumes discovered for a closed window
+DISK_INDEX_FILE = 'disk_index.json'
+
+# Function to get the disk volumes of a report folder's instances (see discover_disk_volumes). Once the window is
+# closed, they are kept in DISK_INDEX_FILE next to the CloudWatch cache, so a rerun read from the cache does not
+# list the metrics of the whole account again; without a cache, or with refresh, they are discovered every time
+def load_disk_index(cloudwatch, output_folder, end_time, cache=None):
+    if cache is None or not cache.is_immutable(end_time):
+        return discover_disk_volumes(cloudwatch)
+    path = os.path.join(output_folder, DISK_INDEX_FILE)
+    if os.path.exists(path) and not cache.refresh:
+        with open(path) as disk_index_file:
+            return json.load(disk_index_file)
+    disk_index = discover_disk_volumes(cloudwatch)
+    os.makedirs(output_folder, exist_ok=True)
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as disk_index_file:
+        json.dump(disk_index, disk_index_file)
+    os.replace(temporary_path, path)
+    return disk_index
+
+# Function to list the disk volumes of an instance by role (primary/secondary/other)
+# Discovered volumes are used as they are, the usual secondary paths and drives ranked first; operating system
+# mounts are listed as 'other', so they get rows and charts but never fill the secondary volume columns.
+# Instances ListMetrics does not know (e.g. for older months) fall back to the usual device/path and drive letter
+# locations, which are fetched in the same batch
+def instance_disk_volumes(instance_name, instance_id, image_id, instance_type, platform, volume_count, disk_index):
+    discovered = disk_index.get(instance_id)
+    if discovered:
+        primary_disk = 'C:' if platform == 'Windows' else '/'
+        secondary_disks = WINDOWS_SECONDARY_DRIVES if platform == 'Windows' else LINUX_SECONDARY_PATHS
+        volumes = {'primary': [], 'secondary': [], 'other': []}
+        seen = set()
+        # Prefer the dimension set of the current instance type when the instance was resized during the window
+        for volume in sorted(discovered, key=lambda v: (
+            {'Name': 'InstanceType', 'Value': instance_type} not in v['Dimensions'],
+            secondary_disks.index(v['disk']) if v['disk'] in secondary_disks else len(secondary_disks),
+            v['disk']
+        )):
+            if (volume['device'], volume['disk']) in seen:
+                continue
+            seen.add((volume['device'], volume['disk']))
+            if volume['disk'] == primary_disk:
+                volumes['primary'].append(volume)
+            elif is_system_volume(volume):
+                volumes['other'].append(volume)
+            else:
+                volumes['secondary'].append(volume)
+        return {role: role_volumes for role, role_volumes in volumes.items() if role_volumes}
+
+    volumes = {}
+    for role, candidates in disk_candidates(platform, volume_count).items():
+        volumes[role] = []
+        for device, disk in candidates:
+            request = disk_utilization_request(instance_name, instance_id, image_id, instance_type, platform, device, disk)
+            volumes[role].append({
+                'MetricName': request['MetricName'],
+                'Dimensions': request['Dimensions'],
+                'device': device,
+                'disk': disk,
+                'fstype': 'xfs' if platform == 'Red Hat Enterprise Linux' else 'N/A'
+            })
+    return volumes
+
+# Function to build the metric data key of a disk volume
+def disk_metric_key(instance_id, volume):
+    return (instance_id, 'disk', volume['device'], volume['disk'])
+
+# Function to build the metric data key of the summary statistics of a metric
+def summary_metric_key(key):
+    return (key, 'summary')
+
+# Function to get a statistic of the whole window from the summary of a metric, None when it has no data
+# stats is SeriesStore.stats; averages, minimums and maximums fall back to the series of metrics without a summary
+def summary_statistic(stats, key, statistic='Average'):
+    value = stats.get((summary_metric_key(key), statistic), {}).get('mean')
+    if value is None and statistic in SERIES_FALLBACK:
+        value = stats.get((key, statistic), {}).get(SERIES_FALLBACK[statistic])
+    return value
+
+# Function to describe every metric collected for one instance
+# periods holds the period of the utilization and network series (see DEFAULT_PERIODS). CPU, memory and network
+# get a summary of the month; their series are only requested with series=True (for charts and the export)
+def instance_metric_requests(instance_name, instance_id, image_id, instance_type, platform, disk_volumes, periods=DEFAULT_PERIODS, series=True):
+    requests = {}
+    utilization_requests = {(instance_id, 'cpu'): cpu_utilization_request(instance_id, periods['utilization'])}
+    memory_request = memory_utilization_request(instance_name, instance_id, image_id, instance_type, platform, periods['utilization'])
+    if memory_request is not None:
+        utilization_requests[(instance_id, 'memory')] = memory_request
+    for key, request in utilization_requests.items():
+        if series:
+            requests[key] = request
+        requests[summary_metric_key(key)] = summary_request(request, SUMMARY_STATISTICS)
+
+    for volumes in disk_volumes.values():
+        for volume in volumes:
+            requests[disk_metric_key(instance_id, volume)] = utilization_request(
+                platform, volume['MetricName'], volume['Dimensions'], periods['utilization']
+            )
+
+    for metric, request in network_utilization_requests(instance_id, periods['network']).items():
+        if series:
+            requests[(instance_id, metric)] = request
+        requests[summary_metric_key((instance_id, metric))] = summary_request(request, NETWORK_SUMMARY_STATISTICS)
+    return requests
+
+# Function to describe the network metrics of an instance
+def network_utilization_requests(instance_id, period=3600):
+    return {
+        metric: metric_request(
+            'AWS/EC2', metric, [{'Name': 'InstanceId', 'Value': instance_id}],
+            statistics=['Average', 'Minimum', 'Maximum'], unit='Bytes', period=period
+        )
+        for metric in ('NetworkIn', 'NetworkOut')
     }
 
+# Function to summarise the network series of an instance into Mbps statistics
+# stats is SeriesStore.stats, keyed by ((instance_id, metric), statistic)
+def summarise_network_utilization(instance_id, stats):
     network_data = {
         'InstanceName': '',
         'InstanceId': instance_id,
@@ -192,656 +387,1280 @@ def get_network_utilization(instance_id, start_time, end_time, cloudwatch):
         'Min Outbound Bandwidth (Mbps)': 0,
         'Max Inbound Bandwidth (Mbps)': 0,
         'Max Outbound Bandwidth (Mbps)': 0,
+        'P50 Inbound Bandwidth (Mbps)': 0,
+        'P50 Outbound Bandwidth (Mbps)': 0,
         'P95 Inbound Bandwidth (Mbps)': 0,
         'P95 Outbound Bandwidth (Mbps)': 0,
+        'P99 Inbound Bandwidth (Mbps)': 0,
+        'P99 Outbound Bandwidth (Mbps)': 0,
         'VM Network capacity (Mbps)': 1000  # Placeholder for network capacity
     }
 
-    for metric, label in metrics.items():
-        response = cloudwatch.get_metric_statistics(
-            Namespace='AWS/EC2',
-            MetricName=metric,
-            Dimensions=[{'Name': 'InstanceId', 'Value': instance_id}],
-            StartTime=start_time,
-            EndTime=end_time,
-            Period=3600,
-            Statistics=['Average', 'Minimum', 'Maximum'],
-            Unit='Bytes'
-        )
-        
-        data_points = response.get('Datapoints', [])
-        
-        if data_points:
-            # Get the individual values for Average, Min, Max
-            average = sum([point['Average'] for point in data_points]) / len(data_points)
-            minimum = min([point['Minimum'] for point in data_points])
-            maximum = max([point['Maximum'] for point in data_points])
-
-            # Convert data points to Mbps (from bytes)
-            bandwidth_values = [point['Average'] / (1024 * 1024) for point in data_points]
-
-            # Calculate P95
-            if bandwidth_values:
-                p95_value = np.percentile(bandwidth_values, 95)  # Using numpy for P95 calculation
-            else:
-                p95_value = 0
-
-            # Convert from bytes to Mbps
-            if metric == 'NetworkIn':
-                network_data['Average Inbound Bandwidth (Mbps)'] = average / (1024 * 1024)
-                network_data['Min Inbound Bandwidth (Mbps)'] = minimum / (1024 * 1024)
-                network_data['Max Inbound Bandwidth (Mbps)'] = maximum / (1024 * 1024)
-                network_data['P95 Inbound Bandwidth (Mbps)'] = p95_value
-                network_data['VM Network capacity (Mbps)'] = maximum / (1024 * 1024)
-            else:
-                network_data['Average Outbound Bandwidth (Mbps)'] = average / (1024 * 1024)
-                network_data['Min Outbound Bandwidth (Mbps)'] = minimum / (1024 * 1024)
-                network_data['Max Outbound Bandwidth (Mbps)'] = maximum / (1024 * 1024)
-                network_data['P95 Outbound Bandwidth (Mbps)'] = p95_value
-                network_data['VM Network capacity (Mbps)'] = maximum / (1024 * 1024)
+    for metric in ('NetworkIn', 'NetworkOut'):
+        key = (instance_id, metric)
+        average = summary_statistic(stats, key)
+        if average is None:
+            continue
+
+        # Average, lowest and highest datapoint and percentiles of the month, converted from bytes to Mbps
+        direction = 'Inbound' if metric == 'NetworkIn' else 'Outbound'
+        maximum = (summary_statistic(stats, key, 'Maximum') or 0) / (1024 * 1024)
+        network_data[f'Average {direction} Bandwidth (Mbps)'] = average / (1024 * 1024)
+        network_data[f'Min {direction} Bandwidth (Mbps)'] = (summary_statistic(stats, key, 'Minimum') or 0) / (1024 * 1024)
+        network_data[f'Max {direction} Bandwidth (Mbps)'] = maximum
+        for statistic in PERCENTILE_STATISTICS:
+            value = summary_statistic(stats, key, statistic)
+            if value is not None:
+                network_data[f'{statistic.upper()} {direction} Bandwidth (Mbps)'] = value / (1024 * 1024)
+        network_data['VM Network capacity (Mbps)'] = maximum
     return network_data
 
-# Function to calculate monthly average
-def calculate_monthly_average(datapoints):
-    if not datapoints:
-        return None
-    total = sum(dp['Average'] for dp in datapoints)
-    return total / len(datapoints)
+# Helper function to retrieve network utilization
+def get_network_utilization(instance_id, start_time, end_time, cloudwatch, cache=None):
+    metric_requests = {
+        summary_metric_key((instance_id, metric)): summary_request(request, NETWORK_SUMMARY_STATISTICS)
+        for metric, request in network_utilization_requests(instance_id).items()
+    }
+    series_store = SeriesStore.from_columns(get_metric_columns(cloudwatch, metric_requests, start_time, end_time, cache))
+    return summarise_network_utilization(instance_id, series_store.stats)
+
+# Function to get the monthly average of a metric from the store statistics, None when it has no data
+def calculate_monthly_average(series_store, key):
+    return summary_statistic(series_store.stats, key)
+
+# RDS metrics collected for every DB instance and cluster: metric key, CloudWatch metric name and unit,
+# RDS Report column, chart axis label and colour, graph file and the scale applied to averages and charts
+RDS_METRICS = [
+    ('cpu', 'CPUUtilization', 'Percent', 'CPU Utilization Avg', 'CPU Utilization (%)', 'blue', 'cpu_utilization.png', 1),
+    ('read_iops', 'ReadIOPS', None, 'Read IOPS Avg', 'Read IOPS', 'green', 'read_iops.png', 1),
+    ('write_iops', 'WriteIOPS', None, 'Write IOPS Avg', 'Write IOPS', 'orange', 'write_iops.png', 1),
+    ('freeable_memory', 'FreeableMemory', None, 'Freeable Memory Avg (GB)', 'Freeable Memory (GB)', 'purple', 'freeable_memory.png', 1 / 1024 ** 3),
+    ('free_storage', 'FreeStorageSpace', None, 'Free Storage Space Avg (GB)', 'Free Storage Space (GB)', 'brown', 'free_storage_space.png', 1 / 1024 ** 3),
+    ('connections', 'DatabaseConnections', None, 'Database Connections Avg', 'Database Connections', 'red', 'database_connections.png', 1)
+]
+
+# RDS metrics whose percentiles get a column in the RDS Report, next to their average
+RDS_PERCENTILE_METRICS = ['cpu', 'read_iops', 'write_iops', 'connections']
+
+# Number of RDS instances and clusters whose summaries fit in one GetMetricData call (their series take another)
+RDS_BATCH_SIZE = MAX_QUERIES_PER_REQUEST // (len(RDS_METRICS) + len(RDS_PERCENTILE_METRICS) * len(PERCENTILE_STATISTICS))
+
+# Function to stream the RDS DB instances and then the DB clusters (Aurora, Multi-AZ) of the account, page by page
+def iter_rds_resources(rds):
+    for db_instance in iter_db_instances(rds):
+        yield {
+            'Identifier': db_instance['DBInstanceIdentifier'], 'Engine': db_instance['Engine'],
+            'Resource': 'Instance', 'DimensionName': 'DBInstanceIdentifier'
+        }
+    for db_cluster in iter_db_clusters(rds):
+        yield {
+            'Identifier': db_cluster['DBClusterIdentifier'], 'Engine': db_cluster['Engine'],
+            'Resource': 'Cluster', 'DimensionName': 'DBClusterIdentifier'
+        }
+
+# Function to build the metric data key of an RDS metric; instances and clusters may share a name
+def rds_metric_key(rds_resource, metric):
+    return (rds_resource['Identifier'], metric, rds_resource['DimensionName'])
+
+# Function to get the ID of an RDS instance or cluster in the report journal
+def rds_resource_id(identifier, resource):
+    return f'{resource}:{identifier}'
+
+# Function to describe the RDS_METRICS of an RDS instance or cluster: a summary of the month (with percentiles
+# for RDS_PERCENTILE_METRICS) and, with series=True, their series for the graphs and the export
+def rds_utilization_requests(rds_resource, period=3600, series=True):
+    dimensions = [{'Name': rds_resource['DimensionName'], 'Value': rds_resource['Identifier']}]
+    requests = {}
+    for metric, metric_name, unit, _, _, _, _, _ in RDS_METRICS:
+        key = rds_metric_key(rds_resource, metric)
+        request = metric_request('AWS/RDS', metric_name, dimensions, unit=unit, period=period)
+        if series:
+            requests[key] = request
+        requests[summary_metric_key(key)] = summary_request(request, SUMMARY_STATISTICS if metric in RDS_PERCENTILE_METRICS else ['Average'])
+    return requests
+
+# Function to stream RDS utilization of every DB instance and cluster, fetching the metrics of RDS_BATCH_SIZE
+# databases with one GetMetricData call. account_name is resolved once by the caller; rds_resources (shaped
+# like iter_rds_resources) replaces the RDS listing, e.g. with the databases the collector found
+# With series=False only the summaries are fetched, and the series are left empty
+def get_rds_utilization(account_name, rds, start_time, end_time, cloudwatch, cache=None, period=3600, rds_resources=None, series=True):
+    if rds_resources is None:
+        rds_resources = iter_rds_resources(rds)
+    for rds_resources in chunked(rds_resources, RDS_BATCH_SIZE):
+        metric_requests = {}
+        for rds_resource in rds_resources:
+            metric_requests.update(rds_utilization_requests(rds_resource, period, series))
+        series_store = SeriesStore.from_columns(get_metric_columns(cloudwatch, metric_requests, start_time, end_time, cache))
+
+        for rds_resource in rds_resources:
+            averages = {}
+            percentiles = {}
+            metric_series = {}
+            for metric, _, _, _, _, _, _, scale in RDS_METRICS:
+                key = rds_metric_key(rds_resource, metric)
+                average = calculate_monthly_average(series_store, key)
+                averages[metric] = average * scale if average is not None else None
+                if metric in RDS_PERCENTILE_METRICS:
+                    percentiles[metric] = {}
+                    for statistic in PERCENTILE_STATISTICS:
+                        value = summary_statistic(series_store.stats, key, statistic)
+                        percentiles[metric][statistic] = value * scale if value is not None else None
+                metric_series[metric] = series_store.series((key, 'Average'))
+            yield {
+                'db_name': rds_resource['Identifier'],
+                'db_type': rds_resource['Engine'],
+                'resource': rds_resource['Resource'],
+                'account_name': account_name,
+                'averages': averages,
+                'percentiles': percentiles,
+                'series': metric_series
+            }
 
-def get_rds_utilization(session, rds,start_time, end_time, cloudwatch):
-    # Fetch the list of RDS instances
-    db_instances = rds.describe_db_instances()
-    account_name = get_aws_account_name(session)
-    
-    # Create a list to store utilization data
-    utilization_data = []
-
-    # Loop through the instances
-    for db_instance in db_instances['DBInstances']:
-        db_name = db_instance['DBInstanceIdentifier']
-        db_type = db_instance['Engine']
-
-        cpu_utilization = cloudwatch.get_metric_statistics(
-            Namespace='AWS/RDS',
-            MetricName='CPUUtilization',
-            Dimensions=[{'Name': 'DBInstanceIdentifier', 'Value': db_name}],
-            StartTime=start_time,
-            EndTime=end_time,
-            Period=3600,
-            Statistics=['Average'],
-            Unit='Percent'
-        )
+# Function to build the RDS Report row of an RDS instance or cluster
+def rds_report_row(rds_utilization):
+    report_row = {
+        'Database name': rds_utilization['db_name'],
+        'db_type': rds_utilization['db_type'],
+        'Resource': rds_utilization['resource'],
+        'AWS Account Name': rds_utilization['account_name']
+    }
+    for metric, _, _, column, _, _, _, _ in RDS_METRICS:
+        report_row[column] = rds_utilization['averages'][metric]
+        for statistic, value in rds_utilization['percentiles'].get(metric, {}).items():
+            report_row[column.replace(' Avg', f' {statistic.upper()}')] = value
+    return report_row
+
+# Function to get the graph folder of an RDS instance or cluster under rds_base_folder
+def rds_graph_folder(rds_base_folder, db_name, resource):
+    return os.path.join(rds_base_folder, db_name if resource == 'Instance' else f'{db_name} (cluster)')
+
+# Function to describe the graphs of an RDS instance or cluster, one per RDS metric, in its folder under rds_base_folder
+def rds_charts(rds_utilization, rds_base_folder):
+    db_name = rds_utilization['db_name']
+    db_folder = rds_graph_folder(rds_base_folder, db_name, rds_utilization['resource'])
+    charts = []
+    for metric, _, _, _, ylabel, color, graph_file, scale in RDS_METRICS:
+        timestamps, values = rds_utilization['series'][metric]
+        charts.append(line_chart(
+            (timestamps, values * scale), ylabel, color, f'{db_name} - {ylabel.split(" (")[0]}', ylabel, os.path.join(db_folder, graph_file)
+        ))
+    return charts
+
+# Function to draw the graphs of RDS instances and clusters on the renderer's worker processes; without a renderer
+# a pool is started for these graphs only
+def create_rds_graphs(utilization_data, output_folder, base_directory='rds_utilization_graphs', renderer=None):
+    rds_base_folder = os.path.join(output_folder, base_directory)
+    charts = []
+    for rds_utilization in utilization_data:
+        charts.extend(rds_charts(rds_utilization, rds_base_folder))
 
-        read_iops = cloudwatch.get_metric_statistics(
-            Namespace='AWS/RDS',
-            MetricName='ReadIOPS',
-            Dimensions=[{'Name': 'DBInstanceIdentifier', 'Value': db_name}],
-            StartTime=start_time,
-            EndTime=end_time,
-            Period=3600,
-            Statistics=['Average']
-        )
+    if renderer is not None:
+        renderer.submit(charts)
+    else:
+        chart_renderer = ChartRenderer()
+        chart_renderer.submit(charts)
+        chart_renderer.close()
 
-        # Extract the data points for graphs
-        cpu_datapoints = sorted(cpu_utilization['Datapoints'], key=lambda x: x['Timestamp'])
-        read_iops_datapoints = sorted(read_iops['Datapoints'], key=lambda x: x['Timestamp'])
 
-        # Get average values if data is returned
-        cpu_avg = (
-            sum([point['Average'] for point in cpu_utilization['Datapoints']]) / len(cpu_utilization['Datapoints'])
-            if cpu_utilization['Datapoints'] else None
-        )
-        read_iops_avg = (
-            sum([point['Average'] for point in read_iops['Datapoints']]) / len(read_iops['Datapoints'])
-            if read_iops['Datapoints'] else None
+# Function to build the compliance rows of an instance from its patch state (see get_patch_states)
+def generate_compliance_report(patch_state, instance_id, instance_name):
+    compliance_data = []
+    if patch_state is None:
+        print(f"No patch state found for instance {instance_id}.")
+        return compliance_data
+
+    operation_start = patch_state.get('OperationStartTime')
+    operation_end = patch_state.get('OperationEndTime')
+    compliance_data.append({
+        'Instance ID': instance_id,
+        'Instance Name': instance_name,
+        'Installed': patch_state.get('InstalledCount', 0),
+        'InstalledOther': patch_state.get('InstalledOtherCount', 0),
+        'Installed Pending Reboot': patch_state.get('InstalledPendingRebootCount', 0),
+        'Installed Rejected': patch_state.get('InstalledRejectedCount', 0),
+        'Missing': patch_state.get('MissingCount', 0),
+        'Failed': patch_state.get('FailedCount', 0),
+        'OperationStart': operation_start.strftime('%Y-%m-%d') if operation_start else 'N/A',
+        'OperationEnd': operation_end.strftime('%Y-%m-%d') if operation_end else 'N/A'
+    })
+    return compliance_data
+
+# Function to fetch the patch states of a list of instances with bulk describe_instance_patch_states calls,
+# indexed by InstanceId
+def get_patch_states(ssm_client, instance_ids, instrumentation=None):
+    try:
+        with service_slot('ssm', ssm_client.meta.region_name), phase(instrumentation, 'compliance'):
+            return {patch_state['InstanceId']: patch_state for patch_state in iter_instance_patch_states(ssm_client, instance_ids)}
+    except botocore.exceptions.ClientError as e:
+        # Expired credentials and other failures are raised, so the batch is not journaled without its compliance
+        if e.response.get('Error', {}).get('Code') not in SKIPPED_PATCH_STATE_ERROR_CODES:
+            raise
+        print(f"An error occurred fetching the patch states of instances {', '.join(instance_ids)}: {str(e)}")
+        return {}
+
+# Function to fetch the SSM compliance and patch data of one instance once the patch states of its batch are in
+# Patches are only listed when the last patch operation (scan or install) ended after the start of the report
+# window: an instance whose last operation ended before it cannot have installed anything in the window
+def collect_instance_patch_data(instance_id, inventory, ssm_client, start_time, end_time, patch_states_future, instrumentation=None):
+    instance_name = get_instance_display_name(instance_id, inventory)
+    patch_state = patch_states_future.result().get(instance_id)
+    compliance_datapoints = generate_compliance_report(patch_state, instance_id, instance_name)
+
+    operation_end = patch_state.get('OperationEndTime') if patch_state else None
+    if operation_end is None or operation_end.replace(tzinfo=None) < start_time:
+        return compliance_datapoints, []
+    with service_slot('ssm', ssm_client.meta.region_name), phase(instrumentation, 'patches'):
+        patches = get_monthly_patches(inventory, instance_id, ssm_client, start_time, end_time)
+    return compliance_datapoints, patches
+
+# Function to start collecting the SSM data of a batch of instances: one task fetches the patch states of the
+# whole batch, then one task per instance builds its compliance rows and lists its patches. The patch states task
+# is queued first, so it is always running before the tasks that wait for it can fill the pool.
+# With collected data (see collected_data.py) the rows the collector stored are read instead of SSM
+def submit_patch_collection(executor, batch, inventory, ssm_client, start_time, end_time, instrumentation=None, collected=None):
+    instance_ids = [instance['InstanceId'] for instance in batch]
+    if collected is not None:
+        return [executor.submit(collected.patch_data, instance_id) for instance_id in instance_ids]
+    patch_states_future = executor.submit(get_patch_states, ssm_client, instance_ids, instrumentation)
+    return [
+        executor.submit(collect_instance_patch_data, instance_id, inventory, ssm_client, start_time, end_time, patch_states_future, instrumentation)
+        for instance_id in instance_ids
+    ]
+
+# Function to fetch a batch of metric requests while holding a CloudWatch slot, into a columnar series store
+def collect_metric_data(cloudwatch, metric_requests, start_time, end_time, cache=None, instrumentation=None):
+    with service_slot('cloudwatch', cloudwatch.meta.region_name), phase(instrumentation, 'metrics'):
+        metric_columns = get_metric_columns(cloudwatch, metric_requests, start_time, end_time, cache)
+    with phase(instrumentation, 'statistics'):
+        return SeriesStore.from_columns(metric_columns)
+
+# Function to add a batch of instances to the inventory and describe every metric of the batch,
+# so they are fetched with batched GetMetricData calls (see instance_metric_requests for series)
+def describe_instance_batch(batch, inventory, disk_index, periods=DEFAULT_PERIODS, series=True):
+    metric_requests = {}
+    for instance in batch:
+        instance_id = instance['InstanceId']
+        add_instance_to_inventory(inventory, instance)
+        instance_name = get_instance_display_name(instance_id, inventory)
+        platform, volume_count = get_instance_platform(inventory, instance_id)
+        inventory[instance_id]['DiskVolumes'] = instance_disk_volumes(
+            instance_name, instance_id, instance['ImageId'], instance['InstanceType'], platform, volume_count, disk_index
         )
+        metric_requests.update(instance_metric_requests(
+            instance_name, instance_id, instance['ImageId'], instance['InstanceType'], platform, inventory[instance_id]['DiskVolumes'], periods, series
+        ))
+    return metric_requests
+
+# Function to start fetching the metrics, compliance and patches of a batch of instances on the worker pool
+def submit_instance_batch(executor, batch, inventory, disk_index, cloudwatch, ssm_client, start_time, end_time, cache=None, instrumentation=None, periods=DEFAULT_PERIODS, collected=None, series=True):
+    metric_requests = describe_instance_batch(batch, inventory, disk_index, periods, series)
+    metric_future = executor.submit(collect_metric_data, cloudwatch, metric_requests, start_time, end_time, cache, instrumentation)
+    patch_futures = submit_patch_collection(executor, batch, inventory, ssm_client, start_time, end_time, instrumentation, collected)
+    return batch, metric_future, patch_futures
+
+# Function to wait for a submitted batch and build its rows and charts in instance order
+# When an exporter is given, the rows of each instance carry the batch's series store ('series_store'), so the
+# caller exports the instance's raw series once the instance is journaled. Each instance leaves the inventory
+# once its rows are consumed, and the batch's series store is released with the batch, so memory stays flat
+def report_instance_batch(submitted_batch, inventory, output_folder, exporter=None, instrumentation=None):
+    batch, metric_future, patch_futures = submitted_batch
+    series_store = metric_future.result()
+    for instance, patch_future in zip(batch, patch_futures):
+        compliance_datapoints, patches = patch_future.result()
+        with phase(instrumentation, 'report rows'):
+            instance_rows = report_instance(instance['InstanceId'], inventory, series_store, compliance_datapoints, patches, output_folder)
+        if exporter is not None:
+            instance_rows['series_store'] = series_store
+        yield instance_rows
+        del inventory[instance['InstanceId']]
+
+# Function to stream instance rows page by page: the next batch is fetched on the worker pool
+# while the previous one is turned into rows and charts, so rows come out in instance order
+def iter_instance_rows(executor, instances, inventory, disk_index, cloudwatch, ssm_client, start_time, end_time, output_folder, cache=None, exporter=None, instrumentation=None, periods=DEFAULT_PERIODS, collected=None, series=True):
+    pending_batch = None
+    for batch in chunked(instances, INSTANCE_BATCH_SIZE):
+        submitted_batch = submit_instance_batch(executor, batch, inventory, disk_index, cloudwatch, ssm_client, start_time, end_time, cache, instrumentation, periods, collected, series)
+        if pending_batch is not None:
+            yield from report_instance_batch(pending_batch, inventory, output_folder, exporter, instrumentation)
+        pending_batch = submitted_batch
+
+    if pending_batch is not None:
+        yield from report_instance_batch(pending_batch, inventory, output_folder, exporter, instrumentation)
+
+# Function to collect the report rows and chart descriptions for one instance from the series store of its batch
+def report_instance(instance_id, inventory, series_store, compliance_datapoints, patches, output_folder):
+    instance = inventory[instance_id]
+    image_id = instance['ImageId']
+    instance_type = instance['InstanceType']
+    instance_name = get_instance_display_name(instance_id, inventory)
+
+    # Get platform (Windows or Linux) for the instance
+    platform = get_instance_platform(inventory, instance_id)[0]
+
+    # Charts go to a subfolder for each EC2 instance inside the main folder
+    instance_folder = os.path.join(output_folder, instance_name)
+
+    # CPU utilization
+    avg_cpu_utilization = calculate_monthly_average(series_store, (instance_id, 'cpu'))
+    
+    # Memory utilization based on platform
+    avg_memory_utilization = calculate_monthly_average(series_store, (instance_id, 'memory'))
+    if avg_memory_utilization is None:
+        avg_memory_utilization = "N/A"
+
+    # Percentiles of the month computed by CloudWatch, e.g. P95CPUUtilization (%)
+    cpu_percentiles = {
+        f'{statistic.upper()}CPUUtilization (%)': summary_statistic(series_store.stats, (instance_id, 'cpu'), statistic)
+        for statistic in PERCENTILE_STATISTICS
+    }
+    memory_percentiles = {}
+    for statistic in PERCENTILE_STATISTICS:
+        value = summary_statistic(series_store.stats, (instance_id, 'memory'), statistic)
+        memory_percentiles[f'{statistic.upper()}MemoryUtilization (%)'] = value if value is not None else "N/A"
+    
+    # Disk utilization based on platform. Every volume with data gets a row in the Disk Utilization sheet and a
+    # chart; the first primary and secondary volume with data also fill the Server Utilization columns
+    w_avg_disk_utilization = "N/A"
+    w_avg_disk_utilization2 = "N/A"
+    l_avg_disk_utilization = "N/A"
+    l_avg_disk_utilization2 = "N/A"
+    disk_data = []
+    charts = []
+
+    disk_volumes = instance['DiskVolumes']
+    if not disk_volumes:
+        print(f"Instance {instance_name} is running on Unsupported platform for Disk utilization:{platform}.")
+    for role, volumes in disk_volumes.items():
+        role_reported = False
+        for volume in volumes:
+            disk_key = disk_metric_key(instance_id, volume)
+            avg_disk_utilization = calculate_monthly_average(series_store, disk_key)
+            if avg_disk_utilization is None:
+                continue
+            disk_data.append({
+                'InstanceId': instance_id,
+                'InstanceName': instance_name,
+                'InstancePlatform': platform,
+                'Metric': volume['MetricName'],
+                'Device': volume['device'],
+                'Path / Drive': volume['disk'],
+                'FsType': volume['fstype'],
+                'Average (%)': avg_disk_utilization
+            })
+
+            if role_reported or role == 'other':
+                disk_label = volume['disk'].strip('/').replace('/', '_').replace(':', '') or 'root'
+                graph_name = f'{instance_name}_{instance_id}_{disk_label}_disk.png'
+            elif platform == 'Windows' and role == 'primary':
+                w_avg_disk_utilization = avg_disk_utilization
+                graph_name = f'{instance_name}_{instance_id}_C_Drive.png'
+            elif platform == 'Windows':
+                w_avg_disk_utilization2 = avg_disk_utilization
+                graph_name = f'{instance_name}_{instance_id}_D_drive.png'
+            elif role == 'primary':
+                l_avg_disk_utilization = avg_disk_utilization
+                graph_name = f'{instance_name}_Disk Utilization for root path.png'
+            else:
+                l_avg_disk_utilization2 = avg_disk_utilization
+                graph_name = f'{instance_name}_Disk Utilization for secondary Volume.png'
+            role_reported = True
 
-        # Append data to list
-        utilization_data.append({
-            'db_name': db_name,
-            'db_type': db_type,
-            'account_name': account_name,
-            'cpu_avg': cpu_avg,
-            'read_iops_avg': read_iops_avg,
-            'cpu_datapoints': cpu_datapoints,
-            'read_iops_datapoints': read_iops_datapoints
+            charts.append(daily_utilization_chart(
+                series_store.series((disk_key, 'Average')), 'Disk Utilization (%)', 'r', f'Disk Utilization - {instance_name} ({instance_id})',
+                os.path.join(instance_folder, graph_name)
+            ))
+
+    compliance_data = []
+    for compliance in compliance_datapoints:
+        compliance_data.append({
+        'Instance ID': instance_id,
+            'Instance Name': instance_name,
+            'Installed': compliance['Installed'],
+            'InstalledOther': compliance['InstalledOther'],
+            'Installed Pending Reboot': compliance['Installed Pending Reboot'],
+            'Installed Rejected':  compliance['Installed Rejected'],
+            'Missing':  compliance['Missing'],
+            'Failed':  compliance['Failed'],
+            'OperationStart':  compliance['OperationStart'],
+            'OperationEnd':  compliance['OperationEnd']
         })
+    
+    # Network utilization
+    network_utilization = summarise_network_utilization(instance_id, series_store.stats)
+    network_utilization['InstanceName'] = instance_name
 
-    return utilization_data
+    # Fetch and add patches data
+    patches_data = []
+    for patch in patches:
+        patches_data.append({
+        'Instance Name': instance_name,
+        'Instance ID': instance_id,
+        'Patch Name': patch['Patch Name'],
+        'Severity': patch['Severity'],
+        'Compliance State': patch['Compliance State'],
+        'Installed Time': patch['Installed Time']
+        })
 
-def create_rds_graphs(utilization_data, output_folder, base_directory='rds_utilization_graphs'):
-    # Create the base directory if it doesn't exist
-    # Create a subfolder for each EC2 instance inside the main folder
-    rds_base_folder = os.path.join(output_folder, base_directory)
-    if not os.path.exists(rds_base_folder):
-        os.makedirs(rds_base_folder)
+    # CPU and memory utilization graphs, daily means with missing days filled by linear interpolation
+    charts.append(daily_utilization_chart(
+        series_store.series(((instance_id, 'cpu'), 'Average')), 'CPU Utilization (%)', 'b',
+        f'CPU Utilization - {instance_name} ({instance_id})',
+        os.path.join(instance_folder, f'{instance_name}_{instance_id}_cpu.png')
+    ))
+    charts.append(daily_utilization_chart(
+        series_store.series(((instance_id, 'memory'), 'Average')), 'Memory Utilization (%)', 'g',
+        f'Memory Utilization - {instance_name} ({instance_id})',
+        os.path.join(instance_folder, f'{instance_name}_{instance_id}_memory.png')
+    ))
+
+    # Save to Excel
+    report_row = {
+        'InstanceId': instance_id,
+        'InstanceName': instance_name,
+        'InstancePlatform': platform,
+        'AverageCPUUtilization (%)': avg_cpu_utilization,
+        **cpu_percentiles,
+        'AverageMemoryUtilization (%)': avg_memory_utilization,
+        **memory_percentiles,
+        'AverageDiskUtilization root (%)': l_avg_disk_utilization if 'l_avg_disk_utilization' in locals() else 'N/A',
+        f'AverageDiskUtilization (%) for Secondary volume': l_avg_disk_utilization2 if 'w_avg_disk_utilization2' in locals() else 'N/A',
+        'AverageDiskUtilization (%) C Drive': w_avg_disk_utilization if 'w_avg_disk_utilization' in locals() else 'N/A',
+        f'AverageDiskUtilization (%) for Secondary Drive': w_avg_disk_utilization2 if 'w_avg_disk_utilization2' in locals() else 'N/A'   
+    }
 
-    for rds_utilization in utilization_data:
-        db_name = rds_utilization['db_name']
-        db_folder = os.path.join(rds_base_folder, db_name)
-
-        # Create subfolder for the database if it doesn't exist
-        if not os.path.exists(db_folder):
-            os.makedirs(db_folder)
-
-        # Get the CPU and Read IOPS data points
-        cpu_datapoints = rds_utilization['cpu_datapoints']
-        read_iops_datapoints = rds_utilization['read_iops_datapoints']
-
-        # Extract timestamps and values for CPU Utilization and Read IOPS
-        cpu_times = [dp['Timestamp'] for dp in cpu_datapoints]
-        cpu_values = [dp['Average'] for dp in cpu_datapoints]
-
-        iops_times = [dp['Timestamp'] for dp in read_iops_datapoints]
-        iops_values = [dp['Average'] for dp in read_iops_datapoints]
-
-        # Plot CPU Utilization graph
-        plt.figure()
-        plt.plot(cpu_times, cpu_values, label='CPU Utilization (%)', color='blue')
-        plt.title(f'{db_name} - CPU Utilization')
-        plt.xlabel('Timestamp')
-        plt.ylabel('CPU Utilization (%)')
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        plt.savefig(os.path.join(db_folder, 'cpu_utilization.png'))
-        plt.close()
-
-        # Plot Read IOPS graph
-        plt.figure()
-        plt.plot(iops_times, iops_values, label='Read IOPS', color='green')
-        plt.title(f'{db_name} - Read IOPS')
-        plt.xlabel('Timestamp')
-        plt.ylabel('Read IOPS')
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        plt.savefig(os.path.join(db_folder, 'read_iops.png'))
-        plt.close()
-
-
-def generate_compliance_report(ssm_client, instance_id, instance_name):
-    compliance_data = []
+    # Network utilization graph
+    charts.append(bar_chart(
+        ['Average Inbound', 'Average Outbound'],
+        [network_utilization['Average Inbound Bandwidth (Mbps)'], network_utilization['Average Outbound Bandwidth (Mbps)']],
+        ['blue', 'green'], f'Network Utilization - {instance_name} ({instance_id})', 'Network Utilization', 'Bandwidth (Mbps)',
+        os.path.join(instance_folder, f'{instance_name}_{instance_id}_network.png')
+    ))
+
+    return {
+        'report': report_row,
+        'network': network_utilization,
+        'patches': patches_data,
+        'compliance': compliance_data,
+        'disks': disk_data,
+        'charts': charts
+    }
 
-    try:
-        # Fetch compliance details
-        response = ssm_client.describe_instance_patch_states(InstanceIds=[instance_id])
-        # Check if the response contains 'InstancePatchStates'
-        if 'InstancePatchStates' in response:
-            for state in response['InstancePatchStates']:
-                compliance_data.append({
-                    'Instance ID': instance_id,
-                    'Instance Name': instance_name,
-                    'Installed': state.get('InstalledCount', 0),
-                    'InstalledOther': state.get('InstalledOtherCount', 0),
-                    'Installed Pending Reboot': state.get('InstalledPendingRebootCount', 0),
-                    'Installed Rejected': state.get('InstalledRejectedCount', 0),
-                    'Missing': state.get('MissingCount', 0),
-                    'Failed': state.get('FailedCount', 0),
-                    'OperationStart': state.get('OperationStartTime', 'N/A').strftime('%Y-%m-%d'),
-                    'OperationEnd': state.get('OperationEndTime', 'N/A').strftime('%Y-%m-%d')
-                })
+# Names of the sheets of the consolidated report, in workbook order
+REPORT_SHEETS = [
+    'Server Utilization', 'Network Utilization', 'Disk Utilization',
+    'Patch Installation', 'Patch Compliance Report', 'RDS Report'
+]
+
+# Items of region rows queued between the region threads and the workbook in a multi-region run
+REGION_QUEUE_SIZE = 64
+
+# Error codes of a region the account cannot use (access denied, region not enabled); such a region is left out
+# of a multi-region report, while any other error stops the run so it is resumed
+SKIPPED_REGION_ERROR_CODES = {
+    'AccessDenied', 'AccessDeniedException', 'AuthFailure', 'UnauthorizedOperation', 'OptInRequired',
+    'UnrecognizedClientException', 'InvalidClientTokenId'
+}
+
+# Function to get the shared CloudWatch, EC2, SSM and RDS clients of one region (the profile's region when None)
+def region_clients(clients, session, region_name, instrumentation):
+    return {
+        service_name: instrumentation.attach(clients.client(session, service_name, region_name))
+        for service_name in ('cloudwatch', 'ec2', 'ssm', 'rds')
+    }
+
+# Function to stream the rows of one region: ('instance', instance rows) for every running instance, then
+# ('rds', rds utilization) for every RDS instance and cluster. Charts go under output_folder
+# Instances and databases whose (kind, id) is in finished were reported by an interrupted run and are skipped
+# With series=False only the monthly summaries of CPU, memory, network and RDS metrics are fetched
+def iter_region_rows(clients, start_time, end_time, output_folder, account_name, workers=1, cache=None, exporter=None, instrumentation=None, periods=DEFAULT_PERIODS, collected_data=None, finished=frozenset(), series=True):
+    cloudwatch = clients['cloudwatch']
+
+    # Find the disk volumes the CloudWatch agent reports, so only volumes that exist are queried
+    with phase(instrumentation, 'inventory'):
+        if collected_data is not None:
+            disk_index = collected_data.disk_index()
         else:
-            print(f"Unexpected response format for instance {instance_id}: {response}")
-    
-    except Exception as e:
-        print(f"An error occurred for instance {instance_id}: {str(e)}")
-    return compliance_data
+            disk_index = load_disk_index(cloudwatch, output_folder, end_time, cache)
+
+    inventory = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if collected_data is not None:
+            instances = collected_data.instances()
+        else:
+            instances = instrumentation.timed_iter(
+                'inventory', iter_instances(clients['ec2'], filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
+            )
+        instances = (instance for instance in instances if ('instance', instance['InstanceId']) not in finished)
+        for instance_rows in iter_instance_rows(executor, instances, inventory, disk_index, cloudwatch, clients['ssm'], start_time, end_time, output_folder, cache, exporter, instrumentation, periods, collected_data, series):
+            yield 'instance', instance_rows
+
+    rds_resources = collected_data.rds_resources() if collected_data is not None else iter_rds_resources(clients['rds'])
+    rds_resources = (
+        rds_resource for rds_resource in rds_resources
+        if ('rds', rds_resource_id(rds_resource['Identifier'], rds_resource['Resource'])) not in finished
+    )
+    for rds_utilization in instrumentation.timed_iter('rds', get_rds_utilization(account_name, clients['rds'], start_time, end_time, cloudwatch, cache, periods['utilization'], rds_resources, series)):
+        yield 'rds', rds_utilization
+
+# Function to put an item on a bounded queue, giving up once stop is set (the consumer has gone away)
+def _put_until_stopped(rows_queue, item, stop):
+    while not stop.is_set():
+        try:
+            rows_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+# Function to merge the rows of several regions, each streamed by its own thread, as (region, kind, rows) in the
+# order they are ready. The queue between the threads and the caller is bounded, so regions wait for the workbook
+# instead of piling rows up. A region the account cannot use (SKIPPED_REGION_ERROR_CODES) is reported and left
+# out; any other error (an expired SSO token, a transient failure) is raised, so the report is not completed
+# without the region and run_profile resumes it
+def iter_regions_rows(region_rows):
+    rows_queue = queue.Queue(maxsize=REGION_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def produce(region_name, rows):
+        try:
+            for kind, item in rows:
+                if not _put_until_stopped(rows_queue, (region_name, kind, item), stop):
+                    return
+        except Exception as e:
+            _put_until_stopped(rows_queue, (region_name, 'error', e), stop)
+        finally:
+            rows.close()
+            _put_until_stopped(rows_queue, (region_name, 'done', None), stop)
+
+    threads = [threading.Thread(target=produce, args=(region_name, rows), daemon=True) for region_name, rows in region_rows.items()]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            region_name, kind, item = rows_queue.get()
+            if kind == 'done':
+                running -= 1
+            elif kind == 'error':
+                if not isinstance(item, botocore.exceptions.ClientError) or item.response.get('Error', {}).get('Code') not in SKIPPED_REGION_ERROR_CODES:
+                    raise item
+                print(f"Region {region_name} is left out of the report: {item}")
+            else:
+                yield region_name, kind, item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+# Function to put the Region column first in a row of a multi-region report (rows are left as they are otherwise)
+def with_region(row, region_name):
+    return row if region_name is None else {'Region': region_name, **row}
 
 # Function to generate CPU, Memory, and Disk utilization report for all instances
-def generate_report(profile_name, session, start_time, end_time, output_folder):
-    cloudwatch = session.client('cloudwatch')
-    ec2 = session.client('ec2')
-    ssm_client = session.client('ssm')
-    rds = session.client('rds')
+# The report is a pipeline of generator stages over pages of instances, holding at most two batches at a time:
+# inventory (describe_instances pages) -> metric and patch fetch (worker pool) -> summarise (series store
+# statistics, rows and chart descriptions) -> emit (workbook, chart renderer, exporter).
+# Rows are streamed into the workbook as instances finish; charts are drawn to PNG files (png_charts)
+# and/or embedded in the workbook as native Excel charts (excel_charts). With export_folder, the raw
+# datapoints and the patch/compliance rows are also exported to a dataset partitioned by account and month.
+# With collected=True, the inventory, patches and compliance the background collector (collector.py) stored in
+# the output folder are read instead of EC2, SSM and RDS, and the metrics come from its month-to-date series.
+# With regions (a list of region names, or ['all'] for every enabled region), each region is collected
+# concurrently by its own thread with its own clients, cache and chart folder, and every sheet gets a Region
+# column; the run takes about as long as its slowest region.
+# Every finished instance and database is checkpointed to report_journal.jsonl in the output folder; when a run
+# stops part way (expired SSO token, crash), the next run of the same report replays the journal and carries on
+# from the next unfinished instance. With resume=False an existing journal is discarded.
+# clients is a ClientManager shared by the attempts of a profile (a new one sized for the workers by default); the
+# SSO login is renewed before it expires while the report runs.
+# The averages and P50/P95/P99 columns are summary statistics CloudWatch computes over the month; the series of
+# CPU, memory, network and RDS metrics are only fetched for the charts and the export.
+# API calls and phase timings are written to run_summary.json in the output folder.
+def generate_report(profile_name, session, start_time, end_time, output_folder, workers=1,
+                    use_cache=True, refresh_cache=False, cache_size_mb=DEFAULT_CACHE_SIZE_MB, incremental=False,
+                    chart_processes=None, png_charts=True, excel_charts=False, export_folder=None, export_format=None,
+                    progress=False, periods=DEFAULT_PERIODS, collected=False, regions=None, resume=True, clients=None):
+    # Count calls, retries, throttles and latency of every client, and time each phase of the run
+    instrumentation = RunInstrumentation(progress)
+    clients = clients or ClientManager(workers)
+    clients.refresh_credentials(session, force=True)
+
+    # None stands for the region of the profile in a single-region run
+    region_names = [None]
+    if regions:
+        region_names = list_enabled_regions(session, clients) if regions == ['all'] else list(regions)
+        print(f"Collecting regions {', '.join(region_names)}")
+
+    # The collector keeps its month-to-date series in the cache of the report folder, so they are read incrementally
+    collected_data = None
+    if collected and regions:
+        print("Collected data covers the profile's region only; collecting every region from AWS instead.")
+    elif collected:
+        collected_data = CollectedData.open(output_folder)
+        if collected_data is None:
+            print(f"No collected data in {output_folder}; collecting from AWS instead.")
+    if collected_data is not None:
+        incremental = True
+
+    # CloudWatch datapoints of closed time windows are kept on disk, so reruns of a past month skip CloudWatch.
+    # In incremental mode the month-to-date series are kept there too and only the new datapoints are fetched.
+    # Each region has its own cache and chart folder, as RDS names can be reused across regions
+    region_folders = {region_name: os.path.join(output_folder, region_name) if region_name else output_folder for region_name in region_names}
+    caches = {}
+    if use_cache or incremental:
+        for region_name, region_folder in region_folders.items():
+            caches[region_name] = MetricCache(
+                os.path.join(region_folder, 'cloudwatch_cache.sqlite'), cache_size_mb, refresh=refresh_cache, incremental=incremental
+            )
+
+    # PNG charts are drawn by a pool of worker processes while collection goes on
+    renderer = ChartRenderer(chart_processes) if png_charts else None
+    rendered, render_seconds = 0, 0.0
+    series = bool(png_charts or excel_charts or export_folder)
 
-    instances = ec2.describe_instances(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
-    
-    report_data = []
-    network_data = []
-    patches_data = []
-    compliance_data = []
-    rds_data = []
-    
     excel_file = os.path.join(output_folder, f'Consolidated_report_{profile_name}_{start_time.strftime("%Y_%m")}.xlsx')
-    with pd.ExcelWriter(excel_file, engine='xlsxwriter') as excel_writer:
-        for reservation in instances['Reservations']:
-            for instance in reservation['Instances']:
-                instance_id = instance['InstanceId']
-                image_id = instance['ImageId']
-                instance_type = instance['InstanceType']
-                instance_name = next(
-                    (tag['Value'] for tag in instance['Tags'] if tag['Key'] == 'Name'),
-                    instance_id
-                )
-
-            # Get platform (Windows or Linux) for the instance
-            platform, volume_count = get_instance_platform(ec2, instance_id)
-
-            # Create a subfolder for each EC2 instance inside the main folder
-            instance_folder = os.path.join(output_folder, instance_name)
-            os.makedirs(instance_folder, exist_ok=True)
-
-            # CPU utilization
-            cpu_datapoints = get_cpu_utilization(instance_id, start_time, end_time, cloudwatch)
-            cpu_datapoints = sorted(cpu_datapoints, key=lambda x: x['Timestamp'])
-            time_series_cpu = [dp['Timestamp'] for dp in cpu_datapoints]
-            cpu_values = [dp['Average'] for dp in cpu_datapoints]
-            avg_cpu_utilization = calculate_monthly_average(cpu_datapoints)
-            
-            # Memory utilization based on platform
-            memory_datapoints = get_memory_utilization(
-                instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform
-            )
-            memory_datapoints = sorted(memory_datapoints, key=lambda x: x['Timestamp'])
-            if not memory_datapoints:
-                avg_memory_utilization = "N/A"
-                time_series_memory = []
-                memory_values = []
-            else:
-                time_series_memory = [dp['Timestamp'] for dp in memory_datapoints]
-                memory_values = [dp['Average'] for dp in memory_datapoints]
-                avg_memory_utilization = calculate_monthly_average(memory_datapoints)
-            
-            # Disk utilization based on platform
-            w_avg_disk_utilization = "N/A"
-            w_avg_disk_utilization2 = "N/A"
-            l_avg_disk_utilization = "N/A"
-            l_avg_disk_utilization2 = "N/A"
-            device = "N/A"
-            
-            if volume_count == 1 and platform == 'Windows':                
-                w_disk_datapoints = get_disk_utilization(
-                    instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform, device, disk = 'C:'
-                )
-
-                w_disk_datapoints = sorted(w_disk_datapoints, key=lambda x: x['Timestamp'])
-                if not w_disk_datapoints:
-                    w_avg_disk_utilization = "N/A"
-                    time_series_disk = []
-                    w_disk_values = []
-                else:
-                    time_series_disk = [dp['Timestamp'] for dp in w_disk_datapoints]
-                    w_disk_values = [dp['Average'] for dp in w_disk_datapoints]
-                    w_avg_disk_utilization = calculate_monthly_average(w_disk_datapoints)
-                
-                if len(w_disk_values) > 1:
-                    time_series_disk = pd.to_datetime(time_series_disk)
-                    w_disk_values = pd.Series(w_disk_values, index=time_series_disk).resample('D').mean().interpolate().tolist()
-                    time_series_disk = pd.date_range(start=time_series_disk[0], end=time_series_disk[-1], freq='D')
-
-                    # Plot Disk utilization graph
-                    plt.figure(figsize=(10, 6))
-                    plt.plot(time_series_disk, w_disk_values, label='Disk Utilization (%)', color='r', linestyle='-', marker='o')
-                    plt.xlabel('Time')
-                    plt.ylabel('Utilization (%)')
-                    plt.title(f'Disk Utilization - {instance_name} ({instance_id})')
-                    plt.legend()
-                    plt.grid(True)
-                    plt.xticks(rotation=45, ha='right')
-                    plt.tight_layout()
-
-                    graph_file_disk = os.path.join(instance_folder, f'{instance_name}_{instance_id}_C_Drive.png')
-                    plt.savefig(graph_file_disk)
-                    plt.close()
-
-            elif volume_count == 2 and platform == 'Windows':
-                w_disk_datapoints = get_disk_utilization(
-                    instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform, device, disk = 'C:'
-                )
-                w_disk_datapoints = sorted(w_disk_datapoints, key=lambda x: x['Timestamp'])
-                if not w_disk_datapoints:
-                    w_avg_disk_utilization = "N/A"
-                    time_series_disk = []
-                    w_disk_values = []
-                else:
-                    time_series_disk = [dp['Timestamp'] for dp in w_disk_datapoints]
-                    w_disk_values = [dp['Average'] for dp in w_disk_datapoints]
-                    w_avg_disk_utilization = calculate_monthly_average(w_disk_datapoints)
-
-                if len(w_disk_values) > 1:
-                    time_series_disk = pd.to_datetime(time_series_disk)
-                    w_disk_values = pd.Series(w_disk_values, index=time_series_disk).resample('D').mean().interpolate().tolist()
-                    time_series_disk = pd.date_range(start=time_series_disk[0], end=time_series_disk[-1], freq='D')
-
-                    # Plot Disk utilization graph
-                    plt.figure(figsize=(10, 6))
-                    plt.plot(time_series_disk, w_disk_values, label='Disk Utilization (%)', color='r', linestyle='-', marker='o')
-                    plt.xlabel('Time')
-                    plt.ylabel('Utilization (%)')
-                    plt.title(f'Disk Utilization - {instance_name} ({instance_id})')
-                    plt.legend()
-                    plt.grid(True)
-                    plt.xticks(rotation=45, ha='right')
-                    plt.tight_layout()
-
-                    graph_file_disk = os.path.join(instance_folder, f'{instance_name}_{instance_id}_C_Drive.png')
-                    plt.savefig(graph_file_disk)
-                    plt.close()
-
-                w_disk_datapoints2 = get_disk_utilization(
-                    instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform, device, disk = 'D:'
-                )
-                w_disk_datapoints2 = sorted(w_disk_datapoints2, key=lambda x: x['Timestamp'])
-                if not w_disk_datapoints2:
-                    w_disk_datapoints2 = get_disk_utilization(
-                    instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform, device, disk = 'F:'
-                )
-                    w_disk_datapoints2 = sorted(w_disk_datapoints2, key=lambda x: x['Timestamp'])
-                    if not w_disk_datapoints2:
-                        w_avg_disk_utilization2 = "N/A"
-                        time_series_disk = []
-                        w_disk_values2 = []
-                
-                time_series_disk = [dp['Timestamp'] for dp in w_disk_datapoints2]
-                w_disk_values2 = [dp['Average'] for dp in w_disk_datapoints2]
-                w_avg_disk_utilization2 = calculate_monthly_average(w_disk_datapoints2)
-
-                if len(w_disk_values2) > 1:
-                    time_series_disk = pd.to_datetime(time_series_disk)
-                    w_disk_values2 = pd.Series(w_disk_values2, index=time_series_disk).resample('D').mean().interpolate().tolist()
-                    time_series_disk = pd.date_range(start=time_series_disk[0], end=time_series_disk[-1], freq='D')
-
-                    # Plot Disk utilization graph
-                    plt.figure(figsize=(10, 6))
-                    plt.plot(time_series_disk, w_disk_values2, label='Disk Utilization (%)', color='r', linestyle='-', marker='o')
-                    plt.xlabel('Time')
-                    plt.ylabel('Utilization (%)')
-                    plt.title(f'Disk Utilization - {instance_name} ({instance_id})')
-                    plt.legend()
-                    plt.grid(True)
-                    plt.xticks(rotation=45, ha='right')
-                    plt.tight_layout()
-
-                    graph_file_disk = os.path.join(instance_folder, f'{instance_name}_{instance_id}_D_drive.png')
-                    plt.savefig(graph_file_disk)
-                    plt.close()
-
-            elif volume_count == 1 and platform == 'Red Hat Enterprise Linux':
-                l_disk_datapoints = get_disk_utilization(
-                    instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform, device = 'nvme0n1p2', disk = '/'
-                )
-
-                l_disk_datapoints = sorted(l_disk_datapoints, key=lambda x: x['Timestamp'])
-                if not l_disk_datapoints:
-                    l_avg_disk_utilization = "N/A"
-                    time_series_disk = []
-                    l_disk_values = []
-                else:
-                    time_series_disk = [dp['Timestamp'] for dp in l_disk_datapoints]
-                    l_disk_values = [dp['Average'] for dp in l_disk_datapoints]
-                    l_avg_disk_utilization = calculate_monthly_average(l_disk_datapoints)
-
-                if len(l_disk_values) > 1:
-                    time_series_disk = pd.to_datetime(time_series_disk)
-                    l_disk_values = pd.Series(l_disk_values, index=time_series_disk).resample('D').mean().interpolate().tolist()
-                    time_series_disk = pd.date_range(start=time_series_disk[0], end=time_series_disk[-1], freq='D')
-
-                    # Plot Disk utilization graph
-                    plt.figure(figsize=(10, 6))
-                    plt.plot(time_series_disk, l_disk_values, label='Disk Utilization (%)', color='r', linestyle='-', marker='o')
-                    plt.xlabel('Time')
-                    plt.ylabel('Utilization (%)')
-                    plt.title(f'Disk Utilization - {instance_name} ({instance_id})')
-                    plt.legend()
-                    plt.grid(True)
-                    plt.xticks(rotation=45, ha='right')
-                    plt.tight_layout()
-
-                    graph_file_disk = os.path.join(instance_folder, f'{instance_name}_Disk Utilization for root path.png')
-                    plt.savefig(graph_file_disk)
-                    plt.close()
-                
-            elif volume_count == 2 and platform == 'Red Hat Enterprise Linux':
-                # List of possible path values and Device values
-                path_values = ['/u01','/opt/tyk-gateway']  # Add all potential paths for secondary disk of linux
-                device_values = ['nvme1n1p1','nvme1n1']
-    
-                l_disk_datapoints = get_disk_utilization(
-                    instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform, device = 'nvme0n1p2', disk = '/'
-                )
-
-                l_disk_datapoints = sorted(l_disk_datapoints, key=lambda x: x['Timestamp'])
-                if not l_disk_datapoints:
-                    l_avg_disk_utilization = "N/A"
-                    time_series_disk = []
-                    l_disk_values = []
-                else:
-                    time_series_disk = [dp['Timestamp'] for dp in l_disk_datapoints]
-                    l_disk_values = [dp['Average'] for dp in l_disk_datapoints]
-                    l_avg_disk_utilization = calculate_monthly_average(l_disk_datapoints)
-
-                if len(l_disk_values) > 1:
-                    time_series_disk = pd.to_datetime(time_series_disk)
-                    l_disk_values = pd.Series(l_disk_values, index=time_series_disk).resample('D').mean().interpolate().tolist()
-                    time_series_disk = pd.date_range(start=time_series_disk[0], end=time_series_disk[-1], freq='D')
-
-                    # Plot Disk utilization graph
-                    plt.figure(figsize=(10, 6))
-                    plt.plot(time_series_disk, l_disk_values, label='Disk Utilization (%)', color='r', linestyle='-', marker='o')
-                    plt.xlabel('Time')
-                    plt.ylabel('Utilization (%)')
-                    plt.title(f'Disk Utilization - {instance_name} ({instance_id})')
-                    plt.legend()
-                    plt.grid(True)
-                    plt.xticks(rotation=45, ha='right')
-                    plt.tight_layout()
-
-                    graph_file_disk = os.path.join(instance_folder, f'{instance_name}_Disk Utilization for root path.png')
-                    plt.savefig(graph_file_disk)
-                    plt.close()
-
-                break_outer_loop = False  # Flag to break outer loop
-                for ldevice in device_values:
-                    for lpath in path_values:
-                        l_disk_datapoints2 = get_disk_utilization(
-                            instance_name, instance_id, image_id, instance_type, start_time, end_time, cloudwatch, platform, device=ldevice, disk=lpath
-                        )
-                        l_disk_datapoints2 = sorted(l_disk_datapoints2, key=lambda x: x['Timestamp'])
-                        if not l_disk_datapoints2:
-                            l_avg_disk_utilization2 = "N/A"
-                            time_series_disk = []
-                            l_disk_values2 = []
-                        else:
-                            time_series_disk = [dp['Timestamp'] for dp in l_disk_datapoints2]
-                            l_disk_values2 = [dp['Average'] for dp in l_disk_datapoints2]
-                            l_avg_disk_utilization2 = calculate_monthly_average(l_disk_datapoints2)
-                
-                            if len(l_disk_values2) > 0:
-                                time_series_disk = pd.to_datetime(time_series_disk)
-                                l_disk_values2 = pd.Series(l_disk_values2, index=time_series_disk).resample('D').mean().interpolate().tolist()
-                                time_series_disk = pd.date_range(start=time_series_disk[0], end=time_series_disk[-1], freq='D')
-                
-                                # Plot Disk utilization graph
-                                plt.figure(figsize=(10, 6))
-                                plt.plot(time_series_disk, l_disk_values2, label='Disk Utilization (%)', color='r', linestyle='-', marker='o')
-                                plt.xlabel('Time')
-                                plt.ylabel('Utilization (%)')
-                                plt.title(f'Disk Utilization - {instance_name} ({instance_id})')
-                                plt.legend()
-                                plt.grid(True)
-                                plt.xticks(rotation=45, ha='right')
-                                plt.tight_layout()
-                
-                                graph_file_disk = os.path.join(instance_folder, f'{instance_name}_Disk Utilization for secondary Volume.png')
-                                plt.savefig(graph_file_disk)
-                                plt.close()
-                
-                                break_outer_loop = True  # Set flag to break outer loop
-                                break  # Break the inner loop
-                            
-                    if break_outer_loop:  # Check flag and break outer loop
-                        break
+    workbook = ReportWorkbook(excel_file, REPORT_SHEETS, charts=excel_charts)
 
+    # The account name (STS and IAM calls) is looked up once for the RDS rows and the export partition
+    account_name = collected_data.account_name() if collected_data is not None else None
+    if account_name is None:
+        account_name = clients.account_name(session)
+
+    journal = ReportJournal(
+        os.path.join(output_folder, 'report_journal.jsonl'),
+        {'start_time': start_time, 'end_time': end_time, 'regions': region_names, 'periods': periods, 'collected': collected_data is not None, 'series': series},
+        resume
+    )
+    if journal.resumed:
+        print(f"Resuming an interrupted run: {journal.resumed} instances and databases are reused from {journal.path}")
+
+    # A resumed run adds to the export of the interrupted one, which was written when it stopped
+    exporter = None
+    if export_folder:
+        exporter = DatasetExporter(export_folder, account_name, start_time.strftime('%Y-%m'), export_format, resume=journal.resumed > 0)
+
+    # Older months are only kept at coarser periods by CloudWatch
+    for series_name, period in periods.items():
+        if retention_period(period, start_time) != period:
+            print(f"CloudWatch no longer keeps {period}s datapoints from {start_time:%Y-%m}; {series_name} uses {retention_period(period, start_time)}s")
+
+    # Function to write the rows of an instance or database (kind 'rds': {'report': row, 'charts': charts}) to the
+    # workbook and queue its charts. Replayed items only draw the PNG charts the interrupted run did not save
+    def emit(region_name, kind, item, replayed=False):
+        charts = item['charts']
+        with instrumentation.phase('excel'):
+            if kind == 'instance':
+                workbook.append('Server Utilization', with_region(item['report'], region_name))
+                workbook.append('Network Utilization', with_region(item['network'], region_name))
+                workbook.extend('Disk Utilization', [with_region(row, region_name) for row in item['disks']])
+                workbook.extend('Patch Installation', [with_region(row, region_name) for row in item['patches']])
+                workbook.extend('Patch Compliance Report', [with_region(row, region_name) for row in item['compliance']])
             else:
-                print(f"Instance {instance_name} is running on Unsupported platform for Disk utilization:{platform}.")
+                workbook.append('RDS Report', with_region(item['report'], region_name))
+            workbook.add_charts(charts)
+        if renderer is not None:
+            if replayed:
+                charts = [chart for chart in charts if chart is not None and not os.path.exists(chart['file'])]
+            with instrumentation.phase('charts'):
+                renderer.submit(charts)
+
+    # Function to export the raw series (and for instances the patch and compliance rows) of an item once it is
+    # journaled, so a resumed run, which keeps the export of the interrupted one, does not export it twice.
+    # Datapoints carry their region (the profile's region in a single-region run)
+    def export(region_name, kind, item, series_store=None):
+        region = region_name or session.region_name or ''
+        with instrumentation.phase('export'):
+            if kind == 'instance':
+                if series_store is not None:
+                    exporter.add_series_store('ec2', series_store, item['report']['InstanceId'], region)
+                exporter.add_rows('patches', [with_region(row, region_name) for row in item['patches']])
+                exporter.add_rows('compliance', [with_region(row, region_name) for row in item['compliance']])
+            else:
+                resource_type = 'rds' if item['resource'] == 'Instance' else 'rds-cluster'
+                for metric, metric_series in item['series'].items():
+                    exporter.add_series(resource_type, item['db_name'], metric, 'Average', metric_series, region=region)
+
+    region_rows = {
+        region_name: iter_region_rows(
+            region_clients(clients, session, region_name, instrumentation), start_time, end_time, region_folders[region_name],
+            account_name, workers, caches.get(region_name), exporter, instrumentation, periods, collected_data,
+            journal.finished_in(region_name), series
+        )
+        for region_name in region_names
+    }
+    if regions:
+        rows = iter_regions_rows(region_rows)
+    else:
+        rows = ((None, kind, item) for kind, item in region_rows[None])
+    completed = False
+    try:
+        for region_name, kind, item in journal.replay():
+            emit(region_name, kind, item, replayed=True)
+
+        for region_name, kind, item in rows:
+            clients.refresh_credentials(session)
+            if kind == 'instance':
+                series_store = item.pop('series_store', None)
+                emit(region_name, kind, item)
+                journal.record(region_name, kind, item['report']['InstanceId'], item)
+                if exporter is not None:
+                    export(region_name, kind, item, series_store)
+                instrumentation.progress(workbook.row_count('Server Utilization'))
+            else:
+                rds_rows = {
+                    'report': rds_report_row(item),
+                    'charts': rds_charts(item, os.path.join(region_folders[region_name], 'rds_utilization_graphs'))
+                }
+                emit(region_name, kind, rds_rows)
+                journal.record(region_name, kind, rds_resource_id(item['db_name'], item['resource']), rds_rows)
+                if exporter is not None:
+                    export(region_name, kind, item)
+        instrumentation.progress(workbook.row_count('Server Utilization'), final=True)
+        completed = True
+    finally:
+        # Stop the region threads before their generators are closed
+        rows.close()
+        for rows_of_region in region_rows.values():
+            rows_of_region.close()
+        with instrumentation.phase('excel'):
+            workbook.close()
+        if exporter is not None:
+            with instrumentation.phase('export'):
+                exported = exporter.close()
+            print(f"Exported {', '.join(f'{rows} {table}' for table, rows in exported.items()) or 'nothing'} to {exporter.folder}")
+        if renderer is not None:
+            with instrumentation.phase('charts'):
+                rendered, render_seconds = renderer.close()
+            instrumentation.add_phase_time('chart rendering (worker time)', render_seconds)
+            print(f"Rendered {rendered} charts in {render_seconds:.1f}s of worker time ({renderer.processes} processes)")
+        cache_stats = None
+        if caches:
+            cache_stats = {
+                'hits': sum(cache.hits for cache in caches.values()),
+                'misses': sum(cache.misses for cache in caches.values())
+            }
+            print(f"CloudWatch cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+            for cache in caches.values():
+                cache.close()
+        if collected_data is not None:
+            collected_data.close()
+        # The journal is kept for the next attempt until the whole report is written
+        if completed:
+            journal.complete()
+        else:
+            journal.close()
+        instrumentation.detach()
+
+        # Phase times add up over the worker threads, so they can exceed the wall time
+        run_summary = instrumentation.write_summary(
+            os.path.join(output_folder, 'run_summary.json'),
+            profile=profile_name, start_time=start_time, end_time=end_time, workers=workers,
+            regions=[region_name for region_name in region_names if region_name],
+            rows={sheet_name: workbook.row_count(sheet_name) for sheet_name in REPORT_SHEETS},
+            charts=rendered, cache=cache_stats
+        )
+        print(f"{run_summary['api_calls']} API calls in {run_summary['wall_seconds']}s, run summary saved to {os.path.join(output_folder, 'run_summary.json')}")
 
-            compliance_datapoints = generate_compliance_report(ssm_client, instance_id, instance_name)
-            for compliance in compliance_datapoints:
-                compliance_data.append({
-                'Instance ID': instance_id,
-                    'Instance Name': instance_name,
-                    'Installed': compliance['Installed'],
-                    'InstalledOther': compliance['InstalledOther'],
-                    'Installed Pending Reboot': compliance['Installed Pending Reboot'],
-                    'Installed Rejected':  compliance['Installed Rejected'],
-                    'Missing':  compliance['Missing'],
-                    'Failed':  compliance['Failed'],
-                    'OperationStart':  compliance['OperationStart'],
-                    'OperationEnd':  compliance['OperationEnd']
-                })
-            
-            # Network utilization
-            network_utilization = get_network_utilization(instance_id, start_time, end_time, cloudwatch)
-            network_utilization['InstanceName'] = instance_name
-            network_data.append(network_utilization)
-
-            # Fetch and add patches data
-            patches = get_monthly_patches( ec2 , instance_id, ssm_client, start_time, end_time)
-            for patch in patches:
-                patches_data.append({
-                'Instance Name': instance_name,
-                'Instance ID': instance_id,
-                'Patch Name': patch['Patch Name'],
-                'Severity': patch['Severity'],
-                'Compliance State': patch['Compliance State'],
-                'Installed Time': patch['Installed Time']
-                })
-
-            # Handle missing data by linear interpolation
-            if len(cpu_values) > 1:
-                time_series_cpu = pd.to_datetime(time_series_cpu)
-                cpu_values = pd.Series(cpu_values, index=time_series_cpu).resample('D').mean().interpolate().tolist()
-                time_series_cpu = pd.date_range(start=time_series_cpu[0], end=time_series_cpu[-1], freq='D')
-
-                # Plot CPU utilization graph
-                plt.figure(figsize=(10, 6))
-                plt.plot(time_series_cpu, cpu_values, label='CPU Utilization (%)', color='b', linestyle='-', marker='o')
-                plt.xlabel('Time')
-                plt.ylabel('Utilization (%)')
-                plt.title(f'CPU Utilization - {instance_name} ({instance_id})')
-                plt.legend()
-                plt.grid(True)
-                plt.xticks(rotation=45, ha='right')
-                plt.tight_layout()
-
-                graph_file_cpu = os.path.join(instance_folder, f'{instance_name}_{instance_id}_cpu.png')
-                plt.savefig(graph_file_cpu)
-                plt.close()
-
-            if len(memory_values) > 1:
-                time_series_memory = pd.to_datetime(time_series_memory)
-                memory_values = pd.Series(memory_values, index=time_series_memory).resample('D').mean().interpolate().tolist()
-                time_series_memory = pd.date_range(start=time_series_memory[0], end=time_series_memory[-1], freq='D')
-
-                # Plot Memory utilization graph
-                plt.figure(figsize=(10, 6))
-                plt.plot(time_series_memory, memory_values, label='Memory Utilization (%)', color='g', linestyle='-', marker='o')
-                plt.xlabel('Time')
-                plt.ylabel('Utilization (%)')
-                plt.title(f'Memory Utilization - {instance_name} ({instance_id})')
-                plt.legend()
-                plt.grid(True)
-                plt.xticks(rotation=45, ha='right')
-                plt.tight_layout()
-
-                graph_file_memory = os.path.join(instance_folder, f'{instance_name}_{instance_id}_memory.png')
-                plt.savefig(graph_file_memory)
-                plt.close()
-
-            # Save to Excel
-            report_data.append({
-                'InstanceId': instance_id,
-                'InstanceName': instance_name,
-                'InstancePlatform': platform,
-                'AverageCPUUtilization (%)': avg_cpu_utilization,
-                'AverageMemoryUtilization (%)': avg_memory_utilization,
-                'AverageDiskUtilization root (%)': l_avg_disk_utilization if 'l_avg_disk_utilization' in locals() else 'N/A',
-                f'AverageDiskUtilization (%) for Secondary volume': l_avg_disk_utilization2 if 'w_avg_disk_utilization2' in locals() else 'N/A',
-                'AverageDiskUtilization (%) C Drive': w_avg_disk_utilization if 'w_avg_disk_utilization' in locals() else 'N/A',
-                f'AverageDiskUtilization (%) for Secondary Drive': w_avg_disk_utilization2 if 'w_avg_disk_utilization2' in locals() else 'N/A'   
-            })
+    print(f"Reports generated and saved to {output_folder}")
+    return {
+        'instances': workbook.row_count('Server Utilization'),
+        'databases': workbook.row_count('RDS Report'),
+        'patches': workbook.row_count('Patch Installation'),
+        'charts': rendered,
+        'render_seconds': render_seconds,
+        'excel_file': excel_file
+    }
+
+# Function to parse MM-YYYY into the start of the month and the start of the next month
+def parse_month_year(month_year):
+    month, year = map(int, month_year.split('-'))
+    start_time = datetime(year, month, 1)
+    # Calculate the end of the month
+    if month == 12:
+        end_time = datetime(year + 1, 1, 1)
+    else:
+        end_time = datetime(year, month + 1, 1)
+    return start_time, end_time
+
+# Function to list the months from one MM-YYYY to another (both included) as ('YYYY-MM', start_time, end_time)
+def month_range(from_month_year, to_month_year):
+    start_time, end_time = parse_month_year(from_month_year)
+    last_start_time = parse_month_year(to_month_year)[0]
+    if last_start_time < start_time:
+        raise ValueError(f"{to_month_year} is before {from_month_year}")
+    months = []
+    while start_time <= last_start_time:
+        months.append((start_time.strftime('%Y-%m'), start_time, end_time))
+        start_time, end_time = parse_month_year(end_time.strftime('%m-%Y'))
+    return months
+
+# Names of the sheets of the trend report, in workbook order
+TREND_SHEETS = ['Server Trend', 'Network Trend', 'Patch Installation', 'Patch Compliance Report', 'RDS Trend']
+
+# Network statistics shown month by month in the trend report (columns of summarise_network_utilization)
+TREND_NETWORK_COLUMNS = [
+    'Average Inbound Bandwidth (Mbps)', 'P95 Inbound Bandwidth (Mbps)', 'Max Inbound Bandwidth (Mbps)',
+    'Average Outbound Bandwidth (Mbps)', 'P95 Outbound Bandwidth (Mbps)', 'Max Outbound Bandwidth (Mbps)'
+]
+
+# Function to add the monthly values of one metric to a trend row, with their average over the months with data
+def trend_row(row, month_labels, values):
+    known_values = [value for value in values if value is not None]
+    row.update(zip(month_labels, values))
+    row['Average'] = sum(known_values) / len(known_values) if known_values else None
+    return row
+
+# Function to fetch a batch of metric requests for one window, keeping only the statistics of each series
+def collect_metric_stats(cloudwatch, metric_requests, start_time, end_time, cache=None, instrumentation=None):
+    return collect_metric_data(cloudwatch, metric_requests, start_time, end_time, cache, instrumentation).stats
+
+# Function to start fetching a batch of instances for a trend report on the worker pool: the metric requests are
+# described once and fetched for every month concurrently; patches and compliance are fetched once for the range
+# Trend rows only need the statistics of each month, so only the summaries are fetched (and the disk series)
+def submit_trend_batch(executor, batch, inventory, disk_index, cloudwatch, ssm_client, months, cache=None, instrumentation=None, periods=DEFAULT_PERIODS):
+    metric_requests = describe_instance_batch(batch, inventory, disk_index, periods, series=False)
+    stats_futures = [
+        executor.submit(collect_metric_stats, cloudwatch, metric_requests, start_time, end_time, cache, instrumentation)
+        for _, start_time, end_time in months
+    ]
+    patch_futures = submit_patch_collection(executor, batch, inventory, ssm_client, months[0][1], months[-1][2], instrumentation)
+    return batch, stats_futures, patch_futures
+
+# Function to wait for a submitted trend batch and build its rows and charts in instance order, releasing
+# each instance from the inventory once its rows are consumed
+def report_trend_batch(submitted_batch, inventory, months, output_folder, instrumentation=None):
+    batch, stats_futures, patch_futures = submitted_batch
+    monthly_stats = [stats_future.result() for stats_future in stats_futures]
+    for instance, patch_future in zip(batch, patch_futures):
+        compliance_datapoints, patches = patch_future.result()
+        with phase(instrumentation, 'report rows'):
+            instance_rows = report_trend_instance(instance['InstanceId'], inventory, monthly_stats, months, compliance_datapoints, patches, output_folder)
+        yield instance_rows
+        del inventory[instance['InstanceId']]
+
+# Function to stream the trend rows of the instances, fetching the next batch while the previous one is reported
+def iter_trend_rows(executor, instances, inventory, disk_index, cloudwatch, ssm_client, months, output_folder, cache=None, instrumentation=None, periods=DEFAULT_PERIODS):
+    pending_batch = None
+    for batch in chunked(instances, INSTANCE_BATCH_SIZE):
+        submitted_batch = submit_trend_batch(executor, batch, inventory, disk_index, cloudwatch, ssm_client, months, cache, instrumentation, periods)
+        if pending_batch is not None:
+            yield from report_trend_batch(pending_batch, inventory, months, output_folder, instrumentation)
+        pending_batch = submitted_batch
+
+    if pending_batch is not None:
+        yield from report_trend_batch(pending_batch, inventory, months, output_folder, instrumentation)
+
+# Function to collect the trend rows and charts of one instance from the statistics of each month
+def report_trend_instance(instance_id, inventory, monthly_stats, months, compliance_datapoints, patches, output_folder):
+    instance = inventory[instance_id]
+    instance_name = get_instance_display_name(instance_id, inventory)
+    platform = get_instance_platform(inventory, instance_id)[0]
+    instance_folder = os.path.join(output_folder, instance_name)
+    month_labels = [month_label for month_label, _, _ in months]
+
+    # CPU, memory and every disk volume, one row each; volumes without data in any month are left out
+    utilization_series = [('CPU Utilization (%)', 'b', (instance_id, 'cpu')), ('Memory Utilization (%)', 'g', (instance_id, 'memory'))]
+    for volumes in instance['DiskVolumes'].values():
+        for volume in volumes:
+            if platform == 'Windows':
+                label = f"Disk {volume['disk']} Free Space (%)"
+            else:
+                label = f"Disk {volume['disk']} Utilization (%)"
+            utilization_series.append((label, None, disk_metric_key(instance_id, volume)))
+
+    server_rows = []
+    chart_series = []
+    for label, color, key in utilization_series:
+        values = [summary_statistic(stats, key) for stats in monthly_stats]
+        if key[1] != 'cpu' and all(value is None for value in values):
+            continue
+        server_rows.append(trend_row({
+            'InstanceId': instance_id, 'InstanceName': instance_name, 'InstancePlatform': platform, 'Metric': label
+        }, month_labels, values))
+        chart_series.append((label, color, values))
+
+    # Network statistics of each month
+    network_by_month = [summarise_network_utilization(instance_id, stats) for stats in monthly_stats]
+    network_rows = [
+        trend_row({'InstanceId': instance_id, 'InstanceName': instance_name, 'Metric': column}, month_labels,
+                  [network_utilization[column] for network_utilization in network_by_month])
+        for column in TREND_NETWORK_COLUMNS
+    ]
 
-            # Plot Network utilization graph
-            plt.figure(figsize=(10, 6))
-            plt.bar(['Average Inbound', 'Average Outbound'], 
-                    [network_utilization['Average Inbound Bandwidth (Mbps)'], 
-                     network_utilization['Average Outbound Bandwidth (Mbps)']],
-                    color=['blue', 'green'])
-            plt.xlabel('Network Utilization')
-            plt.ylabel('Bandwidth (Mbps)')
-            plt.title(f'Network Utilization - {instance_name} ({instance_id})')
-            plt.tight_layout()
-
-            network_graph_file = os.path.join(instance_folder, f'{instance_name}_{instance_id}_network.png')
-            plt.savefig(network_graph_file)
-            plt.close()
-
-    rds_utilization_data = get_rds_utilization(session, rds, start_time, end_time, cloudwatch)
-    create_rds_graphs(rds_utilization_data, output_folder)
-    for rds_utilization in rds_utilization_data:
-        rds_data.append({
-        'Database name': rds_utilization['db_name'], 
-        'db_type':rds_utilization['db_type'], 
-        'AWS Account Name':rds_utilization['account_name'], 
-        'CPU Utilization Avg':rds_utilization['cpu_avg'], 
-        'Read IOPS Avg':rds_utilization['read_iops_avg']
+    patches_data = []
+    for patch in patches:
+        patches_data.append({
+            'Instance Name': instance_name,
+            'Instance ID': instance_id,
+            'Month': patch['Installed Time'].strftime('%Y-%m'),
+            'Patch Name': patch['Patch Name'],
+            'Severity': patch['Severity'],
+            'Compliance State': patch['Compliance State'],
+            'Installed Time': patch['Installed Time']
         })
 
-    # Save all data to an Excel file
-    df = pd.DataFrame(report_data)
-    # Save network data to a new sheet
-    network_df = pd.DataFrame(network_data)
-    # save patch data to new sheet
-    patch_df = pd.DataFrame(patches_data)
-    # save compliance data to new sheet
-    compliance_df = pd.DataFrame(compliance_data)
-    # save RDS data to new sheet
-    rds_df = pd.DataFrame(rds_data)
-    excel_file = os.path.join(output_folder, f'Consolidated_report_{profile_name}_{start_time.strftime("%Y_%m")}.xlsx')
-    with pd.ExcelWriter(excel_file, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Server Utilization')
-        network_df.to_excel(writer, index=False, sheet_name='Network Utilization')
-        patch_df.to_excel(writer, index=False, sheet_name='Patch Installation')
-        compliance_df.to_excel(writer, index=False, sheet_name='Patch Compliance Report')
-        rds_df.to_excel(writer, index=False, sheet_name='RDS Report')
+    charts = [
+        trend_chart(
+            month_labels, chart_series, f'Utilization Trend - {instance_name} ({instance_id})', 'Utilization (%)',
+            os.path.join(instance_folder, f'{instance_name}_{instance_id}_utilization_trend.png')
+        ),
+        trend_chart(
+            month_labels,
+            [(direction, color, [network_utilization[f'Average {direction} Bandwidth (Mbps)'] for network_utilization in network_by_month])
+             for direction, color in (('Inbound', 'blue'), ('Outbound', 'green'))],
+            f'Network Trend - {instance_name} ({instance_id})', 'Average Bandwidth (Mbps)',
+            os.path.join(instance_folder, f'{instance_name}_{instance_id}_network_trend.png')
+        )
+    ]
+
+    return {
+        'server': server_rows,
+        'network': network_rows,
+        'patches': patches_data,
+        'compliance': compliance_datapoints,
+        'charts': charts
+    }
 
-    print(f"Reports generated and saved to {output_folder}")
+# Function to stream the trend rows and charts of the RDS instances and clusters; each batch of databases is
+# fetched for every month concurrently
+def iter_rds_trend_rows(executor, account_name, rds, cloudwatch, months, output_folder, cache=None, instrumentation=None, period=3600):
+    month_labels = [month_label for month_label, _, _ in months]
+    rds_base_folder = os.path.join(output_folder, 'rds_utilization_graphs')
+
+    for rds_resources in chunked(iter_rds_resources(rds), RDS_BATCH_SIZE):
+        metric_requests = {}
+        for rds_resource in rds_resources:
+            metric_requests.update(rds_utilization_requests(rds_resource, period, series=False))
+        stats_futures = [
+            executor.submit(collect_metric_stats, cloudwatch, metric_requests, start_time, end_time, cache, instrumentation)
+            for _, start_time, end_time in months
+        ]
+        monthly_stats = [stats_future.result() for stats_future in stats_futures]
+
+        for rds_resource in rds_resources:
+            db_name = rds_resource['Identifier']
+            db_folder = rds_graph_folder(rds_base_folder, db_name, rds_resource['Resource'])
+            rows = []
+            charts = []
+            for metric, _, _, label, ylabel, color, graph_file, scale in RDS_METRICS:
+                key = rds_metric_key(rds_resource, metric)
+                values = [summary_statistic(stats, key) for stats in monthly_stats]
+                values = [value * scale if value is not None else None for value in values]
+                rows.append(trend_row({
+                    'Database name': db_name, 'db_type': rds_resource['Engine'], 'Resource': rds_resource['Resource'],
+                    'AWS Account Name': account_name, 'Metric': label
+                }, month_labels, values))
+                charts.append(trend_chart(
+                    month_labels, [(label, color, values)], f'{db_name} - {ylabel} Trend', ylabel,
+                    os.path.join(db_folder, graph_file.replace('.png', '_trend.png'))
+                ))
+            yield {'rows': rows, 'charts': charts}
+
+# Function to generate a trend report over several months: one workbook with a column per month and trend charts.
+# The inventory, disk discovery, patches and compliance are collected once for the whole range, and the metrics
+# of each batch of instances are fetched for every month concurrently (each month is its own cacheable window).
+# Takes the same options as generate_report; the dataset export is only written by monthly runs.
+def generate_trend_report(profile_name, session, months, output_folder, workers=1,
+                          use_cache=True, refresh_cache=False, cache_size_mb=DEFAULT_CACHE_SIZE_MB, incremental=False,
+                          chart_processes=None, png_charts=True, excel_charts=False, export_folder=None, export_format=None,
+                          progress=False, periods=DEFAULT_PERIODS, collected=False, regions=None, resume=True, clients=None):
+    instrumentation = RunInstrumentation(progress)
+    clients = clients or ClientManager(workers)
+    clients.refresh_credentials(session, force=True)
+    region = region_clients(clients, session, None, instrumentation)
+    cloudwatch, ec2, ssm_client, rds = region['cloudwatch'], region['ec2'], region['ssm'], region['rds']
+
+    cache = None
+    if use_cache or incremental:
+        cache = MetricCache(
+            os.path.join(output_folder, 'cloudwatch_cache.sqlite'), cache_size_mb, refresh=refresh_cache, incremental=incremental
+        )
 
-# Main function to manage the report generation and SSO session handling
-def main(profile_names, month_year):
-    for profile_name in profile_names:
-        session = initialize_session(profile_name)
-        
+    renderer = ChartRenderer(chart_processes) if png_charts else None
+    rendered, render_seconds = 0, 0.0
+
+    first_month, last_month = months[0][1], months[-1][1]
+    excel_file = os.path.join(output_folder, f'Trend_report_{profile_name}_{first_month.strftime("%Y_%m")}_to_{last_month.strftime("%Y_%m")}.xlsx')
+    workbook = ReportWorkbook(excel_file, TREND_SHEETS, charts=excel_charts)
+
+    if export_folder:
+        print("The dataset export is only written by monthly runs; run each month with --month to export it.")
+    if collected:
+        print("Collected data is only read by monthly runs; the trend report is collected from AWS.")
+    if regions:
+        print("Trend reports cover the profile's region only; run each month with --month for other regions.")
+
+    account_name = clients.account_name(session)
+
+    for series_name, period in periods.items():
+        if retention_period(period, first_month) != period:
+            print(f"CloudWatch no longer keeps {period}s datapoints from {first_month:%Y-%m}; {series_name} uses up to {retention_period(period, first_month)}s")
+
+    inventory = {}
+    instance_count = 0
+    try:
+        with instrumentation.phase('inventory'):
+            disk_index = load_disk_index(cloudwatch, output_folder, months[-1][2], cache)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            instances = instrumentation.timed_iter(
+                'inventory', iter_instances(ec2, filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
+            )
+            for instance_rows in iter_trend_rows(executor, instances, inventory, disk_index, cloudwatch, ssm_client, months, output_folder, cache, instrumentation, periods):
+                clients.refresh_credentials(session)
+                with instrumentation.phase('excel'):
+                    workbook.extend('Server Trend', instance_rows['server'])
+                    workbook.extend('Network Trend', instance_rows['network'])
+                    workbook.extend('Patch Installation', instance_rows['patches'])
+                    workbook.extend('Patch Compliance Report', instance_rows['compliance'])
+                    workbook.add_charts(instance_rows['charts'])
+                if renderer is not None:
+                    with instrumentation.phase('charts'):
+                        renderer.submit(instance_rows['charts'])
+                instance_count += 1
+                instrumentation.progress(instance_count)
+            instrumentation.progress(instance_count, final=True)
+
+            for rds_rows in instrumentation.timed_iter('rds', iter_rds_trend_rows(executor, account_name, rds, cloudwatch, months, output_folder, cache, instrumentation, periods['utilization'])):
+                with instrumentation.phase('excel'):
+                    workbook.extend('RDS Trend', rds_rows['rows'])
+                    workbook.add_charts(rds_rows['charts'])
+                if renderer is not None:
+                    with instrumentation.phase('charts'):
+                        renderer.submit(rds_rows['charts'])
+    finally:
+        with instrumentation.phase('excel'):
+            workbook.close()
+        if renderer is not None:
+            with instrumentation.phase('charts'):
+                rendered, render_seconds = renderer.close()
+            instrumentation.add_phase_time('chart rendering (worker time)', render_seconds)
+            print(f"Rendered {rendered} charts in {render_seconds:.1f}s of worker time ({renderer.processes} processes)")
+        cache_stats = None
+        if cache is not None:
+            cache_stats = {'hits': cache.hits, 'misses': cache.misses}
+            print(f"CloudWatch cache: {cache.hits} hits, {cache.misses} misses")
+            cache.close()
+        instrumentation.detach()
+
+        run_summary = instrumentation.write_summary(
+            os.path.join(output_folder, 'run_summary.json'),
+            profile=profile_name, months=[month_label for month_label, _, _ in months], workers=workers,
+            rows={sheet_name: workbook.row_count(sheet_name) for sheet_name in TREND_SHEETS},
+            charts=rendered, cache=cache_stats
+        )
+        print(f"{run_summary['api_calls']} API calls in {run_summary['wall_seconds']}s, run summary saved to {os.path.join(output_folder, 'run_summary.json')}")
+
+    print(f"Trend report generated and saved to {output_folder}")
+    return {
+        'instances': instance_count,
+        'databases': workbook.row_count('RDS Trend') // len(RDS_METRICS),
+        'patches': workbook.row_count('Patch Installation'),
+        'charts': rendered,
+        'render_seconds': render_seconds,
+        'excel_file': excel_file
+    }
+
+# Function to get the folder holding the reports of a run: monthly-reports-<label>, or trend-reports-<label>
+# when the run covers a range of months, inside output_dir (default: the working directory)
+def reports_folder(run_label, months=None, output_dir=''):
+    return os.path.join(output_dir, f'trend-reports-{run_label}' if months else f'monthly-reports-{run_label}')
+
+# Number of times a profile's report is resumed after an unexpected error before the profile is given up
+RUN_RETRIES = 2
+
+# Function to generate the report of one profile with its own session, re-logging in when SSO expires
+# and resuming the report where it stopped (see ReportJournal); other errors are retried RUN_RETRIES times
+# With months (see month_range) a trend report over those months is generated instead of a monthly one
+# Runs inside a worker process when several profiles are reported in parallel
+def run_profile(profile_name, month_year, start_time, end_time, report_options, months=None, output_dir=''):
+    started = time.time()
+    summary = {'Profile': profile_name, 'Status': 'Failed', 'Instances': 0, 'Databases': 0, 'Patches': 0, 'Report': '', 'Error': ''}
+    session = initialize_session(profile_name)
+    retries = 0
+
+    # The clients are shared by every attempt, and the SSO login is renewed before it expires; an expired
+    # token is still handled below when the login could not be renewed in time
+    clients = ClientManager(report_options.get('workers', 1))
+
+    while True:
         try:
-        # Parse the input month and year
-            month, year = map(int, month_year.split('-'))
-            start_time = datetime(year, month, 1)
-            # Calculate the end of the month
-            if month == 12:
-                end_time = datetime(year + 1, 1, 1)
+            # Create a folder with AWS account name and month_year
+            output_folder = os.path.join(reports_folder(month_year, months, output_dir), f'{profile_name}-{month_year}')
+            os.makedirs(output_folder, exist_ok=True)
+            if months:
+                result = generate_trend_report(profile_name, session, months, output_folder, clients=clients, **report_options)
             else:
-                end_time = datetime(year, month + 1, 1)
-        except ValueError:
-            print("Invalid input format. Please enter month and year as MM-YYYY.")
-            return
-
-        while True:
-            try:
-                # Create a folder with AWS account name and month_year
-                output_folder = f'monthly-reports-{month_year}/{profile_name}-{month_year}'
-                os.makedirs(output_folder, exist_ok=True)
-                generate_report(profile_name, session, start_time, end_time, output_folder)
-                break
-            except botocore.exceptions.UnauthorizedSSOTokenError:
-                print("AWS SSO session has expired. Attempting to re-login...")
-                login_to_sso(profile_name)
-                session = initialize_session(profile_name)
-            except Exception as e:
-                print(f"An unexpected error occurred: {e}")
+                result = generate_report(profile_name, session, start_time, end_time, output_folder, clients=clients, **report_options)
+            summary.update({
+                'Status': 'OK',
+                'Instances': result['instances'],
+                'Databases': result['databases'],
+                'Patches': result['patches'],
+                'Report': result['excel_file']
+            })
+            break
+        except botocore.exceptions.UnauthorizedSSOTokenError:
+            print(f"AWS SSO session for {profile_name} has expired. Attempting to re-login...")
+            login_to_sso(profile_name)
+            session = initialize_session(profile_name)
+            clients.discard(profile_name)
+        except Exception as e:
+            # Another attempt carries on from the instances the report journal holds
+            retries += 1
+            if retries > RUN_RETRIES:
+                print(f"An unexpected error occurred for {profile_name}: {e}")
+                summary['Error'] = str(e)
                 break
+            print(f"An unexpected error occurred for {profile_name}: {e}. Resuming ({retries}/{RUN_RETRIES})...")
+            session = initialize_session(profile_name)
+            clients.discard(profile_name)
+
+    summary['Duration (s)'] = round(time.time() - started, 1)
+    return summary
+
+# Function to print and save the combined summary of a multi-profile run
+def write_run_summary(summaries, month_year, months=None, output_dir=''):
+    columns = list(dict.fromkeys(column for summary in summaries for column in summary))
+    widths = {column: max([len(column)] + [len(str(summary.get(column, ''))) for summary in summaries]) for column in columns}
+    print('  '.join(column.rjust(widths[column]) for column in columns))
+    for summary in summaries:
+        print('  '.join(str(summary.get(column, '')).rjust(widths[column]) for column in columns))
+
+    summary_file = os.path.join(reports_folder(month_year, months, output_dir), f'run_summary_{month_year}.csv')
+    os.makedirs(os.path.dirname(summary_file), exist_ok=True)
+    with open(summary_file, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(summaries)
+    print(f"Run summary saved to {summary_file}")
+
+# Main function to manage the report generation and SSO session handling
+# Each profile runs in its own process (up to processes at a time) with its own boto3 session
+# report_options are passed through to generate_report (workers, cache settings, ...)
+# With to_month_year, a trend report from month_year to to_month_year is generated for each profile
+# The report folders are created in output_dir (default: the working directory)
+def main(profile_names, month_year, processes=1, to_month_year=None, output_dir='', **report_options):
+    try:
+        # Parse the input month and year
+        start_time, end_time = parse_month_year(month_year)
+        months = month_range(month_year, to_month_year) if to_month_year else None
+    except ValueError:
+        print("Invalid input format. Please enter month and year as MM-YYYY, with --from before --to.")
+        return
+    if months:
+        month_year = f'{month_year}_{to_month_year}'
+
+    if processes > 1 and len(profile_names) > 1:
+        # Share the cores between the chart renderers of the profiles running side by side
+        if report_options.get('chart_processes') is None:
+            report_options['chart_processes'] = max((os.cpu_count() or 1) // processes, 1)
+        with ProcessPoolExecutor(max_workers=min(processes, len(profile_names))) as executor:
+            futures = [
+                executor.submit(run_profile, profile_name, month_year, start_time, end_time, report_options, months, output_dir)
+                for profile_name in profile_names
+            ]
+            summaries = [future.result() for future in futures]
+    else:
+        summaries = [
+            run_profile(profile_name, month_year, start_time, end_time, report_options, months, output_dir)
+            for profile_name in profile_names
+        ]
+
+    write_run_summary(summaries, month_year, months, output_dir)
+
+# Function to turn a month argument into MM-YYYY: 'current' and 'previous' are the month of today and the one
+# before it, so scheduled runs need no date arithmetic; anything else is returned as given
+def resolve_month(value, today=None):
+    today = today or datetime.now()
+    if value == 'current':
+        return today.strftime('%m-%Y')
+    if value == 'previous':
+        return (today.replace(day=1) - timedelta(days=1)).strftime('%m-%Y')
+    return value
+
+# Function to build the command line parser of the report
+def build_parser():
+    parser = argparse.ArgumentParser(description='Generate the monthly AWS utilization report.')
+    parser.add_argument('--profiles', help='Comma separated SSO profile names')
+    parser.add_argument('--profiles-file', help='File with one SSO profile name per line')
+    parser.add_argument('--month', help="Month and year of the report (MM-YYYY, or 'current' / 'previous')")
+    parser.add_argument('--from', dest='from_month', help="First month of a trend report over a range of months (MM-YYYY, or 'current' / 'previous')")
+    parser.add_argument('--to', dest='to_month', help='Last month of the trend report (MM-YYYY, default: the --from month)')
+    parser.add_argument('--output-dir', default='', help='Folder the report folders are created in (default: the working directory)')
+    parser.add_argument('--non-interactive', action='store_true', help='Never prompt for missing profiles or month; fail instead (implied when input is not a terminal)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of instances collected concurrently per profile (default: 1)')
+    parser.add_argument('--processes', type=int, default=1, help='Number of profiles reported in parallel (default: 1)')
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write the local CloudWatch cache')
+    parser.add_argument('--refresh', action='store_true', help='Fetch everything from CloudWatch again and refresh the cache')
+    parser.add_argument('--incremental', action='store_true', help='Month-to-date mode: only fetch datapoints added since the last run')
+    parser.add_argument('--chart-processes', type=int, help='Number of processes drawing charts (default: CPU count, 0 draws them inline)')
+    parser.add_argument('--excel-charts', action='store_true', help='Embed native Excel charts in the workbook')
+    parser.add_argument('--no-png-charts', action='store_true', help='Do not draw PNG charts next to the workbook')
+    parser.add_argument('--no-charts', '--metrics-only', dest='no_charts', action='store_true', help='Only write the report sheets: no PNG or Excel charts, and matplotlib is never loaded')
+    parser.add_argument('--export', help='Also export the raw datapoints and patch rows to a dataset in this folder')
+    parser.add_argument('--export-format', choices=['parquet', 'jsonl'], help='Dataset format (default: parquet when pyarrow is installed, else jsonl)')
+    parser.add_argument('--progress', action='store_true', help='Show a live progress line')
+    parser.add_argument('--utilization-period', type=int, default=DEFAULT_PERIODS['utilization'], help=f"Period in seconds of the CPU, memory, disk and RDS series (default: {DEFAULT_PERIODS['utilization']}, daily)")
+    parser.add_argument('--network-period', type=int, default=DEFAULT_PERIODS['network'], help=f"Period in seconds of the network series used for P95 (default: {DEFAULT_PERIODS['network']})")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB, help=f'Cache size limit in MB (default: {DEFAULT_CACHE_SIZE_MB})')
+    parser.add_argument('--regions', help="Comma separated regions to report on, or 'all' for every enabled region (default: the profile's region)")
+    parser.add_argument('--restart', action='store_true', help='Start over instead of resuming an interrupted run of the same report')
+    parser.add_argument('--collected', action='store_true', help='Build the report from the data the background collector (collector.py) stored')
+    return parser
+
+# Function to run the report from command line arguments (sys.argv when argv is None)
+# Missing profiles or month are only asked for when someone is at the terminal; scheduled runs fail right away
+def cli(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.month and args.from_month:
+        parser.error('use either --month or --from/--to')
+    if args.to_month and not args.from_month:
+        parser.error('--to needs --from')
+    if args.no_charts and args.excel_charts:
+        parser.error('--no-charts cannot be combined with --excel-charts')
+    interactive = not args.non_interactive and sys.stdin is not None and sys.stdin.isatty()
+
+    profile_names = []
+    if args.profiles:
+        profile_names.extend(parse_profile_names(args.profiles))
+    if args.profiles_file:
+        profile_names.extend(read_profile_names(args.profiles_file))
+    if not profile_names:
+        if not interactive:
+            parser.error('pass --profiles or --profiles-file')
+        profile_names = parse_profile_names(input("Enter SSO Profile(s): "))
+    to_month_year = None
+    if args.from_month:
+        month_year, to_month_year = resolve_month(args.from_month), resolve_month(args.to_month or args.from_month)
+    elif args.month:
+        month_year = resolve_month(args.month)
+    else:
+        if not interactive:
+            parser.error('pass --month or --from')
+        month_year = input("Enter the month and year (MM-YYYY): ")
+    main(
+        profile_names, month_year, max(args.processes, 1), to_month_year,
+        output_dir=args.output_dir,
+        workers=max(args.workers, 1),
+        use_cache=not args.no_cache,
+        refresh_cache=args.refresh,
+        cache_size_mb=args.cache_size,
+        incremental=args.incremental,
+        chart_processes=args.chart_processes,
+        png_charts=not (args.no_png_charts or args.no_charts),
+        excel_charts=args.excel_charts,
+        export_folder=args.export,
+        export_format=args.export_format,
+        progress=args.progress,
+        periods={'utilization': args.utilization_period, 'network': args.network_period},
+        collected=args.collected,
+        resume=not args.restart,
+        regions=[region.strip() for region in args.regions.split(',') if region.strip()] if args.regions else None
+    )
 
 # Run the main function
 if __name__ == "__main__":
-    profile_names = input("Enter SSO Profile: ")
-    #profile_names = []
-    month_year = input("Enter the month and year (MM-YYYY): ")
-    main(profile_names, month_year)
+    multiprocessing.freeze_support()  # Needed for the process pool in the PyInstaller executable
+    cli()
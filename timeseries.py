@@ -0,0 +1,102 @@
+import numpy as np
+
+# Percentiles computed for every series in the fleet-wide summary
+SUMMARY_PERCENTILES = (95, 99)
+
+
+# Columnar store of time series: one contiguous timestamp array (epoch seconds) and one value array for
+# all series, with offsets marking where each (resource, metric) series starts
+class SeriesStore:
+    def __init__(self):
+        self.keys = []
+        self.index = {}
+        self.timestamps = np.empty(0, dtype=np.int64)
+        self.values = np.empty(0, dtype=np.float64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.stats = {}
+        self._pending = []
+
+    # Function to build a store from the columns returned by the metrics engine
+    @classmethod
+    def from_columns(cls, metric_columns):
+        store = cls()
+        for key, columns in metric_columns.items():
+            for statistic, values in columns.items():
+                if statistic != 'Timestamp':
+                    store.add((key, statistic), columns['Timestamp'], values)
+        store.freeze()
+        return store
+
+    # Function to queue a series; missing values (NaN) are dropped
+    def add(self, key, timestamps, values):
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        present = ~np.isnan(values)
+        self.index[key] = len(self.keys)
+        self.keys.append(key)
+        self._pending.append((timestamps[present], values[present]))
+
+    # Function to pack the queued series into the contiguous arrays and compute their statistics
+    def freeze(self):
+        if self._pending:
+            lengths = [len(timestamps) for timestamps, _ in self._pending]
+            self.timestamps = np.concatenate([self.timestamps] + [timestamps for timestamps, _ in self._pending])
+            self.values = np.concatenate([self.values] + [values for _, values in self._pending])
+            self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+            self._pending = []
+        self.stats = self.summarise()
+        return self
+
+    # Function to get the (timestamps, values) arrays of one series, empty when it is unknown
+    def series(self, key):
+        position = self.index.get(key)
+        if position is None:
+            return self.timestamps[:0], self.values[:0]
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.timestamps[start:end], self.values[start:end]
+
+    # Function to compute count, mean, min, max and percentiles of every series in one vectorized pass
+    def summarise(self, percentiles=SUMMARY_PERCENTILES):
+        counts = np.diff(self.offsets)
+        if not len(counts):
+            return {}
+        starts = self.offsets[:-1]
+        has_data = counts > 0
+
+        if len(self.values):
+            # reduceat only runs over the series with data: an empty series would share its start with the
+            # next one (or be clamped onto the last datapoint) and cut the series before it short
+            sums = np.zeros(len(counts))
+            minimums = np.zeros(len(counts))
+            maximums = np.zeros(len(counts))
+            data_starts = starts[has_data]
+            sums[has_data] = np.add.reduceat(self.values, data_starts)
+            minimums[has_data] = np.minimum.reduceat(self.values, data_starts)
+            maximums[has_data] = np.maximum.reduceat(self.values, data_starts)
+
+            # Sort values within each series, then interpolate percentiles the way np.percentile does
+            segment_ids = np.repeat(np.arange(len(counts)), counts)
+            sorted_values = self.values[np.lexsort((self.values, segment_ids))]
+            percentile_values = {}
+            for percentile in percentiles:
+                position = np.maximum(counts - 1, 0) * (percentile / 100.0)
+                lower = np.floor(position).astype(np.int64)
+                upper = np.ceil(position).astype(np.int64)
+                lower_values = sorted_values[np.minimum(starts + lower, len(sorted_values) - 1)]
+                upper_values = sorted_values[np.minimum(starts + upper, len(sorted_values) - 1)]
+                percentile_values[percentile] = lower_values + (upper_values - lower_values) * (position - lower)
+
+        stats = {}
+        for position, key in enumerate(self.keys):
+            if not has_data[position]:
+                stats[key] = {'count': 0, 'mean': None, 'min': None, 'max': None}
+                stats[key].update({f'p{percentile}': None for percentile in percentiles})
+                continue
+            stats[key] = {
+                'count': int(counts[position]),
+                'mean': float(sums[position] / counts[position]),
+                'min': float(minimums[position]),
+                'max': float(maximums[position])
+            }
+            stats[key].update({f'p{percentile}': float(percentile_values[percentile][position]) for percentile in percentiles})
+        return stats
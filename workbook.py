@@ -0,0 +1,114 @@
+import xlsxwriter
+
+from charts import daily_means
+
+# Rows of one chart band in the Charts sheet (a chart is about 15 rows high) and charts per band
+CHART_BAND_ROWS = 16
+CHARTS_PER_BAND = 2
+
+
+# Streaming Excel writer: rows are appended to each sheet as they are produced and flushed to disk right
+# away (xlsxwriter constant memory mode), so memory does not grow with the number of rows.
+# With charts=True, chart descriptions (see charts.py) are embedded as native Excel charts whose data is
+# written to a 'Chart Data' sheet, instead of being drawn to PNG files.
+class ReportWorkbook:
+    def __init__(self, path, sheet_names, charts=False):
+        self.path = path
+        self.workbook = xlsxwriter.Workbook(path, {
+            'constant_memory': True,
+            'default_date_format': 'yyyy-mm-dd hh:mm:ss'
+        })
+        self.date_format = self.workbook.add_format({'num_format': 'yyyy-mm-dd'})
+        self.sheets = {}
+        for sheet_name in sheet_names:
+            self.sheets[sheet_name] = {'worksheet': self.workbook.add_worksheet(sheet_name), 'columns': None, 'next_row': 0}
+
+        self.chart_sheet = None
+        self.chart_data_sheet = None
+        if charts:
+            self.chart_sheet = self.workbook.add_worksheet('Charts')
+            self.chart_data_sheet = self.workbook.add_worksheet('Chart Data')
+        self.chart_count = 0
+        self.chart_data_row = 0
+
+    # Function to append one row (a dict) to a sheet; the keys of the first row become the header
+    def append(self, sheet_name, row):
+        sheet = self.sheets[sheet_name]
+        worksheet = sheet['worksheet']
+        if sheet['columns'] is None:
+            sheet['columns'] = list(row)
+            worksheet.write_row(0, 0, sheet['columns'])
+            sheet['next_row'] = 1
+        for column, name in enumerate(sheet['columns']):
+            value = row.get(name)
+            if value is not None and value == value:  # Leave missing and NaN values blank, as pandas does
+                worksheet.write(sheet['next_row'], column, value)
+        sheet['next_row'] += 1
+
+    # Function to get the number of data rows written to a sheet
+    def row_count(self, sheet_name):
+        return max(self.sheets[sheet_name]['next_row'] - 1, 0)
+
+    # Function to append several rows to a sheet
+    def extend(self, sheet_name, rows):
+        for row in rows:
+            self.append(sheet_name, row)
+
+    # Function to embed chart descriptions as native Excel charts (ignored unless charts are enabled)
+    def add_charts(self, charts):
+        if self.chart_sheet is None:
+            return
+        for chart in charts:
+            if chart is not None:
+                self.add_chart(chart)
+
+    # Function to write the data of one chart to the Chart Data sheet and place a chart that references it
+    def add_chart(self, chart):
+        if chart['kind'] == 'daily':
+            categories, values = daily_means(chart['timestamps'], chart['values'])
+            categories = categories.astype(object).tolist()
+            series = [(chart['label'], values)]
+        elif chart['kind'] == 'line':
+            categories = chart['timestamps'].astype('datetime64[s]').astype(object).tolist()
+            series = [(chart['label'], chart['values'])]
+        elif chart['kind'] == 'trend':
+            categories = chart['labels']
+            series = [(label, values) for label, color, values in chart['series']]
+        else:
+            categories = chart['labels']
+            series = [(chart.get('label', chart['title']), chart['values'])]
+
+        # One row with the categories (dates or labels) titled with the chart, then one row per series
+        category_row = self.chart_data_row
+        self.chart_data_row += 1 + len(series)
+        self.chart_data_sheet.write(category_row, 0, chart['title'])
+        for column, category in enumerate(categories, start=1):
+            if chart['kind'] in ('bar', 'trend'):
+                self.chart_data_sheet.write(category_row, column, category)
+            else:
+                self.chart_data_sheet.write_datetime(category_row, column, category, self.date_format)
+
+        excel_chart = self.workbook.add_chart({'type': 'column' if chart['kind'] == 'bar' else 'line'})
+        last_column = len(categories)
+        for value_row, (label, values) in enumerate(series, start=category_row + 1):
+            self.chart_data_sheet.write(value_row, 0, label)
+            for column, value in enumerate(values, start=1):
+                if value == value:  # Leave NaN (months without data) blank
+                    self.chart_data_sheet.write_number(value_row, column, float(value))
+            excel_chart.add_series({
+                'name': ['Chart Data', value_row, 0],
+                'categories': ['Chart Data', category_row, 1, category_row, last_column],
+                'values': ['Chart Data', value_row, 1, value_row, last_column],
+                'marker': {'type': 'circle'} if chart['kind'] in ('daily', 'trend') else {'type': 'none'}
+            })
+        excel_chart.set_title({'name': chart['title']})
+        excel_chart.set_y_axis({'name': chart.get('ylabel', 'Utilization (%)')})
+        if chart['kind'] == 'bar':
+            excel_chart.set_legend({'none': True})
+
+        band, position = divmod(self.chart_count, CHARTS_PER_BAND)
+        self.chart_sheet.insert_chart(band * CHART_BAND_ROWS, position * 9, excel_chart)
+        self.chart_count += 1
+
+    def close(self):
+        self.workbook.close()